@@ -5,19 +5,24 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from starlette.status import HTTP_401_UNAUTHORIZED
 from jinja2 import Template
 import os, secrets, time
-import phonenumbers
-from phonenumbers import NumberParseException
 from datetime import datetime
 import pytz
 from typing import Any, Dict, Optional
-
-from firebase import get_user_doc, admin_verify_password, update_user_billing
-try:
-    from firebase import append_admin_audit
-except Exception as _e:
-    def append_admin_audit(*_args, **_kwargs):
-        raise RuntimeError("append_admin_audit() is not defined in firebase.py. "
-                           "Please add it (ArrayUnion into users/{phone}.admin_audit).")
+import lazy
+import graph_client
+import ratelimit
+import media
+import outbound
+from outbox import outbox
+import replies
+import inbound
+import commands
+import listlock
+
+from firebase import (
+    get_user_doc, admin_verify_password, update_user_billing, cache_stats, mirror_stats,
+    append_admin_audit, get_admin_audit_page,
+)
 
 from billing import compute_status, load_config
 try:
@@ -52,13 +57,14 @@ def require_admin(credentials: HTTPBasicCredentials = Depends(security)) -> str:
 
 
 def _normalize_phone(raw: str, default_region: str = "BR") -> str | None:
+    phonenumbers = lazy.load("phonenumbers")
     raw = (raw or "").strip()
     try:
         parsed = phonenumbers.parse(raw, None if raw.startswith("+") else default_region)
         if not phonenumbers.is_valid_number(parsed):
             return None
         return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
-    except NumberParseException:
+    except phonenumbers.NumberParseException:
         return None
 
 
@@ -165,7 +171,8 @@ def _stripe_refresh_patch(phone: str) -> Optional[Dict[str, Any]]:
     print("🧩 Stripe refresh patch (final):", patch)
     return patch
 
-def _render_lookup_page(owner_phone: str, who: str, url_error: str = "") -> str:
+def _render_lookup_page(owner_phone: str, who: str, url_error: str = "",
+                        audit_before: int | None = None) -> str:
     with open("templates/admin.html", encoding="utf-8") as f:
         tpl = Template(f.read())
 
@@ -181,7 +188,12 @@ def _render_lookup_page(owner_phone: str, who: str, url_error: str = "") -> str:
     billing = (user.get("billing") or {})
     state, until_ts = compute_status(billing)
     state_pt = STATUS_NAMES_PT.get(state, state)
-    audit = user.get("admin_audit", [])
+    audit, audit_next = get_admin_audit_page(e164, before=audit_before)
+    if audit_before is None and user.get("admin_audit"):
+        # Entries still on the user doc (not yet moved by maintenance.py slim-users) are
+        # oldest-first; merge them into the newest-first page by ts
+        legacy = list(reversed(user["admin_audit"]))
+        audit = sorted(audit + legacy, key=lambda e: int(e.get("ts") or 0), reverse=True)
 
     exempt = bool(billing.get("exempt") or billing.get("isencao") or billing.get("lifetime"))
 
@@ -214,6 +226,7 @@ def _render_lookup_page(owner_phone: str, who: str, url_error: str = "") -> str:
 
         "exempt": exempt,
         "admin_audit": audit,
+        "admin_audit_next": audit_next,
     }
 
     return tpl.render(query=e164, error=url_error, result=derived, who=who)
@@ -238,11 +251,31 @@ def admin_lookup_post(
 def admin_lookup_get(
     owner_phone: str = Query(None),
     err: str = Query("", alias="err"),
+    audit_before: Optional[int] = Query(None),
     who: str = Depends(require_admin),
 ):
     if not owner_phone:
         return admin_home(who)
-    return _render_lookup_page(owner_phone, who, url_error=err)
+    return _render_lookup_page(owner_phone, who, url_error=err, audit_before=audit_before)
+
+
+@router.get("/admin/metrics")
+def admin_metrics(who: str = Depends(require_admin)):
+    """Runtime counters for this worker process (JSON)."""
+    return {
+        "doc_cache": cache_stats(),
+        "list_mirror": mirror_stats(),
+        "graph_http": graph_client.stats(),
+        "graph_rate_limit": ratelimit.stats(),
+        "media": media.stats(),
+        "outbound": outbound.stats(),
+        "outbox": outbox.stats(),
+        "replies": replies.stats(),
+        "webhook_batches": inbound.stats(),
+        "commands": commands.stats(),
+        "list_locks": listlock.stats(),
+        "lazy_loads_ms": lazy.load_stats(),
+    }
 
 
 # ----------------------------
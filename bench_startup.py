@@ -0,0 +1,103 @@
+# bench_startup.py
+"""
+Cold-start report and budget check. Imports main.py in fresh interpreters
+(python -X importtime) and prints the slowest modules, then what the lazy
+loads cost when the warm-up runs.
+
+    python bench_startup.py
+    python bench_startup.py --runs 5 --top 30 --budget-ms 800
+    python bench_startup.py --no-warm-up
+
+Exits 1 when the median `import main` time is over the budget
+(STARTUP_BUDGET_MS, default 1500), so a deploy check can catch regressions.
+STORAGE_BACKEND defaults to memory here: no credentials or network needed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1500"))
+
+_CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - started) * 1000
+warm_up_ms = None
+if sys.argv[1] == "1":
+    started = time.perf_counter()
+    main._warm_up()
+    warm_up_ms = (time.perf_counter() - started) * 1000
+import lazy
+print("BENCH " + json.dumps({"import_ms": import_ms, "warm_up_ms": warm_up_ms, "lazy": lazy.load_stats()}))
+"""
+
+
+def _run_once(warm_up: bool) -> tuple[dict, list[tuple[int, int, str]]]:
+    env = dict(os.environ)
+    env.setdefault("STORAGE_BACKEND", "memory")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD, "1" if warm_up else "0"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr[-4000:])
+        raise SystemExit(f"❌ Importing main failed (exit {proc.returncode})")
+
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH "):
+            result = json.loads(line[len("BENCH "):])
+
+    # "import time:   self [us] | cumulative | imported package"
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return result, modules
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure main.py cold-start time.")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters to time (median is used)")
+    parser.add_argument("--top", type=int, default=20, help="slowest modules to list")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--no-warm-up", action="store_true", help="skip timing the lazy loads")
+    args = parser.parse_args(argv)
+
+    runs = []
+    modules = []
+    for i in range(max(1, args.runs)):
+        result, found = _run_once(warm_up=not args.no_warm_up and i == 0)
+        runs.append(result)
+        if i == 0:
+            modules = found
+
+    print(f"Slowest imports (cumulative, first run):")
+    for self_us, cumulative_us, name in sorted(modules, key=lambda m: -m[1])[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  (self {self_us / 1000:6.1f})  {name}")
+
+    first = runs[0]
+    if first.get("warm_up_ms") is not None:
+        print(f"\nWarm-up (deferred loads): {first['warm_up_ms']:.0f} ms")
+        for name, ms in sorted(first["lazy"].items(), key=lambda kv: -kv[1]):
+            print(f"  {ms:8.1f} ms  {name}")
+
+    import_times = [r["import_ms"] for r in runs]
+    median = statistics.median(import_times)
+    print(f"\nimport main: median {median:.0f} ms over {len(runs)} run(s) "
+          f"({', '.join(f'{t:.0f}' for t in import_times)}); budget {args.budget_ms:.0f} ms")
+    if median > args.budget_ms:
+        print("❌ Startup is over budget")
+        return 1
+    print("✅ Startup within budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,10 +5,9 @@ from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import Optional, Tuple, Dict, Any
 
-try:
-    import stripe  # type: ignore
-except Exception:
-    stripe = None
+import lazy
+
+stripe = None  # imported on first use, see _require_stripe()
 
 from firebase import (
     get_user_doc,
@@ -98,8 +97,13 @@ def compute_status(b: Dict[str, Any] | None) -> Tuple[str, Optional[int]]:
     return ("EXPIRED", None)
 
 def _require_stripe():
+    global stripe
     if stripe is None:
-        raise RuntimeError("Stripe SDK not installed. Add 'stripe' to requirements.txt and redeploy.")
+        try:
+            stripe = lazy.load("stripe")  # type: ignore
+        except Exception:
+            raise RuntimeError("Stripe SDK not installed. Add 'stripe' to requirements.txt and redeploy.")
+    return stripe
 
 def ensure_customer(phone: str) -> str:
     _require_stripe()
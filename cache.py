@@ -0,0 +1,83 @@
+# cache.py
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Values are deep-copied in and out so callers can't mutate cached state.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1000, ttl: float = 30.0):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[str, tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> tuple[bool, object]:
+        """Return (found, value). A cached None is a valid value (missing doc)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, copy.deepcopy(value)
+
+    def set(self, key: str, value) -> None:
+        if self.ttl <= 0:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key: str) -> tuple[bool, object]:
+        """Like get() but without touching LRU order or counters."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return False, None
+            return True, copy.deepcopy(entry[1])
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._data)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,163 @@
+# commands.py
+"""
+WhatsApp command registry.
+
+main.py registers one handler per command with @command("/i", ...), with
+its aliases and declared properties:
+
+    needs_list    sender must already be in a list (else NOT_IN_LIST)
+    requires_arg  without an argument the command is unknown
+    gated         subscription gate (_gate_if_needed) runs first
+    admin_only    message sent to non-admins instead of running the handler
+    locks_list    mutates the sender's list: runs under listlock (one at a time per list)
+
+Dispatch is one dict lookup. measure() records, per command, the handler's
+wall time, Firestore reads/writes and outbound sends in histograms shown in
+/admin/metrics.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+class Histogram:
+    """Fixed-bucket histogram (count per upper bound, plus overflow)."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (max for the overflow)."""
+        if not self.n:
+            return 0.0
+        rank = q * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return float(self.bounds[i]) if i < len(self.bounds) else round(self.max, 1)
+        return round(self.max, 1)
+
+    def as_dict(self) -> dict:
+        labels = [f"<={b}" for b in self.bounds] + [f">{self.bounds[-1]}"]
+        return {
+            "count": self.n,
+            "avg": round(self.total / self.n, 1) if self.n else 0.0,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 1),
+            "buckets": {label: c for label, c in zip(labels, self.counts) if c},
+        }
+
+
+class Command:
+    __slots__ = ("name", "handler", "aliases", "needs_list", "requires_arg", "gated", "admin_only",
+                 "locks_list")
+
+    def __init__(self, name, handler, aliases, needs_list, requires_arg, gated, admin_only, locks_list):
+        self.name = name
+        self.handler = handler
+        self.aliases = aliases
+        self.needs_list = needs_list
+        self.requires_arg = requires_arg
+        self.gated = gated
+        self.admin_only = admin_only
+        self.locks_list = locks_list
+
+
+_registry: dict[str, Command] = {}
+
+
+def normalize(word: str) -> str:
+    word = (word or "").strip().lower()
+    return word if word.startswith("/") else "/" + word
+
+
+def command(name: str, *aliases: str, needs_list: bool = True, requires_arg: bool = False,
+            gated: bool = False, admin_only: str | None = None, locks_list: bool = False):
+    """Register the decorated handler(from_number, phone, arg, instance_id) for name and aliases."""
+    def register(handler):
+        spec = Command(normalize(name), handler, tuple(normalize(a) for a in aliases),
+                       needs_list, requires_arg, gated, admin_only, locks_list)
+        for key in (spec.name,) + spec.aliases:
+            if key in _registry:
+                raise ValueError(f"Command {key} registered twice")
+            _registry[key] = spec
+        return handler
+    return register
+
+
+def lookup(cmd: str) -> Command | None:
+    return _registry.get(cmd)
+
+
+# --- Instrumentation ---
+
+class _Run:
+    __slots__ = ("sends",)
+
+    def __init__(self):
+        self.sends = 0
+
+
+_run: contextvars.ContextVar = contextvars.ContextVar("listinha_command_run", default=None)
+_lock = threading.Lock()
+_metrics: dict[str, dict[str, Histogram]] = {}
+
+
+def note_send(n: int = 1) -> None:
+    """Count an outbound message for the command being handled (if any)."""
+    run = _run.get()
+    if run is not None:
+        run.sends += n
+
+
+@contextmanager
+def measure(name: str, ctx=None):
+    """Record wall time, Firestore reads/writes (from the request ctx) and sends for `name`."""
+    run = _Run()
+    token = _run.set(run)
+    reads0, writes0 = (ctx.reads, ctx.writes) if ctx is not None else (0, 0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_ms = (time.perf_counter() - started) * 1000
+        _run.reset(token)
+        with _lock:
+            m = _metrics.get(name)
+            if m is None:
+                m = _metrics[name] = {
+                    "wall_ms": Histogram(LATENCY_BUCKETS_MS),
+                    "reads": Histogram(COUNT_BUCKETS),
+                    "writes": Histogram(COUNT_BUCKETS),
+                    "sends": Histogram(COUNT_BUCKETS),
+                }
+            m["wall_ms"].observe(wall_ms)
+            if ctx is not None:
+                m["reads"].observe(ctx.reads - reads0)
+                m["writes"].observe(ctx.writes - writes0)
+            m["sends"].observe(run.sends)
+
+
+def stats() -> dict:
+    with _lock:
+        return {name: {k: h.as_dict() for k, h in m.items()}
+                for name, m in sorted(_metrics.items(), key=lambda kv: -kv[1]["wall_ms"].total)}
@@ -1,32 +1,340 @@
 import os
-import json
-import firebase_admin
-from firebase_admin import credentials, firestore
-from icu import Collator, Locale
-collator = Collator.createInstance(Locale("pt_BR"))
 import pytz
 from datetime import datetime
 import hashlib, secrets
+import unicodedata
+import copy
+import contextvars
+import time
+from contextlib import contextmanager
 from typing import Optional
+from cache import TTLCache
+from mirror import DocMirror
+import lazy
+import storage
+
+# Firestore sentinels/transforms; the SDK loads on first use
+firestore = lazy.LazyModule("firebase_admin.firestore")
+
+# Firestore, or a local engine for offline runs (see storage.py). Nothing is
+# connected until the first query.
+db = storage.LazyClient()
+
+_collator = None
+
+def sort_key(text: str) -> bytes:
+    """pt_BR ICU collation key; ICU is loaded on first use."""
+    global _collator
+    if _collator is None:
+        icu = lazy.load("icu")
+        _collator = icu.Collator.createInstance(icu.Locale("pt_BR"))
+    return _collator.getSortKey(text)
+
+# --- Request-scoped document memo ---
+# One inbound command touches users/{phone} from many helpers (gate, billing,
+# group lookup, snapshot...). Inside a request_context() every helper shares a
+# single copy of each document, so the user doc is read once per command.
+
+class RequestContext:
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.docs: dict[str, dict | None] = {}  # "users/+55..." -> data (None = missing)
+        self.reads = 0
+        self.writes = 0
+        self.started = time.perf_counter()
+
+    def elapsed_ms(self) -> int:
+        return int((time.perf_counter() - self.started) * 1000)
+
+    def summary(self) -> str:
+        return f"{self.label or '-'} reads={self.reads} writes={self.writes} {self.elapsed_ms()}ms"
+
+_request_ctx: contextvars.ContextVar = contextvars.ContextVar("listinha_request_ctx", default=None)
+
+@contextmanager
+def request_context(label: str = ""):
+    """Share document reads between all helpers called within this block."""
+    ctx = RequestContext(label)
+    token = _request_ctx.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _request_ctx.reset(token)
+
+def current_context() -> Optional[RequestContext]:
+    return _request_ctx.get()
+
+def _count_reads(n: int = 1) -> None:
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.reads += n
+
+def _count_writes(n: int = 1) -> None:
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.writes += n
+
+def _is_transform(value) -> bool:
+    """True for Firestore server-side values we can't mirror locally."""
+    if isinstance(value, (firestore.ArrayUnion, firestore.ArrayRemove, firestore.Increment)):
+        return True
+    return value is firestore.SERVER_TIMESTAMP
+
+def _has_transform(data) -> bool:
+    if isinstance(data, dict):
+        return any(_has_transform(v) for v in data.values())
+    return _is_transform(data)
+
+def _deep_merge(base: dict, patch: dict) -> dict:
+    out = dict(base)
+    for k, v in patch.items():
+        if v is firestore.DELETE_FIELD:
+            out.pop(k, None)
+        elif isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _deep_merge(out[k], v)
+        else:
+            out[k] = v
+    return out
+
+# --- Process-wide document cache ---
+# Hot users/listas/admins documents are served from memory for a short TTL.
+# Every write made through this module updates (or drops) the cached copy;
+# writes from other workers become visible once the entry expires, so keep
+# the TTL short when running several workers. Set DOC_CACHE_TTL=0 to disable.
+
+DOC_CACHE_TTL = float(os.getenv("DOC_CACHE_TTL", "30"))
+_doc_cache = {
+    "users": TTLCache("users", int(os.getenv("DOC_CACHE_MAX_USERS", "5000")), DOC_CACHE_TTL),
+    "listas": TTLCache("listas", int(os.getenv("DOC_CACHE_MAX_LISTS", "2000")), DOC_CACHE_TTL),
+    "admins": TTLCache("admins", 100, DOC_CACHE_TTL),
+    "view_snapshots": TTLCache("view_snapshots", int(os.getenv("DOC_CACHE_MAX_VIEWS", "5000")), DOC_CACHE_TTL),
+    "stripe_index": TTLCache("stripe_index", int(os.getenv("DOC_CACHE_MAX_STRIPE_INDEX", "5000")), DOC_CACHE_TTL),
+}
+
+# --- Live mirror of hot lists (optional) ---
+# With LIST_MIRROR=true every list a command touches gets a snapshot
+# listener, and reads are served from the listener's copy instead of the TTL
+# cache. Writes by any worker reach every mirror, so there's no stale window.
+# Our own writes hide the mirror copy until the listener confirms them.
+
+LIST_MIRROR = os.getenv("LIST_MIRROR", "false").lower() == "true"
+_doc_mirror = {}
+if LIST_MIRROR:
+    _doc_mirror["listas"] = DocMirror(
+        "listas",
+        lambda doc_id: db.collection("listas").document(doc_id),
+        maxsize=int(os.getenv("LIST_MIRROR_MAX", "200")),
+        idle_ttl=float(os.getenv("LIST_MIRROR_IDLE_SECONDS", "600")),
+    )
 
-
-# Parse JSON string from env
-firebase_creds = json.loads(os.getenv("FIREBASE_CREDENTIALS"))
-cred = credentials.Certificate(firebase_creds)
-
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+def cache_stats() -> dict:
+    return {name: c.stats() for name, c in _doc_cache.items()}
+
+def mirror_stats() -> dict:
+    return {name: m.stats() for name, m in _doc_mirror.items()}
+
+def _mirror_mark(collection: str, doc_id: str) -> int | None:
+    """Snapshot sequence of the mirrored doc before a write (see DocMirror.written)."""
+    mirror = _doc_mirror.get(collection)
+    return mirror.mark(doc_id) if mirror is not None else None
+
+def _mirror_written(collection: str, doc_id: str, since: int | None = None) -> None:
+    mirror = _doc_mirror.get(collection)
+    if mirror is not None:
+        mirror.written(doc_id, since)
+
+def invalidate_cached_doc(collection: str, doc_id: str, since: int | None = None) -> None:
+    cache = _doc_cache.get(collection)
+    if cache is not None:
+        cache.invalidate(doc_id)
+    _mirror_written(collection, doc_id, since)
+
+def _lookup_cached(collection: str, doc_id: str) -> tuple[bool, dict | None]:
+    """(found, data) from the request memo, then the live mirror, then the process cache."""
+    key = f"{collection}/{doc_id}"
+    ctx = _request_ctx.get()
+    if ctx is not None and key in ctx.docs:
+        return True, copy.deepcopy(ctx.docs[key])
+    mirror = _doc_mirror.get(collection)
+    if mirror is not None:
+        found, data = mirror.get(doc_id)
+        if found:
+            if ctx is not None:
+                ctx.docs[key] = copy.deepcopy(data)
+            return True, data
+        mirror.watch(doc_id)
+    cache = _doc_cache.get(collection)
+    if cache is not None:
+        found, data = cache.get(doc_id)
+        if found:
+            if ctx is not None:
+                ctx.docs[key] = copy.deepcopy(data)
+            return True, data
+    return False, None
+
+def _doc_loaded(collection: str, doc_id: str, snap) -> dict | None:
+    """Record a document snapshot just read from Firestore; returns its data."""
+    data = (snap.to_dict() or {}) if snap.exists else None
+    _count_reads()
+    _remember_doc(collection, doc_id, data)
+    return data
+
+def _get_doc(collection: str, doc_id: str, fresh: bool = False) -> dict | None:
+    """
+    Read collection/doc_id once per request; returns a private copy (or None).
+    fresh=True skips both caches (use it before read-modify-write).
+    """
+    if not fresh:
+        found, data = _lookup_cached(collection, doc_id)
+        if found:
+            return data
+    snap = db.collection(collection).document(doc_id).get()
+    return _doc_loaded(collection, doc_id, snap)
+
+def _get_docs(keys: list[tuple[str, str]], fresh: bool = False) -> list[dict | None]:
+    """
+    Read several (collection, doc_id) documents, in order. Whatever isn't in
+    the memo/cache is fetched together in one get_all round trip.
+    """
+    out = {}
+    missing = []
+    for key in keys:
+        if not fresh:
+            found, data = _lookup_cached(*key)
+            if found:
+                out[key] = data
+                continue
+        missing.append(key)
+    if missing:
+        refs = {db.collection(c).document(d).path: (c, d) for c, d in dict.fromkeys(missing)}
+        for snap in db.get_all([db.collection(c).document(d) for c, d in refs.values()]):
+            key = refs[snap.reference.path]
+            out[key] = _doc_loaded(*key, snap)
+    return [copy.deepcopy(out.get(key)) for key in keys]
+
+def _after_write(known: bool, current: dict | None, data: dict | None, merge: bool, update: bool):
+    """
+    Given what we knew about a document before a write, return (known, value)
+    afterwards. Writes we can't mirror locally (transforms, dotted paths,
+    merges into an unknown doc) come back as unknown.
+    """
+    if data is None:
+        return True, None
+    if _has_transform(data) or any("." in k for k in data):
+        return False, None
+    if not (merge or update):
+        return True, copy.deepcopy(data)
+    if not known or (update and current is None):
+        return False, None
+    if update:
+        out = dict(current or {})
+        for k, v in copy.deepcopy(data).items():
+            if v is firestore.DELETE_FIELD:
+                out.pop(k, None)
+            else:
+                out[k] = v
+        return True, out
+    return True, _deep_merge(current or {}, copy.deepcopy(data))
+
+def _doc_written(collection: str, doc_id: str, data: dict | None = None, merge: bool = False,
+                 update: bool = False, since: int | None = None) -> None:
+    """
+    Keep the request memo and the process cache in line with a write we just
+    made. data=None means the document was deleted; since is the
+    _mirror_mark() taken before the write.
+    """
+    _count_writes()
+    _mirror_written(collection, doc_id, since)
+    key = f"{collection}/{doc_id}"
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        known, value = _after_write(key in ctx.docs, ctx.docs.get(key), data, merge, update)
+        if known:
+            ctx.docs[key] = value
+        else:
+            ctx.docs.pop(key, None)
+
+    cache = _doc_cache.get(collection)
+    if cache is not None:
+        found, current = cache.peek(doc_id)
+        known, value = _after_write(found, current, data, merge, update)
+        if known:
+            cache.set(doc_id, value)
+        else:
+            cache.invalidate(doc_id)
+
+def _remember_doc(collection: str, doc_id: str, data: dict | None) -> None:
+    """Store a document value we know to be current (e.g. after a transaction)."""
+    key = f"{collection}/{doc_id}"
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.docs[key] = copy.deepcopy(data)
+    cache = _doc_cache.get(collection)
+    if cache is not None:
+        cache.set(doc_id, data)
+
+def _set_doc(collection: str, doc_id: str, data: dict, merge: bool = False) -> None:
+    since = _mirror_mark(collection, doc_id)
+    db.collection(collection).document(doc_id).set(data, merge=merge)
+    _doc_written(collection, doc_id, data, merge=merge, since=since)
+
+def _update_doc(collection: str, doc_id: str, data: dict) -> None:
+    since = _mirror_mark(collection, doc_id)
+    db.collection(collection).document(doc_id).update(data)
+    _doc_written(collection, doc_id, data, update=True, since=since)
+
+def _delete_doc(collection: str, doc_id: str) -> None:
+    since = _mirror_mark(collection, doc_id)
+    db.collection(collection).document(doc_id).delete()
+    _doc_written(collection, doc_id, None, since=since)
+
+def _commit_writes(writes: list[tuple]) -> None:
+    """
+    Apply several document writes atomically in one batch. Each write is
+    ("set", collection, doc_id, data), ("merge", collection, doc_id, data),
+    ("update", collection, doc_id, data) or ("delete", collection, doc_id).
+    """
+    marks = {(collection, doc_id): _mirror_mark(collection, doc_id) for _, collection, doc_id, *_ in writes}
+    batch = db.batch()
+    for op, collection, doc_id, *rest in writes:
+        ref = db.collection(collection).document(doc_id)
+        if op == "delete":
+            batch.delete(ref)
+        elif op == "update":
+            batch.update(ref, rest[0])
+        else:
+            batch.set(ref, rest[0], merge=(op == "merge"))
+    batch.commit()
+    for op, collection, doc_id, *rest in writes:
+        data = rest[0] if rest else None
+        _doc_written(collection, doc_id, data, merge=(op == "merge"), update=(op == "update"),
+                     since=marks[(collection, doc_id)])
+
+def normalize_text(s: str) -> str:
+    """
+    Lowercase, remove accents/diacritics, and collapse inner spaces.
+    Ex.: '  PÃO   de   Açúcar  ' -> 'pao de acucar'
+    """
+    if not s:
+        return ""
+    # NFD split + remove combining marks (accents)
+    s = unicodedata.normalize("NFD", s)
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    # lowercase + collapse whitespace
+    s = " ".join(s.lower().split())
+    return s
+
+def list_doc_id(group: dict) -> str:
+    return f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
 
 def get_user_group(phone):
-    ref = db.collection("users").document(phone)
-    doc = ref.get()
-    if doc.exists:
-        return doc.to_dict().get("group")
+    data = _get_doc("users", phone)
+    if data is not None:
+        return data.get("group")
     return {"owner": phone, "list": "default", "instance": "default"}
 
 def set_default_group_if_missing(phone, instance_id="default"):
-    ref = db.collection("users").document(phone)
-    if not ref.get().exists:  # <-- FIX: removed ()
+    if _get_doc("users", phone) is None:
         # Create user as admin of a new list
         group_data = {
             "owner": phone,
@@ -34,42 +342,228 @@ def set_default_group_if_missing(phone, instance_id="default"):
             "instance": instance_id,
             "role": "admin"
         }
-        ref.set({"group": group_data})
 
         # Create the list document
         doc_id = f"{instance_id}__{phone}__default"
-        list_data = {
-            "owner": phone,
-            "members": [phone],
-            "itens": []
-        }
-        db.collection("listas").document(doc_id).set(list_data)
+        list_data = _new_list_data(phone)
+        _commit_writes([
+            ("set", "users", phone, {"group": group_data}),
+            ("set", "listas", doc_id, list_data),
+        ])
 
         # Debug prints
         print(f"✅ Created new admin list: {doc_id}")
         print(f"📄 User doc: {group_data}")
         print(f"📄 List doc: {list_data}")
 
-def add_item(phone, item):
-    group = get_user_group(phone)
-    doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-    doc_ref = firestore.client().collection("listas").document(doc_id)
-    doc = doc_ref.get()
+# --- List storage ---
+# A list keeps its items either inline in the "itens" array (the original
+# layout) or, with storage="subcollection", one document per item under
+# listas/{doc_id}/itens/{key}. The key is derived from the item name, so
+# duplicates are detected with a single document read, and the list doc
+# carries an item_count. LIST_STORAGE picks the layout for new lists;
+# existing lists move over with `python maintenance.py migrate-items`.
+
+LIST_STORAGE = os.getenv("LIST_STORAGE", "array")  # "array" | "subcollection"
+ITEMS_PAGE_SIZE = int(os.getenv("ITEMS_PAGE_SIZE", "100"))
+
+def _new_list_data(owner: str, name: str = "") -> dict:
+    member_index = {owner: {"name": name[:20], "role": "admin"}}
+    if LIST_STORAGE == "subcollection":
+        return {"owner": owner, "members": [owner], "member_index": member_index, "member_index_ready": True,
+                "storage": "subcollection", "item_count": 0}
+    return {
+        "owner": owner,
+        "members": [owner],
+        "member_index": member_index,
+        "member_index_ready": True,
+        "itens": []
+    }
 
-    if not doc.exists:
-        return False
+def is_paged_list(data: dict | None) -> bool:
+    return (data or {}).get("storage") == "subcollection"
+
+def list_item_count(data: dict | None) -> int:
+    if is_paged_list(data):
+        return int((data or {}).get("item_count") or 0)
+    return len((data or {}).get("itens", []))
+
+def _item_key(name: str) -> str:
+    # Same equivalence as the array layout: names are compared stripped + lowercased
+    return hashlib.sha1(name.strip().lower().encode("utf-8")).hexdigest()[:24]
+
+def _item_doc(entry) -> dict:
+    """Subcollection document for an item entry (dict or legacy string)."""
+    if isinstance(entry, str):
+        entry = {"item": entry, "user": "", "timestamp": ""}
+    name = entry.get("item", "")
+    return {
+        **entry,
+        "norm": normalize_text(name),
+        "sort_key": sort_key(name),
+        "created_at": entry.get("created_at") or time.time(),
+    }
+
+def _public_entry(data: dict) -> dict:
+    return {k: data.get(k, "") for k in ("item", "user", "timestamp")}
+
+def _items_ref(doc_id: str):
+    return db.collection("listas").document(doc_id).collection("itens")
+
+def get_list_items_page(doc_id: str, limit: int = ITEMS_PAGE_SIZE, after=None,
+                        order: str = "sort_key") -> tuple[list[dict], object]:
+    """
+    One ordered page of a subcollection list: ([{item, user, timestamp}], cursor).
+    Pass the cursor back as `after` for the next page; it is None on the last one.
+    """
+    query = _items_ref(doc_id).order_by(order)
+    if after is not None:
+        query = query.start_after({order: after})
+    # One extra row tells whether a next page exists (no empty last page)
+    snaps = list(query.limit(limit + 1).stream())
+    _count_reads(max(1, len(snaps)))
+    page = snaps[:limit]
+    entries = [_public_entry(s.to_dict() or {}) for s in page]
+    cursor = (page[-1].to_dict() or {}).get(order) if len(snaps) > limit else None
+    return entries, cursor
+
+def iter_list_items(doc_id: str, order: str = "sort_key", page_size: int = ITEMS_PAGE_SIZE):
+    after = None
+    while True:
+        entries, after = get_list_items_page(doc_id, page_size, after, order)
+        yield from entries
+        if after is None:
+            return
+
+def get_list_entries(doc_id: str, data: dict, limit: int | None = None, after=None,
+                     order: str = "sort_key") -> tuple[list, object]:
+    """
+    Raw item entries of a list in either layout, plus the next-page cursor.
+    The array layout is already in memory, so it's returned whole (unsorted).
+    """
+    if not is_paged_list(data):
+        return data.get("itens", []), None
+    if limit:
+        return get_list_items_page(doc_id, limit, after, order)
+    return list(iter_list_items(doc_id, order)), None
+
+def get_item_at(doc_id: str, position: int) -> str | None:
+    """Name of the item at 1-based A→Z position in a subcollection list."""
+    snaps = list(_items_ref(doc_id).order_by("sort_key").offset(position - 1).limit(1).stream())
+    _count_reads()
+    return (snaps[0].to_dict() or {}).get("item") if snaps else None
+
+def get_items_at(doc_id: str, positions: list[int]) -> list[str | None]:
+    """Names at several 1-based A→Z positions of a subcollection list, with one ranged query."""
+    if not positions:
+        return []
+    first, last = min(positions), max(positions)
+    snaps = list(_items_ref(doc_id).order_by("sort_key").offset(first - 1).limit(last - first + 1).stream())
+    _count_reads(max(1, len(snaps)))
+    names = [(s.to_dict() or {}).get("item") for s in snaps]
+    return [names[p - first] if p - first < len(names) else None for p in positions]
+
+# --- Item mutations ---
+# Items are changed inside a Firestore transaction: the list is read for
+# duplicate/match detection and only the delta is written (ArrayUnion /
+# ArrayRemove, or a single item document), so write size doesn't grow with
+# the list. If another member touches the same list concurrently, Firestore
+# aborts and the transaction function is re-run (up to ITEM_TXN_MAX_ATTEMPTS)
+# on the fresh document.
+
+ITEM_TXN_MAX_ATTEMPTS = int(os.getenv("ITEM_TXN_MAX_ATTEMPTS", "5"))
+_DELETE_ITEM = object()
+
+def _run_list_txn(doc_id: str, mutate, item_name: str | None = None, mutate_doc=None,
+                  item_names: list[str] | None = None, mutate_docs=None):
+    """
+    Run a transactional change on listas/{doc_id}.
+    Array layout: mutate(items) -> (result, transform | None); transform is
+    written to "itens". Subcollection layout: mutate_doc(existing | None) ->
+    (result, change) for the item document named item_name, where change is
+    None, a new entry dict, or _DELETE_ITEM. For several items at once,
+    mutate_docs([existing | None, ...]) -> (result, [change, ...]) over
+    item_names (all read with one get_all).
+    Returns None if the list doesn't exist, else the mutate result.
+    """
+    ref = db.collection("listas").document(doc_id)
+    outcome = {}
+    if mutate_doc is not None:
+        item_names = [item_name]
+
+        def mutate_docs(existing):
+            result, change = mutate_doc(existing[0])
+            return result, [change]
+
+    @storage.transactional
+    def _txn(transaction):
+        outcome.clear()
+        snap = ref.get(transaction=transaction)
+        _count_reads()
+        if not snap.exists:
+            outcome["data"] = None
+            return None
+        data = snap.to_dict() or {}
+        outcome["data"] = data
+
+        if is_paged_list(data) and mutate_docs is not None:
+            item_refs = [ref.collection("itens").document(_item_key(name)) for name in item_names]
+            if len(item_refs) == 1:
+                snaps = {item_refs[0].id: item_refs[0].get(transaction=transaction)}
+            else:
+                snaps = {snap.id: snap for snap in transaction.get_all(item_refs)}
+            _count_reads(len(item_refs))
+            existing = [snaps[r.id].to_dict() if r.id in snaps and snaps[r.id].exists else None
+                        for r in item_refs]
+            result, changes = mutate_docs(existing)
+            delta = 0
+            for item_ref, change in zip(item_refs, changes):
+                if change is _DELETE_ITEM:
+                    transaction.delete(item_ref)
+                    delta -= 1
+                elif change is not None:
+                    transaction.set(item_ref, _item_doc(change))
+                    delta += 1
+            if delta:
+                transaction.update(ref, {"item_count": firestore.Increment(delta)})
+            outcome["count_delta"] = delta
+            outcome["docs_written"] = sum(1 for c in changes if c is not None)
+            return result
+
+        result, transform = mutate(data.get("itens", []))
+        if transform is not None:
+            transaction.update(ref, {"itens": transform})
+        outcome["transform"] = transform
+        return result
+
+    since = _mirror_mark("listas", doc_id)
+    result = _txn(db.transaction(max_attempts=ITEM_TXN_MAX_ATTEMPTS))
+
+    # Mirror the committed state locally (the change is deterministic here)
+    data = outcome.get("data")
+    transform = outcome.get("transform")
+    if data is not None and transform is not None:
+        _count_writes()
+        items = data.get("itens", [])
+        if isinstance(transform, firestore.ArrayUnion):
+            items = items + [v for v in transform.values if v not in items]
+        elif isinstance(transform, firestore.ArrayRemove):
+            items = [v for v in items if v not in transform.values]
+        data["itens"] = items
+    if data is not None and outcome.get("count_delta"):
+        _count_writes(outcome["docs_written"] + 1)
+        data["item_count"] = int(data.get("item_count") or 0) + outcome["count_delta"]
+    _mirror_written("listas", doc_id, since)
+    _remember_doc("listas", doc_id, data)
+    return result
 
-    data = doc.to_dict()
-    existing_items = data.get("itens", [])
+def add_item(phone, item):
+    group = get_user_group(phone)
+    doc_id = list_doc_id(group)
 
     # Normalize and capitalize item name
     item = item.strip().capitalize()
 
-    # Prevent duplicates (only compare the "item" field)
-    for entry in existing_items:
-        if isinstance(entry, dict) and entry.get("item") == item:
-            return False
-
     # Format timestamp for Brazil
     sao_paulo = pytz.timezone("America/Sao_Paulo")
     now = datetime.now(sao_paulo).strftime("%d/%m/%y %H:%M")
@@ -80,18 +574,79 @@ def add_item(phone, item):
         "user": phone,
         "timestamp": now
     }
-    existing_items.append(new_entry)
 
-    # Save updated list
-    doc_ref.update({"itens": existing_items})
-    return True
+    def _mutate(existing_items):
+        # Prevent duplicates (only compare the "item" field)
+        for entry in existing_items:
+            if isinstance(entry, dict) and entry.get("item") == item:
+                return False, None
+        return True, firestore.ArrayUnion([new_entry])
 
-def get_items(phone):
+    def _mutate_doc(existing):
+        if existing is not None:
+            return False, None
+        return True, new_entry
+
+    return bool(_run_list_txn(doc_id, _mutate, item_name=item, mutate_doc=_mutate_doc))
+
+# Items per transaction in add_items (Firestore allows 500 writes per commit)
+_BULK_CHUNK = 400
+
+def add_items(phone, items: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Add several items at once: one list read and one write per chunk of
+    _BULK_CHUNK, instead of a transaction per item.
+    Returns (added, already_present) names, in the order given.
+    """
     group = get_user_group(phone)
-    doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-    ref = db.collection("listas").document(doc_id)
-    doc = ref.get()
-    items = doc.to_dict()["itens"] if doc.exists else []
+    doc_id = list_doc_id(group)
+
+    names = []
+    for raw in items:
+        name = raw.strip().capitalize()
+        if name and name not in names:
+            names.append(name)
+
+    sao_paulo = pytz.timezone("America/Sao_Paulo")
+    now = datetime.now(sao_paulo).strftime("%d/%m/%y %H:%M")
+    entries = [{"item": name, "user": phone, "timestamp": now} for name in names]
+
+    def _add_chunk(chunk):
+        def _mutate(existing_items):
+            present = {e.get("item") for e in existing_items if isinstance(e, dict)}
+            new = [e for e in chunk if e["item"] not in present]
+            return [e["item"] for e in new], (firestore.ArrayUnion(new) if new else None)
+
+        def _mutate_docs(existing):
+            changes = [e if found is None else None for e, found in zip(chunk, existing)]
+            return [c["item"] for c in changes if c is not None], changes
+
+        return _run_list_txn(doc_id, _mutate, item_names=[e["item"] for e in chunk], mutate_docs=_mutate_docs)
+
+    added = []
+    for start in range(0, len(entries), _BULK_CHUNK):
+        result = _add_chunk(entries[start:start + _BULK_CHUNK])
+        if result is None:
+            break
+        added.extend(result)
+    return added, [name for name in names if name not in added]
+
+def get_items(phone, limit: int | None = None):
+    """Item names A→Z. limit caps the result (one page read for subcollection lists)."""
+    group = get_user_group(phone)
+    doc_id = list_doc_id(group)
+    data = _get_doc("listas", doc_id)
+    if data is None:
+        return []
+
+    if is_paged_list(data):
+        if limit:
+            entries, _ = get_list_items_page(doc_id, limit)
+        else:
+            entries = list(iter_list_items(doc_id))
+        return [e["item"] for e in entries]
+
+    items = data.get("itens", [])
 
     # Handle both old (strings) and new (dict) formats
     names_only = [
@@ -99,83 +654,191 @@ def get_items(phone):
         for i in items
     ]
 
-    return sorted(names_only, key=collator.getSortKey)
+    names_only = sorted(names_only, key=sort_key)
+    return names_only[:limit] if limit else names_only
+
+def find_item(phone, wanted: str) -> str | None:
+    """Stored name of the item matching `wanted` accent/case-insensitively, or None."""
+    group = get_user_group(phone)
+    doc_id = list_doc_id(group)
+    data = _get_doc("listas", doc_id)
+    if data is None:
+        return None
+
+    target = normalize_text(wanted)
+    if is_paged_list(data):
+        snaps = list(_items_ref(doc_id).where("norm", "==", target).limit(1).stream())
+        _count_reads()
+        return (snaps[0].to_dict() or {}).get("item") if snaps else None
+
+    for txt in get_items(phone):
+        if normalize_text(txt) == target:
+            return txt
+    return None
+
+def find_items(phone, wanted: list[str]) -> list[str | None]:
+    """find_item for several names at once (one scan, or "in" queries for subcollection lists)."""
+    group = get_user_group(phone)
+    doc_id = list_doc_id(group)
+    data = _get_doc("listas", doc_id)
+    if data is None:
+        return [None] * len(wanted)
+
+    targets = [normalize_text(w) for w in wanted]
+    found = {}
+    if is_paged_list(data):
+        unique = list(dict.fromkeys(targets))
+        for start in range(0, len(unique), 30):  # Firestore "in" takes up to 30 values
+            snaps = list(_items_ref(doc_id).where("norm", "in", unique[start:start + 30]).stream())
+            _count_reads(max(1, len(snaps)))
+            for snap in snaps:
+                entry = snap.to_dict() or {}
+                found.setdefault(entry.get("norm"), entry.get("item"))
+    else:
+        for txt in get_items(phone):
+            found.setdefault(normalize_text(txt), txt)
+    return [found.get(t) for t in targets]
+
+def get_list_doc(doc_id: str) -> dict | None:
+    """Return the raw listas/{doc_id} document, or None."""
+    return _get_doc("listas", doc_id)
+
+def set_list_title(phone: str, title: str) -> None:
+    group = get_user_group(phone)
+    _update_doc("listas", list_doc_id(group), {"title": title})
 
 def clear_items(phone):
     group = get_user_group(phone)
-    doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-    db.collection("listas").document(doc_id).set({"itens": []}, merge=True)
+    doc_id = list_doc_id(group)
+    data = _get_doc("listas", doc_id)
+    if not is_paged_list(data):
+        _set_doc("listas", doc_id, {"itens": []}, merge=True)
+        return
+
+    # Delete item docs page by page; each batch also adjusts item_count so the
+    # counter stays right even if someone adds an item meanwhile.
+    list_ref = db.collection("listas").document(doc_id)
+    since = _mirror_mark("listas", doc_id)
+    while True:
+        snaps = list(_items_ref(doc_id).limit(400).stream())
+        _count_reads(max(1, len(snaps)))
+        if not snaps:
+            break
+        batch = db.batch()
+        for snap in snaps:
+            batch.delete(snap.reference)
+        batch.update(list_ref, {"item_count": firestore.Increment(-len(snaps))})
+        batch.commit()
+        _count_writes(len(snaps) + 1)
+    invalidate_cached_doc("listas", doc_id, since)
+    ctx = _request_ctx.get()
+    if ctx is not None:
+        ctx.docs.pop(f"listas/{doc_id}", None)
 
 def delete_item(phone, item):
     group = get_user_group(phone)
     doc_id = f"{group['instance']}__{group['owner']}__{group['list']}"
-    ref = firestore.client().collection("listas").document(doc_id)
 
-    doc = ref.get()
-    if not doc.exists:
-        return False
+    def _mutate(items):
+        # Updated: match item name regardless of structure; remove just those entries
+        matches = [
+            entry for entry in items
+            if (isinstance(entry, dict) and entry.get("item", "").strip().lower() == item.strip().lower()) or
+               (isinstance(entry, str) and entry.strip().lower() == item.strip().lower())
+        ]
+        return True, (firestore.ArrayRemove(matches) if matches else None)
 
-    data = doc.to_dict()
-    items = data.get("itens", [])
+    def _mutate_doc(existing):
+        return True, (_DELETE_ITEM if existing is not None else None)
 
-    # Updated: filter out matching item name, regardless of structure
-    updated_items = [
-        entry for entry in items
-        if not (
-            (isinstance(entry, dict) and entry.get("item", "").strip().lower() == item.strip().lower()) or
-            (isinstance(entry, str) and entry.strip().lower() == item.strip().lower())
-        )
-    ]
+    return _run_list_txn(doc_id, _mutate, item_name=item, mutate_doc=_mutate_doc) is not None
 
-    ref.update({"itens": updated_items})
-    return True
+def delete_items(phone, items: list[str]) -> list[str]:
+    """Remove several items in one transaction per _BULK_CHUNK; returns the names removed."""
+    group = get_user_group(phone)
+    doc_id = list_doc_id(group)
+
+    names, seen = [], set()
+    for item in items:
+        key = (item or "").strip().lower()
+        if key and key not in seen:
+            seen.add(key)
+            names.append(item)
+
+    def _delete_chunk(chunk):
+        def _mutate(existing_items):
+            removed, matches = [], []
+            for name in chunk:
+                key = name.strip().lower()
+                hits = [
+                    entry for entry in existing_items
+                    if (isinstance(entry, dict) and entry.get("item", "").strip().lower() == key) or
+                       (isinstance(entry, str) and entry.strip().lower() == key)
+                ]
+                if hits:
+                    removed.append(name)
+                    matches.extend(hits)
+            return removed, (firestore.ArrayRemove(matches) if matches else None)
+
+        def _mutate_docs(existing):
+            changes = [_DELETE_ITEM if found is not None else None for found in existing]
+            return [name for name, c in zip(chunk, changes) if c is not None], changes
+
+        return _run_list_txn(doc_id, _mutate, item_names=chunk, mutate_docs=_mutate_docs)
+
+    removed = []
+    for start in range(0, len(names), _BULK_CHUNK):
+        result = _delete_chunk(names[start:start + _BULK_CHUNK])
+        if result is None:
+            break
+        removed.extend(result)
+    return removed
 
 def user_in_list(phone):
-    ref = db.collection("users").document(phone)
-    doc = ref.get()
-    return doc.exists  # True if user is already in a list
-
-def create_new_list(phone, instance_id="default", name=""):
+    return _get_doc("users", phone) is not None  # True if user is already in a list
 
+def create_new_list(phone, instance_id="default", name="", billing: dict | None = None):
+    """
+    Create the user's default list with them as admin. billing (e.g. the
+    trial fields) is merged into the user doc in the same batch.
+    """
     group_data = {
         "owner": phone,
         "list": "default",
         "instance": instance_id,
         "role": "admin"
     }
-    db.collection("users").document(phone).set({
+    doc_id = f"{instance_id}__{phone}__default"
+    list_data = _new_list_data(phone, name)
+    user_data = {
         "group": group_data,
         "name": name[:20]  # garante no Firestore também
-    })
-
-    doc_id = f"{instance_id}__{phone}__default"
-    list_data = {
-        "owner": phone,
-        "members": [phone],
-        "itens": []
     }
-    db.collection("listas").document(doc_id).set(list_data)
+    if billing:
+        user_data["billing"] = {k: v for k, v in billing.items() if not k.startswith("_")}
+    # merge keeps anything already stored for this phone (e.g. Stripe ids)
+    _commit_writes([
+        ("merge", "users", phone, user_data),
+        ("set", "listas", doc_id, list_data),
+    ] + _stripe_index_writes(phone, user_data.get("billing") or {}))
 
     print(f"✅ New list created for {phone} in {instance_id}")
     return doc_id
 
 def is_admin(phone):
-    ref = db.collection("users").document(phone)
-    doc = ref.get()
-    if not doc.exists:
+    data = _get_doc("users", phone)
+    if data is None:
         return False
-    group = doc.to_dict().get("group", {})
+    group = data.get("group", {})
     return group.get("role") == "admin"
 
 def add_user_to_list(admin_phone, target_phone, name=""):
-    from firebase_admin import firestore
-
-    users_ref = firestore.client().collection("users")
-    admin_doc = users_ref.document(admin_phone).get()
-    if not admin_doc.exists:
+    # Fresh reads: these guards decide which users doc gets overwritten/deleted
+    admin_data, target_data = _get_docs([("users", admin_phone), ("users", target_phone)], fresh=True)
+    if admin_data is None:
         return False, "admin_not_found"
 
-    group_info = admin_doc.to_dict().get("group")
+    group_info = admin_data.get("group")
     if not group_info:
         return False, "group_not_found"
 
@@ -187,32 +850,39 @@ def add_user_to_list(admin_phone, target_phone, name=""):
         "role": "user"  # 👈 force "user" role
     }
 
-    user_ref = users_ref.document(target_phone)
-    if user_ref.get().exists:
-        existing_group = user_ref.get().to_dict().get("group", {})
+    writes = []
+    if target_data is not None:
+        existing_group = target_data.get("group", {})
         if (
             existing_group.get("instance") == new_group_info["instance"]
             and existing_group.get("list") == new_group_info["list"]
             and existing_group.get("owner") == new_group_info["owner"]
         ):
             return False, "already_in_list"
-
-    user_ref.set({
-        "group": new_group_info,
-        "name": name[:20]
-    })
+        if existing_group.get("owner"):
+            # Moving from another list: drop the stale entry there
+            writes.append(_member_index_write(list_doc_id(existing_group), target_phone, None))
+
+    writes += [
+        ("set", "users", target_phone, {
+            "group": new_group_info,
+            "name": name[:20]
+        }),
+        _member_index_write(list_doc_id(new_group_info), target_phone, {"name": name[:20], "role": "user"}),
+    ]
+    _commit_writes(writes)
     return True, "added"
 
 def remove_user_from_list(admin_phone, target_phone):
-    admin_ref = db.collection("users").document(admin_phone)
-    if not admin_ref.get().exists:
+    # Fresh reads: these guards decide which users doc gets overwritten/deleted
+    admin_data, target_data = _get_docs([("users", admin_phone), ("users", target_phone)], fresh=True)
+    if admin_data is None:
         return False
-    admin_group = admin_ref.get().to_dict()["group"]
+    admin_group = admin_data["group"]
 
-    target_ref = db.collection("users").document(target_phone)
-    if not target_ref.get().exists:
+    if target_data is None:
         return False
-    target_group = target_ref.get().to_dict()["group"]
+    target_group = target_data["group"]
 
     # Check same list via users data
     if (target_group["owner"] != admin_group["owner"] or
@@ -220,53 +890,49 @@ def remove_user_from_list(admin_phone, target_phone):
         target_group["instance"] != admin_group["instance"]):
         return False
 
-    # Remove from members array (optional for display)
+    # Remove from members array + member index, and delete the target user document
     doc_id = f"{admin_group['instance']}__{admin_group['owner']}__{admin_group['list']}"
-    list_ref = db.collection("listas").document(doc_id)
-    list_data = list_ref.get().to_dict()
-    members = list_data.get("members", [])
-    if target_phone in members:
-        members = [m for m in members if m != target_phone]
-        list_ref.update({"members": members})
-
-    # Delete target user document
-    db.collection("users").document(target_phone).delete()
+    _commit_writes([
+        ("merge", "listas", doc_id, {
+            "members": firestore.ArrayRemove([target_phone]),
+            "member_index": {target_phone: firestore.DELETE_FIELD},
+        }),
+        ("delete", "users", target_phone),
+    ])
     return True
 
 def remove_self_from_list(user_phone):
-    user_ref = db.collection("users").document(user_phone)
-    if not user_ref.get().exists:
+    user_data = _get_doc("users", user_phone, fresh=True)
+    if user_data is None:
         return False
 
-    user_group = user_ref.get().to_dict()["group"]
+    user_group = user_data["group"]
 
     # Admins cannot self-remove
     if user_group["role"] == "admin":
         return False
 
-    # Remove from members array (optional for display)
+    # Remove from members array + member index, and delete the user document
     doc_id = f"{user_group['instance']}__{user_group['owner']}__{user_group['list']}"
-    list_ref = db.collection("listas").document(doc_id)
-    list_data = list_ref.get().to_dict()
-    members = list_data.get("members", [])
-    if user_phone in members:
-        members = [m for m in members if m != user_phone]
-        list_ref.update({"members": members})
-
-    # Delete the user document
-    db.collection("users").document(user_phone).delete()
+    _commit_writes([
+        ("merge", "listas", doc_id, {
+            "members": firestore.ArrayRemove([user_phone]),
+            "member_index": {user_phone: firestore.DELETE_FIELD},
+        }),
+        ("delete", "users", user_phone),
+    ])
     return True
 
 def propose_admin_transfer(admin_phone, target_phone):
-    admin_ref = db.collection("users").document(admin_phone)
-    if not admin_ref.get().exists:
+    # Fresh reads: these guards decide which users doc gets overwritten/deleted
+    admin_data, target_data = _get_docs([("users", admin_phone), ("users", target_phone)], fresh=True)
+    if admin_data is None:
         return False
-    admin_group = admin_ref.get().to_dict()["group"]
+    admin_group = admin_data["group"]
 
-    target_ref = db.collection("users").document(target_phone)
-    if not target_ref.get().exists:
+    if target_data is None:
         return False
-    target_group = target_ref.get().to_dict()["group"]
+    target_group = target_data["group"]
 
     # Check same list via users data
     if (target_group["owner"] != admin_group["owner"] or
@@ -275,7 +941,7 @@ def propose_admin_transfer(admin_phone, target_phone):
         return False
 
     # Store pending transfer
-    target_ref.update({
+    _update_doc("users", target_phone, {
         "pending_admin_transfer": {
             "from": admin_phone,
             "doc_id": f"{admin_group['instance']}__{admin_group['owner']}__{admin_group['list']}"
@@ -284,46 +950,271 @@ def propose_admin_transfer(admin_phone, target_phone):
     return True
 
 def accept_admin_transfer(user_phone):
-    user_ref = db.collection("users").document(user_phone)
-    user_data = user_ref.get().to_dict()
-
-    pending = user_data.get("pending_admin_transfer")
+    """
+    Swap roles between the pending transfer's sender and user_phone. Both
+    user docs are read together inside one transaction and every write
+    (roles, pending flag, member index) commits atomically, so a failure
+    can't leave the list with two admins.
+    """
+    pending = (_get_doc("users", user_phone) or {}).get("pending_admin_transfer")
+    if not pending:
+        # A cached copy may predate the proposal
+        pending = (_get_doc("users", user_phone, fresh=True) or {}).get("pending_admin_transfer")
     if not pending:
         return False
 
     from_phone = pending["from"]
     doc_id = pending["doc_id"]
-
-    # Update target to admin
-    user_group = user_data["group"]
-    user_group["role"] = "admin"
-    db.collection("users").document(user_phone).set({"group": user_group}, merge=True)
-
-    # Update old admin to user
+    user_ref = db.collection("users").document(user_phone)
     from_ref = db.collection("users").document(from_phone)
-    from_group = from_ref.get().to_dict()["group"]
-    from_group["role"] = "user"
-    db.collection("users").document(from_phone).set({"group": from_group}, merge=True)
+    list_ref = db.collection("listas").document(doc_id)
+    outcome = {}
+
+    @storage.transactional
+    def _txn(transaction):
+        outcome.clear()
+        snaps = {snap.id: snap for snap in transaction.get_all([user_ref, from_ref])}
+        _count_reads(2)
+        user_snap, from_snap = snaps.get(user_phone), snaps.get(from_phone)
+        user_data = user_snap.to_dict() if user_snap is not None and user_snap.exists else None
+        from_data = from_snap.to_dict() if from_snap is not None and from_snap.exists else None
+        # The memo may be stale: re-check the pending transfer inside the txn
+        if not user_data or user_data.get("pending_admin_transfer") != pending or not from_data:
+            return False
+
+        user_group = dict(user_data["group"], role="admin")
+        from_group = dict(from_data["group"], role="user")
+        transaction.update(user_ref, {
+            "group": user_group,
+            "pending_admin_transfer": firestore.DELETE_FIELD,
+        })
+        transaction.update(from_ref, {"group": from_group})
+        # Keep the list's member index roles in sync
+        transaction.set(list_ref, {"member_index": {
+            user_phone: {"role": "admin"},
+            from_phone: {"role": "user"},
+        }}, merge=True)
+        outcome["user"] = {"group": user_group, "pending_admin_transfer": firestore.DELETE_FIELD}
+        outcome["from"] = {"group": from_group}
+        return True
+
+    since = _mirror_mark("listas", doc_id)
+    if not _txn(db.transaction(max_attempts=ITEM_TXN_MAX_ATTEMPTS)):
+        invalidate_cached_doc("users", user_phone)
+        return False
 
-    # Remove pending transfer
-    db.collection("users").document(user_phone).update({"pending_admin_transfer": firestore.DELETE_FIELD})
+    _doc_written("users", user_phone, outcome["user"], update=True)
+    _doc_written("users", from_phone, outcome["from"], update=True)
+    _doc_written("listas", doc_id, {"member_index": {
+        user_phone: {"role": "admin"},
+        from_phone: {"role": "user"},
+    }}, merge=True, since=since)
 
     return {"from": from_phone}
 
+# --- Member index ---
+# listas/{doc_id}.member_index = {phone: {name, role}} mirrors the users that
+# point at the list, so "who is in this list" is one document read instead
+# of a 3-field query over users. Every membership change writes it in the
+# same batch as the user document; rebuild_member_index() repairs it. Lists
+# created before the index existed only get partial entries from those
+# writes, so member_index_ready marks an index that is complete.
+
+def _member_index_write(doc_id: str, phone: str, entry: dict | None) -> tuple:
+    """Batch write that sets (or with entry=None removes) one member entry."""
+    return ("merge", "listas", doc_id, {
+        "member_index": {phone: entry if entry is not None else firestore.DELETE_FIELD}
+    })
+
+def _query_list_members(doc_id: str) -> dict:
+    instance_id, owner, list_name = doc_id.split("__")
+    snaps = (
+        db.collection("users")
+        .where("group.owner", "==", owner)
+        .where("group.list", "==", list_name)
+        .where("group.instance", "==", instance_id)
+        .stream()
+    )
+    members = {}
+    for snap in snaps:
+        _count_reads()
+        data = snap.to_dict() or {}
+        members[snap.id] = {
+            "name": (data.get("name") or "").strip(),
+            "role": (data.get("group") or {}).get("role", "user"),
+        }
+    return members
+
+def rebuild_member_index(doc_id: str) -> dict:
+    """Recompute listas/{doc_id}.member_index from the users collection."""
+    members = _query_list_members(doc_id)
+    _update_doc("listas", doc_id, {"member_index": members, "member_index_ready": True})
+    return members
+
+def get_list_members(doc_id: str) -> dict:
+    """{phone: {name, role}} for a list; builds the index on first use."""
+    data = _get_doc("listas", doc_id)
+    if data is None:
+        return {}
+    if not data.get("member_index_ready"):
+        return rebuild_member_index(doc_id)
+    return data.get("member_index") or {}
+
+# --- Per-user view snapshot (numbered deletes) ---
+# Kept in view_snapshots/{phone}, not on the user doc: it's rewritten on every
+# /v and can hold hundreds of items, which every user-doc read would pay for.
+
+def save_view_snapshot(phone: str, doc_id: str, items: list[str] | None, count: int | None = None) -> None:
+    """
+    Persist the user's last alphabetized view as a 1..N → text mapping.
+    For large subcollection lists pass items=None and the count: numbers are
+    then resolved against the live A→Z order (see get_item_at).
+    """
+    _set_doc("view_snapshots", phone, {
+        "doc_id": doc_id,
+        "items": items or [],
+        "paged": items is None,
+        "count": len(items) if items is not None else int(count or 0),
+        "ts_epoch": int(time.time()),
+    })
+
+def load_view_snapshot(phone: str):
+    snap = _get_doc("view_snapshots", phone)
+    if snap is not None:
+        return snap
+    # Users not yet moved by `maintenance.py slim-users`
+    data = _get_doc("users", phone)
+    if data is None:
+        return None
+    return data.get("last_view_snapshot") or {}
+
+def load_media_entry(key: str) -> dict | None:
+    """Uploaded WhatsApp media ({media_id, sha1, expires_at}) for media.py."""
+    return _get_doc("media_cache", key)
+
+def save_media_entry(key: str, entry: dict | None) -> None:
+    if entry is None:
+        _delete_doc("media_cache", key)
+    else:
+        _set_doc("media_cache", key, entry)
+
+def claim_inbound_message(message_id: str, ttl_seconds: float, lease_seconds: float) -> bool:
+    """
+    True when this worker may handle a WhatsApp message id (any worker),
+    False for a redelivery. create() is atomic; taking over a claim whose
+    window expired (done and older than ttl, or processing and older than
+    the lease: its worker died) runs in a transaction so only one worker
+    wins. expires_at can back a Firestore TTL policy.
+    """
+    from google.api_core.exceptions import AlreadyExists
+    ref = db.collection("inbound_messages").document(message_id)
+    now = time.time()
+    doc = {"state": "processing", "ts": now, "expires_at": datetime.fromtimestamp(now + ttl_seconds, pytz.utc)}
+    try:
+        ref.create(doc)
+        _count_writes()
+        return True
+    except AlreadyExists:
+        pass
+
+    @storage.transactional
+    def _take_over(transaction):
+        snap = ref.get(transaction=transaction)
+        _count_reads()
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        window = lease_seconds if data.get("state") == "processing" else ttl_seconds
+        if data and data.get("ts", 0) + window > now:
+            return False
+        transaction.set(ref, doc)
+        _count_writes()
+        return True
+
+    return _take_over(db.transaction(max_attempts=ITEM_TXN_MAX_ATTEMPTS))
+
+def finish_inbound_message(message_id: str, ok: bool, ttl_seconds: float) -> None:
+    """Mark a claimed message done (redeliveries skipped for ttl), or drop the claim."""
+    ref = db.collection("inbound_messages").document(message_id)
+    if ok:
+        now = time.time()
+        ref.set({"state": "done", "ts": now, "expires_at": datetime.fromtimestamp(now + ttl_seconds, pytz.utc)})
+    else:
+        ref.delete()
+    _count_writes()
+
+def iter_lists():
+    """Yield (doc_id, data) for every list document (maintenance jobs only)."""
+    for snap in db.collection("listas").stream():
+        yield snap.id, (snap.to_dict() or {})
+
+def migrate_list_to_subcollection(doc_id: str, batch_size: int = 400) -> int:
+    """
+    Move listas/{doc_id}.itens into the itens subcollection. Items are copied
+    in batches first (idempotent: keys are derived from names), then a
+    transaction copies anything added meanwhile, deletes copies of items
+    removed meanwhile, sets storage/item_count from the fresh array and
+    drops the array. Returns the number of items in the migrated list.
+    """
+    ref = db.collection("listas").document(doc_id)
+    snap = ref.get()
+    if not snap.exists:
+        return 0
+    data = snap.to_dict() or {}
+    if is_paged_list(data):
+        return list_item_count(data)
+
+    since = _mirror_mark("listas", doc_id)
+    copied = set()
+    items = data.get("itens", [])
+    for start in range(0, len(items), batch_size):
+        batch = db.batch()
+        for entry in items[start:start + batch_size]:
+            doc = _item_doc(entry)
+            key = _item_key(doc["item"])
+            if key in copied:
+                continue
+            batch.set(ref.collection("itens").document(key), doc)
+            copied.add(key)
+        batch.commit()
+
+    @storage.transactional
+    def _finish(transaction):
+        fresh = ref.get(transaction=transaction).to_dict() or {}
+        if is_paged_list(fresh):
+            return list_item_count(fresh)  # another run finished first
+        keys = set()
+        for entry in fresh.get("itens", []):
+            doc = _item_doc(entry)
+            key = _item_key(doc["item"])
+            if key not in copied and key not in keys:
+                transaction.set(ref.collection("itens").document(key), doc)
+            keys.add(key)
+        # Items deleted from the array while the batches ran must not come back
+        for key in copied - keys:
+            transaction.delete(ref.collection("itens").document(key))
+        transaction.update(ref, {
+            "storage": "subcollection",
+            "item_count": len(keys),
+            "itens": firestore.DELETE_FIELD,
+        })
+        return len(keys)
+
+    total = _finish(db.transaction(max_attempts=ITEM_TXN_MAX_ATTEMPTS))
+    invalidate_cached_doc("listas", doc_id, since)
+    print(f"✅ Migrated {doc_id}: {total} items → subcollection")
+    return total
+
 # --- System Admin (platform) helpers ---
 
 def get_user_doc(phone: str) -> dict | None:
     """Return the raw user document for a phone (E.164), or None."""
-    doc = db.collection("users").document(phone).get()
-    return doc.to_dict() if doc.exists else None
+    return _get_doc("users", phone)
 
 def _hash_password(password: str, salt: str) -> str:
     return hashlib.sha256((salt + ":" + password).encode("utf-8")).hexdigest()
 
 def admin_get(username: str) -> Optional[dict]:
     """admins/{username}: {active: bool, salt: str, password_hash: str, ...}"""
-    doc = db.collection("admins").document(username).get()
-    return doc.to_dict() if doc.exists else None
+    return _get_doc("admins", username)
 
 def admin_verify_password(username: str, password: str) -> bool:
     data = admin_get(username)
@@ -340,7 +1231,9 @@ def admin_set_password(username: str, password: str, active: bool = True) -> Non
     """Seed/update a system admin account."""
     salt = secrets.token_hex(16)
     pwd_hash = _hash_password(password, salt)
-    db.collection("admins").document(username).set(
+    _set_doc(
+        "admins",
+        username,
         {
             "active": active,
             "salt": salt,
@@ -353,20 +1246,38 @@ def admin_set_password(username: str, password: str, active: bool = True) -> Non
 # --- Billing accessors (all Firestore writes live here) ---
 
 def get_user_billing(phone: str):
-    user_ref = db.collection("users").document(phone)
-    doc = user_ref.get()
-    if not doc.exists:
+    data = _get_doc("users", phone)
+    if data is None:
         return None
-    data = doc.to_dict() or {}
     return data.get("billing") or None
 
+# --- Stripe id -> phone index ---
+# stripe_index/{customer or subscription id} = {phone, kind}. Written in the
+# same batch as the billing fields, so a webhook without metadata resolves
+# its user with one key read. backfill_stripe_index() covers older users.
+
+STRIPE_ID_FIELDS = {"stripe_customer_id": "customer", "subscription_id": "subscription"}
+# Fall back to the users queries on an index miss (until the backfill ran)
+STRIPE_INDEX_FALLBACK = os.getenv("STRIPE_INDEX_FALLBACK", "true").lower() == "true"
+
+def _stripe_index_writes(phone: str, billing: dict) -> list[tuple]:
+    writes = []
+    for field, kind in STRIPE_ID_FIELDS.items():
+        value = billing.get(field)
+        if isinstance(value, str) and value:
+            writes.append(("set", "stripe_index", value, {"phone": phone, "kind": kind}))
+    return writes
+
+def _billing_writes(phone: str, billing: dict) -> list[tuple]:
+    return [("merge", "users", phone, {"billing": billing})] + _stripe_index_writes(phone, billing)
+
 def set_user_billing(phone: str, data: dict) -> None:
-    db.collection("users").document(phone).set({"billing": data}, merge=True)
+    _commit_writes(_billing_writes(phone, data))
 
 def update_user_billing(phone: str, patch: dict) -> None:
     # Avoid leaking helper fields
     patch = {k: v for k, v in patch.items() if not k.startswith("_")}
-    db.collection("users").document(phone).set({"billing": patch}, merge=True)
+    _commit_writes(_billing_writes(phone, patch))
 
 def set_stripe_ids(phone: str, customer_id: str, sub_id: str | None = None) -> None:
     patch = {"stripe_customer_id": customer_id}
@@ -374,27 +1285,114 @@ def set_stripe_ids(phone: str, customer_id: str, sub_id: str | None = None) -> N
         patch["subscription_id"] = sub_id
     update_user_billing(phone, patch)
 
+def _query_phone_by_billing_field(field: str, value: str) -> str | None:
+    docs = db.collection("users").where(f"billing.{field}", "==", value).limit(1).stream()
+    for d in docs:
+        _count_reads()
+        return d.id  # document id is the phone
+    return None
+
 def find_phone_by_customer_or_subscription(customer_id: str | None, subscription_id: str | None) -> str | None:
-    # Try customer first
-    if customer_id:
-        docs = db.collection("users").where("billing.stripe_customer_id", "==", customer_id).stream()
-        for d in docs:
-            return d.id  # document id is the phone
-    # Then subscription
-    if subscription_id:
-        docs = db.collection("users").where("billing.subscription_id", "==", subscription_id).stream()
-        for d in docs:
-            return d.id
+    """Resolve a Stripe customer/subscription to a phone; the customer id wins."""
+    ids = [(field, value) for field, value in
+           (("stripe_customer_id", customer_id), ("subscription_id", subscription_id)) if value]
+    if not ids:
+        return None
+    for entry in _get_docs([("stripe_index", value) for _, value in ids]):
+        if entry and entry.get("phone"):
+            return entry["phone"]
+    if not STRIPE_INDEX_FALLBACK:
+        return None
+    for field, value in ids:
+        phone = _query_phone_by_billing_field(field, value)
+        if phone:
+            print(f"⚠️ stripe_index miss for {value}; repaired from users query")
+            _commit_writes(_stripe_index_writes(phone, {field: value}))
+            return phone
     return None
 
+def backfill_stripe_index(batch_size: int = 400, dry_run: bool = False) -> int:
+    """Write stripe_index entries for every user with Stripe ids. Returns how many."""
+    writes = []
+    total = 0
+    for snap in db.collection("users").stream():
+        billing = (snap.to_dict() or {}).get("billing") or {}
+        for op in _stripe_index_writes(snap.id, billing):
+            total += 1
+            if dry_run:
+                print(f"  would index {op[2]} → {snap.id}")
+                continue
+            writes.append(op)
+            if len(writes) >= batch_size:
+                _commit_writes(writes)
+                writes = []
+    if writes:
+        _commit_writes(writes)
+    return total
+
+# --- Admin audit log ---
+# Append-only users/{phone}/admin_audit/{auto-id}; read newest first in pages.
+
+ADMIN_AUDIT_PAGE_SIZE = int(os.getenv("ADMIN_AUDIT_PAGE_SIZE", "20"))
+
+def _audit_ref(phone: str):
+    return db.collection("users").document(phone).collection("admin_audit")
+
 def append_admin_audit(phone: str, entry: dict) -> None:
     """
-    Append an admin action record to users/{phone}.admin_audit (array).
-    Each entry should be a small dict: {ts, admin, action, details}.
+    Record an admin action for phone. Each entry should be a small dict:
+    {ts, admin, action, details}.
+    """
+    doc = dict(entry)
+    doc.setdefault("ts", int(time.time()))
+    doc["ts_ns"] = time.time_ns()  # page cursor; ts alone repeats within a second
+    _audit_ref(phone).document().set(doc)
+    _count_writes()
+
+def get_admin_audit_page(phone: str, limit: int = ADMIN_AUDIT_PAGE_SIZE, before: int | None = None):
+    """
+    Newest-first page of audit entries. Returns (entries, cursor); pass the
+    cursor back as `before` for the next page (None when there's no more).
     """
-    db = firestore.client()
-    ref = db.collection("users").document(phone)
-    # Make sure document exists
-    ref.set({}, merge=True)
-    ref.update({"admin_audit": firestore.ArrayUnion([entry])})
+    query = _audit_ref(phone).order_by("ts_ns", direction="DESCENDING")
+    if before is not None:
+        query = query.start_after({"ts_ns": before})
+    snaps = list(query.limit(limit + 1).stream())
+    _count_reads(max(1, len(snaps)))
+    entries = [snap.to_dict() or {} for snap in snaps[:limit]]
+    cursor = entries[-1].get("ts_ns") if len(snaps) > limit else None
+    return entries, cursor
+
+# --- Moving ballast off users docs (maintenance) ---
+
+def iter_users():
+    """Yield (phone, data) for every user document (maintenance jobs only)."""
+    for snap in db.collection("users").stream():
+        yield snap.id, (snap.to_dict() or {})
+
+def slim_user_doc(phone: str, data: dict) -> bool:
+    """
+    Move a legacy admin_audit array and last_view_snapshot off users/{phone}
+    into their own collections. Returns False if there was nothing to move.
+    """
+    audit = data.get("admin_audit")
+    snapshot = data.get("last_view_snapshot")
+    if audit is None and snapshot is None:
+        return False
 
+    writes = []
+    base_ns = time.time_ns()
+    for i, entry in enumerate(audit or []):
+        doc = dict(entry)
+        # Keep the original order when ts repeats
+        doc["ts_ns"] = int(doc.get("ts") or 0) * 1_000_000_000 + i if doc.get("ts") else base_ns + i
+        writes.append(("set", f"users/{phone}/admin_audit", f"legacy-{i:05d}", doc))
+    if snapshot:
+        writes.append(("set", "view_snapshots", phone, snapshot))
+    writes.append(("update", "users", phone, {
+        "admin_audit": firestore.DELETE_FIELD,
+        "last_view_snapshot": firestore.DELETE_FIELD,
+    }))
+    for start in range(0, len(writes), 400):
+        _commit_writes(writes[start:start + 400])
+    return True
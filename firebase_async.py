@@ -0,0 +1,121 @@
+# firebase_async.py
+"""
+Async counterparts of the firebase.py data layer, on Firestore's AsyncClient.
+
+They share the request memo and the process cache with firebase.py, so a
+document awaited here is served from memory to the sync helpers that run
+later in the same request (and vice versa).
+"""
+import asyncio
+
+import storage
+from firebase import (
+    _lookup_cached, _doc_loaded, _doc_written, _mirror_mark, _count_reads, list_doc_id,
+    _billing_writes, _stripe_index_writes, STRIPE_INDEX_FALLBACK,
+)
+
+_adb = None
+
+
+def _client():
+    # Created on first use so the gRPC channel binds to the running event loop
+    global _adb
+    if _adb is None:
+        _adb = storage.async_client()
+    return _adb
+
+
+async def get_doc(collection: str, doc_id: str, fresh: bool = False) -> dict | None:
+    if not fresh:
+        found, data = _lookup_cached(collection, doc_id)
+        if found:
+            return data
+    snap = await _client().collection(collection).document(doc_id).get()
+    return _doc_loaded(collection, doc_id, snap)
+
+
+async def get_docs(keys: list[tuple[str, str]]) -> list[dict | None]:
+    """Read several (collection, doc_id) documents concurrently, in order."""
+    return list(await asyncio.gather(*(get_doc(c, d) for c, d in keys)))
+
+
+async def get_user_doc(phone: str) -> dict | None:
+    return await get_doc("users", phone)
+
+
+async def get_list_doc(doc_id: str) -> dict | None:
+    return await get_doc("listas", doc_id)
+
+
+async def get_user_billing(phone: str):
+    data = await get_user_doc(phone)
+    if data is None:
+        return None
+    return data.get("billing") or None
+
+
+async def _commit_writes(writes: list[tuple]) -> None:
+    """Async twin of firebase._commit_writes (same write tuples)."""
+    adb = _client()
+    marks = {(collection, doc_id): _mirror_mark(collection, doc_id) for _, collection, doc_id, *_ in writes}
+    batch = adb.batch()
+    for op, collection, doc_id, *rest in writes:
+        ref = adb.collection(collection).document(doc_id)
+        if op == "delete":
+            batch.delete(ref)
+        elif op == "update":
+            batch.update(ref, rest[0])
+        else:
+            batch.set(ref, rest[0], merge=(op == "merge"))
+    await batch.commit()
+    for op, collection, doc_id, *rest in writes:
+        data = rest[0] if rest else None
+        _doc_written(collection, doc_id, data, merge=(op == "merge"), update=(op == "update"),
+                     since=marks[(collection, doc_id)])
+
+
+async def update_user_billing(phone: str, patch: dict) -> None:
+    # Avoid leaking helper fields
+    patch = {k: v for k, v in patch.items() if not k.startswith("_")}
+    await _commit_writes(_billing_writes(phone, patch))
+
+
+async def prefetch(phone: str, other_phones: tuple[str, ...] = ()) -> None:
+    """
+    Warm the request memo for a command: the sender's user doc and any other
+    users the command mentions are read concurrently, then the sender's list.
+    """
+    phones = [phone] + [p for p in other_phones if p and p != phone]
+    docs = await get_docs([("users", p) for p in phones])
+    user = docs[0]
+    group = (user or {}).get("group")
+    if group and group.get("owner"):
+        await get_list_doc(list_doc_id(group))
+
+
+async def _first_match(field: str, value: str) -> str | None:
+    query = _client().collection("users").where(f"billing.{field}", "==", value).limit(1)
+    async for snap in query.stream():
+        _count_reads()
+        return snap.id
+    return None
+
+
+async def find_phone_by_customer_or_subscription(customer_id: str | None,
+                                                 subscription_id: str | None) -> str | None:
+    """One stripe_index read per id (concurrent); a customer match wins."""
+    ids = [(field, value) for field, value in
+           (("stripe_customer_id", customer_id), ("subscription_id", subscription_id)) if value]
+    for entry in await get_docs([("stripe_index", value) for _, value in ids]):
+        if entry and entry.get("phone"):
+            return entry["phone"]
+    if not ids or not STRIPE_INDEX_FALLBACK:
+        return None
+    # Index miss (user not backfilled yet): query users and repair the entry
+    matches = await asyncio.gather(*(_first_match(field, value) for field, value in ids))
+    for (field, value), phone in zip(ids, matches):
+        if phone:
+            print(f"⚠️ stripe_index miss for {value}; repaired from users query")
+            await _commit_writes(_stripe_index_writes(phone, {field: value}))
+            return phone
+    return None
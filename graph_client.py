@@ -0,0 +1,328 @@
+# graph_client.py
+"""
+Shared keep-alive HTTP clients for the WhatsApp Graph API.
+
+One pooled requests.Session (sync callers, threadpool) and one
+httpx.AsyncClient (event loop) per WhatsApp number (the `pool` argument,
+a phone_number_id) are reused for every outbound call, so
+back-to-back replies share TCP+TLS connections instead of handshaking each
+time. Pool size and timeouts come from the environment; stats() reports
+how often connections were reused.
+
+send_json()/asend_json() add pacing through a ratelimit bucket and retry
+throttling (429, Meta's rate-limit error codes) and 5xx responses with
+jittered backoff that honors Retry-After.
+"""
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GRAPH_BASE_URL = os.getenv("GRAPH_BASE_URL", "https://graph.facebook.com").rstrip("/")
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "10"))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "5"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "15"))
+GRAPH_KEEPALIVE_SECONDS = float(os.getenv("GRAPH_KEEPALIVE_SECONDS", "60"))
+GRAPH_SEND_RETRIES = int(os.getenv("GRAPH_SEND_RETRIES", "3"))
+GRAPH_RETRY_BASE = float(os.getenv("GRAPH_RETRY_BASE", "0.5"))  # seconds, doubled per attempt
+GRAPH_RETRY_MAX = float(os.getenv("GRAPH_RETRY_MAX", "30"))
+
+# Graph error codes that mean "slow down" even when the HTTP status is 400
+# (4 app, 80007 WABA, 130429 throughput, 131048 spam, 131056 pair rate limit)
+THROTTLE_CODES = {4, 80007, 130429, 131048, 131056}
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.responses = 0  # requests that got an HTTP response (any status)
+        self.errors = 0
+        self.new_connections = 0
+        self.retries = 0
+        self.throttled = 0
+        self.total_ms = 0.0
+
+    def record(self, started: float, response, ok: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            self.responses += 0 if response is None else 1
+            self.errors += 0 if ok else 1
+            self.total_ms += (time.perf_counter() - started) * 1000
+
+    def as_dict(self, new_connections: int) -> dict:
+        with self.lock:
+            reused = max(0, self.responses - new_connections)
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "new_connections": new_connections,
+                "reused_connections": reused,
+                "reuse_rate": round(reused / self.responses, 3) if self.responses else 0.0,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "avg_ms": round(self.total_ms / self.requests, 1) if self.requests else 0.0,
+            }
+
+
+class _Pool:
+    """Connections and counters for one WhatsApp number (phone_number_id)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.session = None
+        self.async_client = None
+        self.async_streams = weakref.WeakSet()
+        self.sync_stats = _Stats()
+        self.async_stats = _Stats()
+        self.lock = threading.Lock()
+
+
+_pools: dict[str, _Pool] = {}
+_lock = threading.Lock()
+
+
+def _pool(name: str | None) -> _Pool:
+    key = name or "default"
+    found = _pools.get(key)
+    if found is None:
+        with _lock:
+            found = _pools.setdefault(key, _Pool(key))
+    return found
+
+
+def _timeout() -> tuple[float, float]:
+    return (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)
+
+
+def session(pool: str | None = None) -> requests.Session:
+    p = _pool(pool)
+    if p.session is None:
+        with p.lock:
+            if p.session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=GRAPH_POOL_SIZE)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                p.session = s
+    return p.session
+
+
+def async_client(pool: str | None = None):
+    """The number's shared httpx.AsyncClient (created on first use, inside the running loop)."""
+    p = _pool(pool)
+    if p.async_client is None:
+        import httpx
+        p.async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=GRAPH_POOL_SIZE,
+                max_keepalive_connections=GRAPH_POOL_SIZE,
+                keepalive_expiry=GRAPH_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(GRAPH_READ_TIMEOUT, connect=GRAPH_CONNECT_TIMEOUT),
+        )
+    return p.async_client
+
+
+def graph_url(path: str) -> str:
+    return f"{GRAPH_BASE_URL}/{path.lstrip('/')}"
+
+
+def post_json(path: str, payload: dict, token: str, timeout: float | None = None,
+              pool: str | None = None) -> requests.Response:
+    """POST JSON to the Graph API on the number's pooled session (raises on network errors)."""
+    stats = _pool(pool).sync_stats
+    started = time.perf_counter()
+    r = None
+    try:
+        r = session(pool).post(
+            graph_url(path),
+            headers={"Authorization": f"Bearer {token}"},
+            json=payload,
+            timeout=(GRAPH_CONNECT_TIMEOUT, timeout) if timeout else _timeout(),
+        )
+        return r
+    finally:
+        stats.record(started, r, r is not None and r.status_code < 400)
+
+
+async def apost_json(path: str, payload: dict, token: str, timeout: float | None = None,
+                     pool: str | None = None):
+    """Async POST JSON to the Graph API on the number's shared httpx client."""
+    p = _pool(pool)
+    started = time.perf_counter()
+    r = None
+    try:
+        kwargs = {"timeout": timeout} if timeout else {}
+        r = await async_client(pool).post(
+            graph_url(path), headers={"Authorization": f"Bearer {token}"}, json=payload, **kwargs
+        )
+        stream = r.extensions.get("network_stream")
+        if stream is not None:
+            with p.async_stats.lock:
+                if stream not in p.async_streams:
+                    p.async_streams.add(stream)
+                    p.async_stats.new_connections += 1
+        return r
+    finally:
+        p.async_stats.record(started, r, r is not None and r.status_code < 400)
+
+
+def upload_media(path: str, file_path: str, mime_type: str, token: str,
+                 pool: str | None = None) -> requests.Response:
+    """Multipart upload to /{phone_number_id}/media on the pooled session."""
+    stats = _pool(pool).sync_stats
+    started = time.perf_counter()
+    r = None
+    try:
+        with open(file_path, "rb") as f:
+            r = session(pool).post(
+                graph_url(path),
+                headers={"Authorization": f"Bearer {token}"},
+                data={"messaging_product": "whatsapp", "type": mime_type},
+                files={"file": (os.path.basename(file_path), f, mime_type)},
+                timeout=(GRAPH_CONNECT_TIMEOUT, max(GRAPH_READ_TIMEOUT, 60)),
+            )
+        return r
+    finally:
+        stats.record(started, r, r is not None and r.status_code < 400)
+
+
+def is_throttled(response) -> bool:
+    """429, or a Graph error code that asks us to slow down."""
+    if response is None:
+        return False
+    if response.status_code == 429:
+        return True
+    if response.status_code < 400:
+        return False
+    try:
+        code = ((response.json() or {}).get("error") or {}).get("code")
+    except Exception:
+        return False
+    return code in THROTTLE_CODES
+
+
+def should_retry(response) -> bool:
+    """Network error (no response), throttling or a server error."""
+    return response is None or response.status_code >= 500 or is_throttled(response)
+
+
+def retry_delay(attempt: int, response=None) -> float:
+    """Retry-After when Meta sent one, else full-jitter exponential backoff."""
+    header = response.headers.get("Retry-After") if response is not None else None
+    if header:
+        try:
+            after = float(header)
+        except ValueError:
+            try:
+                after = email.utils.parsedate_to_datetime(header).timestamp() - time.time()
+            except (TypeError, ValueError):
+                after = None
+        if after is not None:
+            after = min(GRAPH_RETRY_MAX, max(0.0, after))
+            return after + random.uniform(0, min(1.0, after * 0.1))
+    return random.uniform(0, min(GRAPH_RETRY_MAX, GRAPH_RETRY_BASE * (2 ** attempt)))
+
+
+def _note_retry(stats: _Stats, bucket, response, delay: float) -> None:
+    throttled = is_throttled(response)
+    with stats.lock:
+        stats.retries += 1
+        stats.throttled += 1 if throttled else 0
+    if throttled and bucket is not None:
+        bucket.pause(delay)
+
+
+def send_json(path: str, payload: dict, token: str, bucket=None, timeout: float | None = None,
+              pool: str | None = None):
+    """
+    post_json paced by `bucket` (a ratelimit.TokenBucket), retried on
+    throttling/5xx/network errors. Returns the last response; raises only if
+    the last attempt got no response at all.
+    """
+    for attempt in range(GRAPH_SEND_RETRIES + 1):
+        if bucket is not None:
+            bucket.acquire()
+        r, error = None, None
+        try:
+            r = post_json(path, payload, token, timeout=timeout, pool=pool)
+        except requests.RequestException as e:
+            error = e
+        if not should_retry(r) or attempt == GRAPH_SEND_RETRIES:
+            break
+        delay = retry_delay(attempt, r)
+        _note_retry(_pool(pool).sync_stats, bucket, r, delay)
+        time.sleep(delay)
+    if r is None:
+        raise error
+    return r
+
+
+async def asend_json(path: str, payload: dict, token: str, bucket=None, timeout: float | None = None,
+                     pool: str | None = None):
+    """Async send_json on the shared httpx client."""
+    import httpx
+    for attempt in range(GRAPH_SEND_RETRIES + 1):
+        if bucket is not None:
+            await bucket.acquire_async()
+        r, error = None, None
+        try:
+            r = await apost_json(path, payload, token, timeout=timeout, pool=pool)
+        except httpx.TransportError as e:
+            error = e
+        if not should_retry(r) or attempt == GRAPH_SEND_RETRIES:
+            break
+        delay = retry_delay(attempt, r)
+        _note_retry(_pool(pool).async_stats, bucket, r, delay)
+        await asyncio.sleep(delay)
+    if r is None:
+        raise error
+    return r
+
+
+def _sync_new_connections(p: _Pool) -> int:
+    if p.session is None:
+        return 0
+    total = 0
+    seen = set()
+    for adapter in p.session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+    return total
+
+
+def stats() -> dict:
+    with _lock:
+        pools = dict(_pools)
+    return {
+        "pool_size": GRAPH_POOL_SIZE,
+        "by_number": {
+            name: {
+                "sync": p.sync_stats.as_dict(_sync_new_connections(p)),
+                "async": p.async_stats.as_dict(p.async_stats.new_connections),
+            }
+            for name, p in pools.items()
+        },
+    }
+
+
+async def aclose() -> None:
+    with _lock:
+        pools = list(_pools.values())
+    for p in pools:
+        if p.async_client is not None:
+            await p.async_client.aclose()
+            p.async_client = None
@@ -0,0 +1,232 @@
+# inbound.py
+"""
+Inbound Meta webhook payloads.
+
+Meta may batch several entries, changes and messages into one delivery.
+split_messages() turns a payload into one single-message payload per
+message (same shape the handler reads: entry[0].changes[0].value.messages[0])
+and by_sender() groups them so different senders can be handled
+concurrently while each sender's messages keep their order.
+
+first_delivery() claims a message id before it is handled and finished()
+settles the claim: done (remembered for INBOUND_DEDUPE_TTL seconds, so a
+webhook Meta redelivers is acknowledged without running the command again)
+or released when handling failed. A claim left "processing" by a worker
+that died is taken over after INBOUND_DEDUPE_LEASE seconds, so a crash
+mid-command doesn't lose the redelivery.
+
+    INBOUND_DEDUPE=memory     this process only (default; bounded LRU)
+    INBOUND_DEDUPE=sqlite     shared by workers on one host (INBOUND_DEDUPE_PATH)
+    INBOUND_DEDUPE=firestore  shared by every worker (inbound_messages collection)
+    INBOUND_DEDUPE=off
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from cache import TTLCache
+
+INBOUND_DEDUPE = (os.getenv("INBOUND_DEDUPE") or "memory").lower()
+INBOUND_DEDUPE_TTL = float(os.getenv("INBOUND_DEDUPE_TTL", str(24 * 3600)))
+INBOUND_DEDUPE_MAX = int(os.getenv("INBOUND_DEDUPE_MAX", "50000"))
+INBOUND_DEDUPE_PATH = os.getenv("INBOUND_DEDUPE_PATH", "inbound.db")
+INBOUND_DEDUPE_LEASE = float(os.getenv("INBOUND_DEDUPE_LEASE", "120"))  # longest a command may take
+
+PROCESSING = "processing"
+DONE = "done"
+
+_lock = threading.Lock()
+_stats = {"payloads": 0, "messages": 0, "duplicates": 0, "status_only": 0, "max_batch": 0, "max_senders": 0}
+_batch_sizes = OrderedDict((label, 0) for label in ("1", "2-5", "6-20", "21+"))
+
+
+def split_messages(body: dict) -> list[dict]:
+    """One payload per message, in delivery order, keeping each message's value metadata."""
+    out = []
+    for entry in (body or {}).get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            for msg in value.get("messages") or []:
+                single_value = {**value, "messages": [msg]}
+                out.append({**body, "entry": [{**entry, "changes": [{**change, "value": single_value}]}]})
+    return out
+
+
+def sender_of(payload: dict) -> str:
+    msg = payload["entry"][0]["changes"][0]["value"]["messages"][0]
+    return str(msg.get("from") or "").strip()
+
+
+def by_sender(payloads: list[dict]) -> list[list[dict]]:
+    groups: "OrderedDict[str, list[dict]]" = OrderedDict()
+    for payload in payloads:
+        groups.setdefault(sender_of(payload), []).append(payload)
+    return list(groups.values())
+
+
+def message_id(payload: dict) -> str:
+    msg = payload["entry"][0]["changes"][0]["value"]["messages"][0]
+    return str(msg.get("id") or "").strip()
+
+
+class _SQLiteSeen:
+    def __init__(self, path: str, ttl: float, lease: float):
+        self.ttl = ttl
+        self.lease = lease
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS inbound_seen (id TEXT PRIMARY KEY, ts REAL NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'done')"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(inbound_seen)")}
+        if "state" not in columns:  # files created before claims had a state
+            self._conn.execute("ALTER TABLE inbound_seen ADD COLUMN state TEXT NOT NULL DEFAULT 'done'")
+        self._lock = threading.Lock()
+        self._purged = 0.0
+
+    def claim(self, msg_id: str) -> bool:
+        now = time.time()
+        with self._lock:
+            if now - self._purged > 600:
+                self._conn.execute("DELETE FROM inbound_seen WHERE ts < ?", (now - self.ttl,))
+                self._purged = now
+            # Insert, or take over an expired done row / an abandoned processing row;
+            # no change = duplicate (or still being handled elsewhere)
+            cur = self._conn.execute(
+                "INSERT INTO inbound_seen (id, ts, state) VALUES (?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET ts = excluded.ts, state = excluded.state"
+                " WHERE (inbound_seen.state = ? AND inbound_seen.ts < ?)"
+                " OR (inbound_seen.state = ? AND inbound_seen.ts < ?)",
+                (msg_id, now, PROCESSING, DONE, now - self.ttl, PROCESSING, now - self.lease),
+            )
+            return cur.rowcount > 0
+
+    def finish(self, msg_id: str, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._conn.execute("UPDATE inbound_seen SET state = ?, ts = ? WHERE id = ?",
+                                   (DONE, time.time(), msg_id))
+            else:
+                self._conn.execute("DELETE FROM inbound_seen WHERE id = ?", (msg_id,))
+
+
+_seen_memory = TTLCache("inbound_seen", INBOUND_DEDUPE_MAX, INBOUND_DEDUPE_TTL)
+_seen_lock = threading.Lock()
+_seen_sqlite = None
+_dedupe = {"checked": 0, "duplicates": 0, "released": 0, "errors": 0}
+
+
+def _sqlite() -> _SQLiteSeen:
+    global _seen_sqlite
+    if _seen_sqlite is None:
+        with _seen_lock:
+            if _seen_sqlite is None:
+                _seen_sqlite = _SQLiteSeen(INBOUND_DEDUPE_PATH, INBOUND_DEDUPE_TTL, INBOUND_DEDUPE_LEASE)
+    return _seen_sqlite
+
+
+def _claim(msg_id: str) -> bool:
+    if INBOUND_DEDUPE == "firestore":
+        from firebase import claim_inbound_message
+        return claim_inbound_message(msg_id, INBOUND_DEDUPE_TTL, INBOUND_DEDUPE_LEASE)
+    if INBOUND_DEDUPE == "sqlite":
+        return _sqlite().claim(msg_id)
+    with _seen_lock:
+        found, claim = _seen_memory.get(msg_id)
+        if found and (claim[0] == DONE or claim[1] + INBOUND_DEDUPE_LEASE > time.time()):
+            return False
+        _seen_memory.set(msg_id, (PROCESSING, time.time()))
+        return True
+
+
+def _finish(msg_id: str, ok: bool) -> None:
+    if INBOUND_DEDUPE == "firestore":
+        from firebase import finish_inbound_message
+        finish_inbound_message(msg_id, ok, INBOUND_DEDUPE_TTL)
+    elif INBOUND_DEDUPE == "sqlite":
+        _sqlite().finish(msg_id, ok)
+    else:
+        with _seen_lock:
+            if ok:
+                _seen_memory.set(msg_id, (DONE, time.time()))
+            else:
+                _seen_memory.invalidate(msg_id)
+
+
+def first_delivery(payload: dict) -> bool:
+    """
+    Claim the payload's message id; False when it was already handled (or
+    is being handled). Settle the claim with finished() afterwards.
+    Blocking for the sqlite/firestore modes (run it in the threadpool).
+    If the store fails, the message is handled (better twice than never).
+    """
+    msg_id = message_id(payload)
+    if INBOUND_DEDUPE == "off" or not msg_id:
+        return True
+    try:
+        first = _claim(msg_id)
+    except Exception as e:
+        print(f"⚠️ Inbound dedupe failed for {msg_id}:", str(e))
+        with _lock:
+            _dedupe["errors"] += 1
+        return True
+    with _lock:
+        _dedupe["checked"] += 1
+        _dedupe["duplicates"] += 0 if first else 1
+    return first
+
+
+def finished(payload: dict, ok: bool) -> None:
+    """Mark the claimed message done, or release the claim so a redelivery runs it again."""
+    msg_id = message_id(payload)
+    if INBOUND_DEDUPE == "off" or not msg_id:
+        return
+    try:
+        _finish(msg_id, ok)
+    except Exception as e:
+        print(f"⚠️ Inbound dedupe update failed for {msg_id}:", str(e))
+        with _lock:
+            _dedupe["errors"] += 1
+        return
+    if not ok:
+        with _lock:
+            _dedupe["released"] += 1
+
+
+def _bucket(n: int) -> str:
+    if n <= 1:
+        return "1"
+    if n <= 5:
+        return "2-5"
+    if n <= 20:
+        return "6-20"
+    return "21+"
+
+
+def record_batch(messages: int, senders: int, duplicates: int = 0) -> None:
+    """One webhook delivery as Meta sent it; duplicates = redelivered messages skipped."""
+    with _lock:
+        _stats["payloads"] += 1
+        if not messages:
+            _stats["status_only"] += 1
+            return
+        _stats["messages"] += messages
+        _stats["duplicates"] += duplicates
+        _stats["max_batch"] = max(_stats["max_batch"], messages)
+        _stats["max_senders"] = max(_stats["max_senders"], senders)
+        _batch_sizes[_bucket(messages)] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        with_messages = _stats["payloads"] - _stats["status_only"]
+        return {
+            **_stats,
+            "avg_batch": round(_stats["messages"] / with_messages, 2) if with_messages else 0.0,
+            "batch_sizes": dict(_batch_sizes),
+            "dedupe": {"mode": INBOUND_DEDUPE, "ttl_s": INBOUND_DEDUPE_TTL, "lease_s": INBOUND_DEDUPE_LEASE,
+                   **_dedupe},
+        }
@@ -0,0 +1,43 @@
+# lazy.py
+"""
+Deferred imports for faster cold starts.
+
+Heavy libraries (firebase_admin/google-cloud, weasyprint, ICU, stripe,
+phonenumbers) are imported on first use instead of when main.py loads.
+Each deferred load is timed so /admin/metrics shows what the first request
+(or the startup warm-up) paid for.
+"""
+import importlib
+import threading
+import time
+
+_load_ms: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def load(name: str):
+    """Import a module by name, recording how long the first import took."""
+    if name in _load_ms:
+        return importlib.import_module(name)
+    with _lock:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        _load_ms.setdefault(name, round((time.perf_counter() - started) * 1000, 1))
+    return module
+
+
+class LazyModule:
+    """Stand-in for a module that imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = load(self._name)
+        return getattr(self._module, attr)
+
+
+def load_stats() -> dict:
+    return dict(_load_ms)
@@ -0,0 +1,80 @@
+# listlock.py
+"""
+Per-list serialization of item mutations.
+
+Members of one household often send /i, /a and /l to the same list within
+the same second. The webhook holds list_lock.hold(doc_id) around those
+commands, so they run one after another per list (in arrival order) while
+different lists keep running in parallel. Each key gets its own
+asyncio.Lock, created on first use and dropped when nobody holds or waits
+for it; there is no global lock.
+
+This orders commands inside one process; across workers the Firestore
+transactions in firebase.py remain the guarantee.
+
+    LIST_LOCK=true   (default) serialize /i, /a, /l per list
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+from commands import Histogram, LATENCY_BUCKETS_MS
+
+LIST_LOCK = os.getenv("LIST_LOCK", "true").lower() == "true"
+
+
+class KeyedLock:
+    """One asyncio.Lock per key (event-loop only), with wait-time metrics."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._locks: dict[str, list] = {}  # key -> [asyncio.Lock, holders + waiters]
+        self.acquired = 0
+        self.contended = 0
+        self.max_waiters = 0
+        self.wait_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        """Hold the key's lock; yields the wait in ms (0.0 when it was free)."""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            started = time.perf_counter()
+            # Someone else holds or queues for this key (a just-released lock may still have waiters ahead)
+            contended = entry[0].locked() or entry[1] > 1
+            if contended:
+                self.contended += 1
+                self.max_waiters = max(self.max_waiters, entry[1] - 1)
+            await entry[0].acquire()
+            waited = (time.perf_counter() - started) * 1000 if contended else 0.0
+            self.acquired += 1
+            self.wait_ms.observe(waited)
+            try:
+                yield waited
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": LIST_LOCK,
+            "active_keys": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "max_waiters": self.max_waiters,
+            "wait_ms": self.wait_ms.as_dict(),
+        }
+
+
+list_lock = KeyedLock("lists")
+
+
+def stats() -> dict:
+    return list_lock.stats()
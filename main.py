@@ -1,27 +1,42 @@
 from fastapi import FastAPI, Request, Query
 from firebase import (
-    add_item, get_items, delete_item, clear_items,
+    add_item, add_items, get_items, delete_item, delete_items, clear_items,
     get_user_group, create_new_list, user_in_list,
     is_admin, add_user_to_list, propose_admin_transfer, accept_admin_transfer,
     remove_user_from_list, remove_self_from_list, get_user_billing, update_user_billing,
-    find_phone_by_customer_or_subscription
+    get_user_doc, get_list_doc, set_list_title,
+    save_view_snapshot, load_view_snapshot, request_context, current_context,
+    normalize_text, find_item, find_items, get_items_at, get_list_entries, is_paged_list, list_item_count,
+    get_list_members, ITEMS_PAGE_SIZE, sort_key, list_doc_id, _lookup_cached,
 )
-from firebase_admin import firestore
+import firebase_async
+from starlette.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from jinja2 import Template
-import weasyprint
 import os
-import requests
+import re
+import asyncio
+import contextvars
+import threading
+from contextlib import asynccontextmanager
+import lazy
+import graph_client
+import ratelimit
+import media
+import outbound
+from outbound import OUTBOUND_QUEUE, OUTBOUND_DRAIN_SECONDS
+from outbox import outbox, OUTBOX, OUTBOX_POLL_SECONDS
+import replies
+import inbound
+import commands
+from commands import command
+from listlock import LIST_LOCK, list_lock
+import storage
 from urllib.parse import quote
-from icu import Collator, Locale
-collator = Collator.createInstance(Locale("pt_BR"))
 from datetime import datetime, timezone, timedelta
 import time
 import pytz
-import phonenumbers
-from phonenumbers import NumberParseException
-import unicodedata
 from messages import (
     ALREADY_IN_LIST, NAMELESS_OPENING, ADD_USER_USAGE, NOT_IN_LIST,
     INVALID_NUMBER, NOT_ADMIN, INVALID_SELF_EXIT,
@@ -30,7 +45,7 @@ from messages import (
     NOT_OWNER_CANNOT_RENAME, NOT_OWNER_CANNOT_CLEAR,
 
     REMOVED_FROM_LIST, MEMBER_LEFT_NOTIFICATION, list_created, item_added_log,
-    item_already_exists, item_removed, item_not_found,
+    item_already_exists, items_added, item_removed, items_removed, item_not_found,
     guest_added, guest_removed, guest_already_in_other_list, transfer_proposed,
     not_a_guest, list_title_updated, list_download_url,
     list_shown, list_detailed_url, not_a_member, indication_text,
@@ -46,7 +61,53 @@ from billing import (
     compute_status, create_billing_portal_session, ensure_customer,
 )
 
-app = FastAPI()
+# Heavy SDKs load lazily (see lazy.py). Right after startup a background
+# thread loads them anyway, so the port binds fast and the first reply after
+# a cold start usually finds everything ready.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+
+def _warm_demo_video():
+    # Make sure /z can send the demo by media id from the first request, from every number
+    if META_ACCESS_TOKEN:
+        for number in OUTBOUND_NUMBERS:
+            media.ensure(DEMO_VIDEO_FILE, "video/mp4", number, META_ACCESS_TOKEN, META_API_VERSION)
+
+def _warm_up():
+    started = time.perf_counter()
+    steps = {
+        "storage": storage.client,
+        "icu": lambda: sort_key("a"),
+        "phonenumbers": lambda: lazy.load("phonenumbers"),
+        "weasyprint": lambda: lazy.load("weasyprint"),
+        "demo video": _warm_demo_video,
+    }
+    for name, step in steps.items():
+        try:
+            step()
+        except Exception as e:
+            print(f"⚠️ Warm-up of {name} failed:", str(e))
+    print(f"🔥 Warm-up done in {int((time.perf_counter() - started) * 1000)}ms")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    if OUTBOUND_QUEUE:
+        outbound.start(OUTBOUND_NUMBERS or [""], _deliver_queued)
+    replayer = asyncio.create_task(_replay_outbox()) if OUTBOX else None
+    yield
+    if replayer is not None:
+        replayer.cancel()
+    await outbound.stop(OUTBOUND_DRAIN_SECONDS)
+    if OUTBOX:
+        try:
+            # Whatever didn't drain is ours no more: the next worker replays it now
+            outbox.release()
+        except Exception as e:
+            print("⚠️ Outbox release failed:", str(e))
+    await graph_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(admin_router)
 PUBLIC_DISPLAY_NUMBER = os.getenv("PUBLIC_DISPLAY_NUMBER", "+55 11 91270-5543")  # your real number
@@ -64,7 +125,12 @@ NUMBER_MAP = {k: v for k, v in _raw_map.items() if k}
 # WhatsApp Cloud API (Meta)
 META_ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN", "")
 META_PHONE_NUMBER_ID = os.getenv("META_PHONE_NUMBER_ID", "")
+# Every number we send from: replies leave through the number that received
+# the message, each with its own queue, connection pool and rate limit
+OUTBOUND_NUMBERS = list(NUMBER_MAP) or ([META_PHONE_NUMBER_ID] if META_PHONE_NUMBER_ID else [])
+_sender_number: contextvars.ContextVar = contextvars.ContextVar("listinha_sender_number", default=None)
 META_API_VERSION = os.getenv("META_API_VERSION", "v21.0")
+DEMO_VIDEO_FILE = os.path.join("static", "listinha-demo.mp4")
 
 # Token de verificação para o GET do webhook (Meta)
 VERIFY_TOKEN = os.getenv("META_VERIFY_TOKEN", "listinha-verify")
@@ -86,6 +152,9 @@ def normalize_phone(raw_phone: str, admin_phone: str) -> str or None:
     - Returns None if invalid.
     """
 
+    phonenumbers = lazy.load("phonenumbers")
+    NumberParseException = phonenumbers.NumberParseException
+
     # Get admin DDI from their phone
     try:
         admin_parsed = phonenumbers.parse(admin_phone, None)
@@ -138,22 +207,6 @@ def current_doc_id(phone: str) -> str:
     group = get_user_group(phone) or {}
     return f"{group.get('instance','default')}__{group.get('owner', phone)}__{group.get('list','default')}"
 
-def save_view_snapshot(phone: str, items: list[str]) -> None:
-    """Persist the user's last alphabetized view as a 1..N → text mapping."""
-    firestore.client().collection("users").document(phone).set({
-        "last_view_snapshot": {
-            "doc_id": current_doc_id(phone),
-            "items": items,
-            "ts_epoch": int(datetime.now(timezone.utc).timestamp()),
-        }
-    }, merge=True)
-
-def load_view_snapshot(phone: str):
-    doc = firestore.client().collection("users").document(phone).get()
-    if not doc.exists:
-        return None
-    return (doc.to_dict() or {}).get("last_view_snapshot") or {}
-
 SNAPSHOT_TTL_SECONDS = 600  # 10 minutos
 
 def snapshot_is_fresh(ts_epoch) -> bool:
@@ -163,83 +216,257 @@ def snapshot_is_fresh(ts_epoch) -> bool:
     except Exception:
         return False
 
-def send_message(to, body):
-    """
-    Envia mensagem de texto via WhatsApp Cloud API (Meta).
-    Aceita 'to' como "whatsapp:+55119..." ou "+55119..." ou "55119...".
-    """
-    try:
-        to_norm = (to or "").replace("whatsapp:", "").strip()
-        if to_norm.startswith("+"):
-            to_norm = to_norm[1:]
-
-        url = f"https://graph.facebook.com/{META_API_VERSION}/{META_PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {META_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": to_norm,
-            "type": "text",
-            "text": {"body": body[:4096]}  # pequeno limite de segurança
-        }
-        print(f"📤 META OUT → to=+{to_norm} chars={len(body)}")
-        r = requests.post(url, headers=headers, json=payload, timeout=15)
-        try:
-            r.raise_for_status()
-        except Exception:
-            # 🔎 Extra debug: show Graph API error payload to pinpoint cause
-            try:
-                print("META ERROR BODY:", r.text)
-            except Exception:
-                pass
-            raise  # rethrow for the outer except
+# Items in one "i"/"a" message: comma or newline separated, but a comma between
+# digits with no space after it is a decimal separator ("leite 1,5 l", but "leite 2, pão")
+_ITEM_SEPARATOR = re.compile(r",\s+|(?<!\d),|,(?!\d)|\n")
 
-        resp = r.json()
-        msg_id = (resp.get("messages") or [{}])[0].get("id")
-        print(f"✅ Enviado via Meta. id={msg_id}")
-    except Exception as e:
-        print("❌ Erro ao enviar via Meta:", str(e))
+def _split_items(text: str) -> list[str]:
+    return [n.strip() for n in _ITEM_SEPARATOR.split(text or "") if n.strip()]
 
-def send_video(to, video_url, caption=""):
-    """
-    Envia um pequeno vídeo via WhatsApp Cloud API.
-    'video_url' deve ser HTTPS público (ex.: https://.../static/listinha-demo.mp4)
-    """
-    try:
-        to_norm = (to or "").replace("whatsapp:", "").strip()
-        if to_norm.startswith("+"):
-            to_norm = to_norm[1:]
-
-        url = f"https://graph.facebook.com/{META_API_VERSION}/{META_PHONE_NUMBER_ID}/messages"
-        headers = {
-            "Authorization": f"Bearer {META_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        payload = {
+def _parse_positions(text: str) -> list[tuple[int, int]] | None:
+    """Parse "3", "1,3,5-9" or "1 3 5" into [(lo, hi), ...]; None if text isn't only numbers/ranges."""
+    tokens = [t for t in re.split(r"[,\s]+", re.sub(r"\s*-\s*", "-", text or "")) if t]
+    ranges = []
+    for token in tokens:
+        m = re.fullmatch(r"(\d+)(?:-(\d+))?", token)
+        if not m:
+            return None
+        lo, hi = int(m.group(1)), int(m.group(2) or m.group(1))
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges or None
+
+def _wa_recipient(to) -> str:
+    to_norm = (to or "").replace("whatsapp:", "").strip()
+    if to_norm.startswith("+"):
+        to_norm = to_norm[1:]
+    return to_norm
+
+def _graph_payload(to_norm, msg, media_id=None):
+    if msg["type"] == "video":
+        # By uploaded media id when we have one; otherwise Meta fetches the link
+        source = {"id": media_id} if media_id else {"link": msg["link"]}
+        return {
             "messaging_product": "whatsapp",
             "to": to_norm,
             "type": "video",
             "video": {
-                "link": video_url,
-                "caption": caption[:1024] if caption else None
+                **source,
+                "caption": msg["caption"][:1024] if msg.get("caption") else None
             }
         }
-        print(f"📤 META OUT (video) → to=+{to_norm} url={video_url}")
-        r = requests.post(url, headers=headers, json=payload, timeout=20)
+    return {
+        "messaging_product": "whatsapp",
+        "to": to_norm,
+        "type": "text",
+        "text": {"body": msg["body"][:4096]}  # pequeno limite de segurança
+    }
+
+def _from_number(msg):
+    return msg.get("from_id") or META_PHONE_NUMBER_ID
+
+def _messages_path(number):
+    return f"{META_API_VERSION}/{number}/messages"
+
+def _media_id(msg):
+    """Cached Meta media id for a local file; schedules the upload when missing."""
+    file_path = msg.get("file")
+    if not file_path:
+        return None
+    number = _from_number(msg)
+    media_id = media.cached_id(file_path, number)
+    if media_id is None:
+        media.ensure_in_background(file_path, msg.get("mime") or "video/mp4",
+                                   number, META_ACCESS_TOKEN, META_API_VERSION)
+    return media_id
+
+def _media_rejected(r, media_id):
+    # Meta dropped the uploaded media early: forget it and resend by link
+    if media_id and 400 <= r.status_code < 500 and not graph_client.is_throttled(r):
+        print(f"⚠️ Meta rejected media_id={media_id}, resending by link:", r.text[:300])
+        return True
+    return False
+
+def _log_out(to_norm, msg, media_id=None):
+    if msg["type"] == "video":
+        source = f"media_id={media_id}" if media_id else f"url={msg['link']}"
+        print(f"📤 META OUT (video) → to=+{to_norm} {source}")
+    else:
+        print(f"📤 META OUT → to=+{to_norm} chars={len(msg['body'])}")
+
+def _log_sent(r, msg):
+    try:
         r.raise_for_status()
-        resp = r.json()
-        msg_id = (resp.get("messages") or [{}])[0].get("id")
-        print(f"✅ Vídeo enviado via Meta. id={msg_id}")
-    except Exception as e:
+    except Exception:
+        # 🔎 Extra debug: show Graph API error payload to pinpoint cause
         try:
-            print("META ERROR BODY (video):", r.text)
+            print("META ERROR BODY:", r.text)
         except Exception:
             pass
-        print("❌ Erro ao enviar vídeo via Meta:", str(e))
+        raise  # rethrow for the outer except
+    resp = r.json()
+    msg_id = (resp.get("messages") or [{}])[0].get("id")
+    print(f"✅ {'Vídeo enviado' if msg['type'] == 'video' else 'Enviado'} via Meta. id={msg_id}")
+
+def _deliver_sync(to, msg):
+    to_norm = _wa_recipient(to)
+    number = _from_number(msg)
+    media_id = _media_id(msg)
+    _log_out(to_norm, msg, media_id)
+    timeout = 20 if msg["type"] == "video" else None
+    bucket = ratelimit.bucket(number)
+    r = graph_client.send_json(_messages_path(number), _graph_payload(to_norm, msg, media_id), META_ACCESS_TOKEN,
+                               bucket=bucket, timeout=timeout, pool=number)
+    if _media_rejected(r, media_id):
+        media.forget(msg["file"], number)
+        r = graph_client.send_json(_messages_path(number), _graph_payload(to_norm, msg), META_ACCESS_TOKEN,
+                                   bucket=bucket, timeout=timeout, pool=number)
+    _log_sent(r, msg)
+
+async def _deliver_async(to, msg):
+    """Outbound queue worker: send one message on the number's async client (raises on failure)."""
+    to_norm = _wa_recipient(to)
+    number = _from_number(msg)
+    media_id = _media_id(msg)
+    _log_out(to_norm, msg, media_id)
+    timeout = 20 if msg["type"] == "video" else None
+    bucket = ratelimit.bucket(number)
+    r = await graph_client.asend_json(_messages_path(number), _graph_payload(to_norm, msg, media_id),
+                                      META_ACCESS_TOKEN, bucket=bucket, timeout=timeout, pool=number)
+    if _media_rejected(r, media_id):
+        await run_in_threadpool(media.forget, msg["file"], number)
+        r = await graph_client.asend_json(_messages_path(number), _graph_payload(to_norm, msg),
+                                          META_ACCESS_TOKEN, bucket=bucket, timeout=timeout, pool=number)
+    _log_sent(r, msg)
+
+def _retryable(e) -> bool:
+    # 4xx (bad number, bad payload) won't succeed later; timeouts, throttling, 5xx and network errors may
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is None or status == 408 or graph_client.should_retry(response)
+
+def _settle(msg, error=None):
+    """Mark the outbox entry behind msg delivered, or schedule its retry."""
+    entry_id = msg.get("outbox_id")
+    if entry_id is None:
+        return
+    try:
+        if error is None:
+            outbox.delivered(entry_id)
+        else:
+            outbox.failed(entry_id, str(error), retry=_retryable(error))
+    except Exception as e:
+        print(f"⚠️ Outbox update for entry {entry_id} failed:", str(e))
+
+async def _deliver_queued(to, msg):
+    """Outbound queue worker: deliver and record the outcome in the outbox."""
+    try:
+        await _deliver_async(to, msg)
+    except Exception as e:
+        _settle(msg, e)
+        raise
+    _settle(msg)
+
+def _outboxed(to, msg, key=None):
+    """Record msg in the durable outbox before sending; None if `key` was already sent."""
+    # Fix the sending number now: queue workers and replays run outside this request
+    msg = {**msg, "from_id": msg.get("from_id") or _sender_number.get() or META_PHONE_NUMBER_ID}
+    if not OUTBOX:
+        return msg
+    try:
+        entry_id = outbox.record(to, msg, key)
+    except Exception as e:
+        print("⚠️ Outbox write failed, sending without it:", str(e))
+        return msg
+    if entry_id is None:
+        print(f"↩️ Mensagem duplicada ignorada (key={key})")
+        return None
+    return {**msg, "outbox_id": entry_id}
+
+async def _replay_outbox():
+    """Re-send what dead workers left pending, then retry failures as their backoff expires."""
+    try:
+        recovered = await run_in_threadpool(outbox.recover)
+        if recovered:
+            print(f"📬 Outbox: replaying {recovered} message(s) left in flight")
+    except Exception as e:
+        print("⚠️ Outbox recovery failed:", str(e))
+    last_purge = 0.0
+    while True:
+        try:
+            for entry_id, to, msg in await run_in_threadpool(outbox.claim_due):
+                msg = {**msg, "outbox_id": entry_id}
+                if not outbound.submit(_from_number(msg), to, msg):
+                    try:
+                        await _deliver_queued(to, msg)
+                    except Exception:
+                        pass  # already recorded by _settle
+            if time.monotonic() - last_purge > 3600:
+                await run_in_threadpool(outbox.purge)
+                last_purge = time.monotonic()
+        except Exception as e:
+            print("⚠️ Outbox replay failed:", str(e))
+        await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+def _send(to, msg, key=None):
+    # Queued when the outbound workers are running (the webhook returns
+    # before Graph is called); inline otherwise (scripts, tests).
+    msg = _outboxed(to, msg, key)
+    if msg is None:
+        return
+    if outbound.submit(_from_number(msg), to, msg):
+        return
+    try:
+        _deliver_sync(to, msg)
+    except Exception as e:
+        _settle(msg, e)
+        label = "vídeo " if msg["type"] == "video" else ""
+        print(f"❌ Erro ao enviar {label}via Meta:", str(e))
+        return
+    _settle(msg)
+
+def send_message(to, body, key=None):
+    """
+    Envia mensagem de texto via WhatsApp Cloud API (Meta).
+    Aceita 'to' como "whatsapp:+55119..." ou "+55119..." ou "55119...".
+    'key' (opcional) evita reenviar a mesma mensagem, ex.: id do evento Stripe.
+    Durante um comando do webhook, as respostas são juntadas numa só mensagem.
+    """
+    commands.note_send()
+    batch = replies.current()
+    if batch is not None and key is None:
+        batch.add(to, body)
+        return
+    _send(to, {"type": "text", "body": body}, key)
+
+async def send_message_async(to, body, key=None):
+    """Same as send_message, for async handlers (never blocks the loop)."""
+    # The outbox write is a SQLite commit: keep it off the event loop
+    msg = await run_in_threadpool(_outboxed, to, {"type": "text", "body": body}, key)
+    if msg is None or outbound.submit(_from_number(msg), to, msg):
+        return
+    try:
+        await _deliver_queued(to, msg)
+    except Exception as e:
+        print("❌ Erro ao enviar via Meta:", str(e))
 
-def render_list_page(doc_id, items, title="Sua Listinha", updated_at="", show_footer=True, mode="normal"):
+def send_video(to, video_url, caption="", file=None):
+    """
+    Envia um pequeno vídeo via WhatsApp Cloud API.
+    'video_url' deve ser HTTPS público (ex.: https://.../static/listinha-demo.mp4)
+    'file' (opcional) é o mesmo vídeo em disco: é enviado à Meta uma vez e
+    reutilizado pelo media id (ver media.py); o link fica como reserva.
+    """
+    commands.note_send()
+    batch = replies.current()
+    if batch is not None:
+        batch.flush(to)  # texts collected so far go out before the video
+    msg = {"type": "video", "link": video_url, "caption": caption}
+    if file:
+        msg.update(file=file, mime="video/mp4")
+    _send(to, msg)
+
+def render_list_page(doc_id, items, title="Sua Listinha", updated_at="", show_footer=True, mode="normal",
+                     count=None, start=1, next_url=""):
     with open("templates/list.html", encoding="utf-8") as f:
         html = f.read()
     template = Template(html)
@@ -248,7 +475,9 @@ def render_list_page(doc_id, items, title="Sua Listinha", updated_at="", show_fo
     return template.render(
         doc_id=doc_id_encoded,
         items=items,
-        count=len(items),
+        count=len(items) if count is None else count,
+        start=start,
+        next_url=next_url,
         title=title,
         updated_at=updated_at,
         show_footer=show_footer,
@@ -256,45 +485,26 @@ def render_list_page(doc_id, items, title="Sua Listinha", updated_at="", show_fo
         mode=mode
     )
 
-def normalize_text(s: str) -> str:
-    """
-    Lowercase, remove accents/diacritics, and collapse inner spaces.
-    Ex.: '  PÃO   de   Açúcar  ' -> 'pao de acucar'
-    """
-    if not s:
-        return ""
-    # NFD split + remove combining marks (accents)
-    s = unicodedata.normalize("NFD", s)
-    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
-    # lowercase + collapse whitespace
-    s = " ".join(s.lower().split())
-    return s
-
 def _send_current_list(from_number: str, phone: str) -> None:
     """Send the current list view (same behavior as /v) right after a change."""
-    raw_items = get_items(phone)  # already A→Z
-    items = [entry["item"] if isinstance(entry, dict) and "item" in entry else str(entry) for entry in raw_items]
-
-    # Save snapshot for numbered deletes
-    save_view_snapshot(phone, items)
-
     # Build doc id & fetch title
-    group = get_user_group(phone)
     raw_doc_id = current_doc_id(phone)
+    data = get_list_doc(raw_doc_id) or {}
+    title = data.get("title") or "Sua Listinha"
 
-    # Title fallback
-    title = "Sua Listinha"
-    try:
-        ref = firestore.client().collection("listas").document(raw_doc_id)
-        doc = ref.get()
-        if doc.exists:
-            data = doc.to_dict() or {}
-            title = data.get("title") or title
-    except Exception:
-        pass
+    # Large subcollection lists go out as a PDF link; don't read every item for it
+    if is_paged_list(data) and list_item_count(data) > 20:
+        save_view_snapshot(phone, raw_doc_id, None, count=list_item_count(data))
+        items = None
+    else:
+        raw_items = get_items(phone)  # already A→Z
+        items = [entry["item"] if isinstance(entry, dict) and "item" in entry else str(entry) for entry in raw_items]
+
+        # Save snapshot for numbered deletes
+        save_view_snapshot(phone, raw_doc_id, items)
 
     # If many items, send PDF link; else bullets
-    if len(items) > 20:
+    if items is None or len(items) > 20:
         timestamp = int(time.time())
         doc_id = quote(raw_doc_id, safe="")
         pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&footer=true&&t={timestamp}"
@@ -304,25 +514,14 @@ def _send_current_list(from_number: str, phone: str) -> None:
 
 def _send_people_list(from_number: str, phone: str) -> None:
     """Send the numbered people list with local phone format (no +55)."""
-    group = get_user_group(phone)
-
-    users_ref = firestore.client().collection("users")
-    same_list_users = (
-        users_ref
-        .where("group.owner", "==", group["owner"])
-        .where("group.list", "==", group["list"])
-        .where("group.instance", "==", group.get("instance", "default"))
-        .stream()
-    )
+    # Member index on the list doc (one read) instead of querying users
+    same_list_users = get_list_members(current_doc_id(phone))
 
     members = []
-    for udoc in same_list_users:
-        data = udoc.to_dict() or {}
-        grp = data.get("group", {})
-        name = (data.get("name") or "").strip()
-        phone_e164 = udoc.id  # ex.: +55119...
+    for phone_e164, info in same_list_users.items():  # ex.: +55119...
+        name = (info.get("name") or "").strip()
 
-        is_owner = (grp.get("role") == "admin" and grp.get("owner") == group["owner"])
+        is_owner = info.get("role") == "admin"
 
         # display phone without +55
         phone_display = br_local_number(phone_e164)
@@ -345,16 +544,32 @@ def unified_view(
     format: str = Query("html"),               # "html" ou "pdf"
     footer: str = Query("false"),
     download: str = Query("false"),
-    mode: str = Query("normal")                # "normal" ou "vc"
+    mode: str = Query("normal"),               # "normal" ou "vc"
+    after: str = Query(""),                    # cursor da próxima página (listas em subcoleção)
+    start: int = Query(1),
 ):
-    ref = firestore.client().collection("listas").document(g)
-    doc = ref.get()
-    if not doc.exists:
+    data = get_list_doc(g)
+    if data is None:
         return HTMLResponse("❌ Lista não encontrada.")
 
-    data = doc.to_dict()
     title = data.get("title", "Sua Listinha")
 
+    # Subcollection lists: the HTML view reads one page at a time; the PDF has everything
+    order = "created_at" if mode == "vc" else "sort_key"
+    page_limit = ITEMS_PAGE_SIZE if (is_paged_list(data) and format != "pdf") else None
+    cursor = None
+    if after:
+        try:
+            cursor = float(after) if order == "created_at" else bytes.fromhex(after)
+        except ValueError:
+            cursor = None
+    entries, next_cursor = get_list_entries(g, data, limit=page_limit, after=cursor, order=order)
+    next_url = ""
+    if next_cursor is not None:
+        nxt = next_cursor.hex() if isinstance(next_cursor, bytes) else str(next_cursor)
+        next_url = f"/view?g={quote(g, safe='')}&mode={mode}&footer={footer}&after={nxt}&start={start + len(entries)}"
+    page_args = {"count": list_item_count(data), "start": start, "next_url": next_url}
+
     show_footer = footer.lower() == "true"
     sao_paulo = pytz.timezone("America/Sao_Paulo")
     updated_at = datetime.now(sao_paulo).strftime("Atualizado em: %d/%m/%Y às %H:%M") if show_footer else ""
@@ -366,25 +581,17 @@ def unified_view(
         except ValueError:
             return HTMLResponse("❌ ID de documento inválido.")
 
-        # Busca todos os usuários da mesma listinha
-        users_ref = firestore.client().collection("users")
-        same_list_users = (
-            users_ref
-            .where("group.owner", "==", owner)
-            .where("group.list", "==", list_name)
-            .where("group.instance", "==", instance_id)
-            .stream()
-        )
+        # Todos os usuários da mesma listinha (índice de membros no doc da lista)
+        same_list_users = get_list_members(g)
 
         # Mapeia várias variantes do telefone → nome
         phone_name_map = {}
-        for udoc in same_list_users:
-            data_u = udoc.to_dict() or {}
-            name = (data_u.get("name") or "").strip()
+        for member_phone, info in same_list_users.items():
+            name = (info.get("name") or "").strip()
             if not name:
                 continue  # sem nome, não ajuda no display
 
-            raw = (udoc.id or "").strip()  # ex.: "+5511999999999"
+            raw = (member_phone or "").strip()  # ex.: "+5511999999999"
             variants = set()
             if raw:
                 variants.add(raw)
@@ -438,7 +645,7 @@ def unified_view(
 
         # Monta itens com nome (ou telefone se não houver nome)
         items = []
-        for i in data.get("itens", []):
+        for i in entries:
             if not (isinstance(i, dict) and all(k in i for k in ("item", "user", "timestamp"))):
                 continue
             display_user = resolve_user_display(i["user"])
@@ -447,22 +654,23 @@ def unified_view(
             )
 
         html_content = render_list_page(
-            g, items, title=title, updated_at=updated_at, show_footer=show_footer, mode="vc"
+            g, items, title=title, updated_at=updated_at, show_footer=show_footer, mode="vc", **page_args
         )
 
     else:
         # Modo normal (bullet list)
         items = sorted(
-            [i for i in data.get("itens", []) if isinstance(i, dict) and "item" in i],
-            key=lambda x: collator.getSortKey(x["item"])
+            [i for i in entries if isinstance(i, dict) and "item" in i],
+            key=lambda x: sort_key(x["item"])
         )
 
         html_content = render_list_page(
-            g, items, title=title, updated_at=updated_at, show_footer=show_footer, mode="normal"
+            g, items, title=title, updated_at=updated_at, show_footer=show_footer, mode="normal", **page_args
         )
 
     # PDF output
     if format == "pdf":
+        weasyprint = lazy.load("weasyprint")
         pdf = weasyprint.HTML(string=html_content).write_pdf()
         return Response(
             content=pdf,
@@ -527,6 +735,122 @@ async def whatsapp_webhook(request: Request):
         print("❌ Payload inválido (não-JSON) no /webhook")
         return {"status": "ok"}
 
+    # Meta may batch several messages in one delivery: handle every one of
+    # them, senders concurrently, each sender's messages in order.
+    payloads = inbound.split_messages(body)
+    received, senders = len(payloads), len(inbound.by_sender(payloads))
+    # Redeliveries (Meta retries when we're slow) are acknowledged without work
+    if inbound.INBOUND_DEDUPE in ("sqlite", "firestore"):
+        fresh = await run_in_threadpool(lambda: [p for p in payloads if inbound.first_delivery(p)])
+    else:
+        fresh = [p for p in payloads if inbound.first_delivery(p)]
+    if len(fresh) < len(payloads):
+        print(f"↩️ Webhook: {len(payloads) - len(fresh)} mensagem(ns) repetida(s) ignorada(s)")
+    payloads = fresh
+    groups = inbound.by_sender(payloads)
+    # What Meta sent (before dedupe), so batch sizes reflect real deliveries
+    inbound.record_batch(received, senders, duplicates=received - len(payloads))
+    if len(payloads) > 1:
+        print(f"📥 Webhook batch: {len(payloads)} mensagens de {len(groups)} remetente(s)")
+    results = await asyncio.gather(*(_handle_sender_messages(group) for group in groups), return_exceptions=True)
+    for group, result in zip(groups, results):
+        if isinstance(result, BaseException):
+            print(f"❌ Erro processando mensagens de {inbound.sender_of(group[0])}:", repr(result))
+    return {"status": "ok"}
+
+async def _handle_sender_messages(payloads: list[dict]):
+    for payload in payloads:
+        await _handle_message(payload)
+
+async def _handle_message(payload: dict):
+    # One shared copy of users/{phone} and the list for the whole command.
+    # The docs are awaited up front; the command itself runs in the threadpool
+    # so its remaining Firestore/HTTP calls never block the event loop.
+    ok = False
+    try:
+        with request_context("webhook") as ctx:
+            sender, targets = _prefetch_phones(payload)
+            if sender:
+                try:
+                    await firebase_async.prefetch(sender, targets)
+                except Exception as e:
+                    print("⚠️ Firestore prefetch error:", str(e))
+            lock_key = _list_lock_key(payload, sender)
+            if lock_key is None:
+                result = await run_in_threadpool(_handle_with_replies, payload)
+            else:
+                # /i, /a, /l on the same list run one at a time (see listlock.py)
+                async with list_lock.hold(lock_key) as waited_ms:
+                    if waited_ms:
+                        # Another command changed the list while we waited: drop the prefetched copy
+                        ctx.docs.pop(f"listas/{lock_key}", None)
+                    result = await run_in_threadpool(_handle_with_replies, payload)
+        print(f"📊 Firestore {ctx.summary()}")
+        ok = (result or {}).get("status") != "error"
+        return result
+    finally:
+        # Done → redeliveries are skipped; failed → the claim is released so a redelivery runs it
+        if inbound.INBOUND_DEDUPE in ("sqlite", "firestore"):
+            await run_in_threadpool(inbound.finished, payload, ok)
+        else:
+            inbound.finished(payload, ok)
+
+def _list_lock_key(body: dict, phone: str) -> str | None:
+    """doc_id of the sender's list when the payload is a list-mutating command."""
+    if not LIST_LOCK or not phone:
+        return None
+    try:
+        value = ((body.get("entry") or [{}])[0].get("changes") or [{}])[0].get("value") or {}
+        msg = (value.get("messages") or [None])[0] or {}
+    except Exception:
+        return None
+    parts = ((msg.get("text") or {}).get("body", "") or "").strip().split(maxsplit=1)
+    spec = commands.lookup("/" + parts[0].lower()) if parts else None
+    if spec is None or not spec.locks_list:
+        return None
+    found, user = _lookup_cached("users", phone)  # prefetched above: no I/O on the loop
+    group = (user or {}).get("group") if found else None
+    return list_doc_id(group) if group and group.get("owner") else None
+
+def _prefetch_phones(body: dict) -> tuple[str, tuple[str, ...]]:
+    """Sender phone and the other users (/u, /e, /t) a payload will touch."""
+    try:
+        value = ((body.get("entry") or [{}])[0].get("changes") or [{}])[0].get("value") or {}
+        msg = (value.get("messages") or [None])[0]
+    except Exception:
+        return "", ()
+    if not msg or not msg.get("from"):
+        return "", ()
+    phone = "+" + str(msg.get("from")).strip()
+    parts = ((msg.get("text") or {}).get("body", "") or "").strip().split(maxsplit=1)
+    if len(parts) < 2 or parts[0].lower() not in ("u", "e", "t"):
+        return phone, ()
+    raw = parts[1].split(maxsplit=1)[0] if parts[0].lower() == "u" else parts[1]
+    target = normalize_phone(raw, phone)
+    return phone, ((target,) if target else ())
+
+def _send_text(to, body):
+    _send(to, {"type": "text", "body": body})
+
+def _receiving_number(body: dict) -> str:
+    """phone_number_id the payload was delivered to (our number that must answer)."""
+    try:
+        value = ((body.get("entry") or [{}])[0].get("changes") or [{}])[0].get("value") or {}
+        return str((value.get("metadata") or {}).get("phone_number_id") or "").strip()
+    except Exception:
+        return ""
+
+def _handle_with_replies(body: dict):
+    """Handle one inbound payload, sending its replies as one message per recipient."""
+    token = _sender_number.set(_receiving_number(body) or None)
+    try:
+        with replies.collect(_send_text):
+            return _handle_whatsapp_payload(body)
+    finally:
+        _sender_number.reset(token)
+
+def _handle_whatsapp_payload(body: dict):
+
     # Estrutura Meta: entry[0].changes[0].value.messages[0]
     try:
         entry = (body.get("entry") or [])[0]
@@ -563,519 +887,491 @@ async def whatsapp_webhook(request: Request):
 
         phone = from_number.replace("whatsapp:", "")
 
-        # LISTINHA commands
-
-        if cmd == "/listinha":
-            raw = (arg or "").strip()
-            # Keep quotes, but normalize capitalization of first letter as a courtesy
-            name = raw.strip('"').strip()[:20]
-            if name:
-                name = name.capitalize()
-
-            if not name:
-                send_message(from_number, NAMELESS_OPENING)
-                return {"status": "ok"}
-
-            if user_in_list(phone):
-                send_message(from_number, ALREADY_IN_LIST)
-            else:
-                # --- Internal free trial (no Stripe) ---
-                now = int(time.time())
-                # allow fractional days for testing, e.g., 0.0035 ≈ 5 minutes
-                try:
-                    trial_days = float(os.getenv("TRIAL_DAYS_DEFAULT", "30"))
-                except Exception:
-                    trial_days = 30.0
-                trial_end = now + int(trial_days * 24 * 3600)
-
-                update_user_billing(phone, {
-                    "trial_end": trial_end,
-                    "stripe_status": "TRIALING",  # informational only for admin
-                    "last_updated": now
-                })
-
-                # Create the list and set the user as Dono (first time, not transfer)
-                # NOTE: uses the existing `instance_id` from the webhook context
-                create_new_list(phone, instance_id, name)
-
-                # Welcome message (first-time owner)
-                send_message(
-                    from_number,
-                    f"Bem-vindo à Listinha, {name}. 🎁 Sua assinatura de teste de *30 dias* foi ativada! "
-                    "Aproveite a Listinha à vontade nesse período."
-                )
-
-                # Optional: immediately show the (current) list
-                _send_current_list(from_number, phone)
-
-            return {"status": "ok"}
-
-        # Check if user exists before other commands
-        if not user_in_list(phone):
-            send_message(from_number, NOT_IN_LIST)
-            return {"status": "ok"}
-
-        # Add item to list (i <text>)
-        if cmd == "/i" and arg:
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            added = add_item(phone, arg)
-            if added:
-                send_message(from_number, item_added_log(arg))
-                print(f"✅ Item adicionado: {arg}")
-                # (1) Show updated list right after action
-                _send_current_list(from_number, phone)
-            else:
-                send_message(from_number, item_already_exists(arg))
-            return {"status": "ok"}
-
-        # Delete item: a <número | texto>
-        if cmd == "/a" and arg:
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            wanted = arg.strip()
-
-            # If it's a number, resolve via last snapshot (no race with live reordering)
-            if wanted.isdigit():
-                idx = int(wanted)
-
-                snap = load_view_snapshot(phone)
-                snap_items = snap.get("items")
-                snap_doc_id = snap.get("doc_id")
-                snap_ts = snap.get("ts_epoch")
-
-                if not (snap_items and snapshot_is_fresh(snap_ts) and snap_doc_id == current_doc_id(phone)):
-                    send_message(from_number, NEED_REFRESH_VIEW)
-                    return {"status": "ok"}
-
-                if idx < 1 or idx > len(snap_items):
-                    send_message(from_number, item_index_invalid(idx, len(snap_items)))
-                    return {"status": "ok"}
-
-                canonical = snap_items[idx - 1]
-                delete_item(phone, canonical)
-                send_message(from_number, item_removed(canonical))
-                # (1) Show updated list right after action
-                _send_current_list(from_number, phone)
-                return {"status": "ok"}
-
-            # Otherwise fall back to text delete (accent-insensitive)
-            items = get_items(phone) or []
-
-            def _norm(s: str) -> str:
-                return normalize_text(s)  # your existing normalizer
-
-            match_text = None
-            for txt in items:
-                if _norm(txt) == _norm(wanted):
-                    match_text = txt
-                    break
-
-            if not match_text:
-                send_message(from_number, item_not_found(wanted))
+        ctx = current_context()
+        if ctx is not None:
+            ctx.label = cmd
+
+        # Command registry (see commands.py and the @command handlers below)
+        spec = commands.lookup(cmd)
+        if spec is not None and spec.requires_arg and not arg:
+            spec = None  # e.g. "i" with nothing after it
+        with commands.measure(spec.name if spec else "unknown", ctx):
+            # Check if user exists before other commands
+            if (spec is None or spec.needs_list) and not user_in_list(phone):
+                send_message(from_number, NOT_IN_LIST)
                 return {"status": "ok"}
 
-            delete_item(phone, match_text)
-            send_message(from_number, item_removed(match_text))
-            # (1) Show updated list right after action
-            _send_current_list(from_number, phone)
-            return {"status": "ok"}
-
-        # Add new user (u <phone> [name])
-        if cmd == "/u":
-            # Requer telefone + nome
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            if not arg:
-                send_message(from_number, ADD_USER_USAGE)
-                return {"status": "ok"}
-
-            parts = arg.strip().split(maxsplit=1)
-            if len(parts) < 2 or not parts[1].strip():
-                send_message(from_number, ADD_USER_USAGE)
-                return {"status": "ok"}
-
-            phone_part, name_raw = parts[0], parts[1].strip()
-            # (5) Capitalize first letter of user's name
-            name = name_raw[:20].capitalize()
-
-            target_phone = normalize_phone(phone_part, phone)
-            if not target_phone:
-                send_message(from_number, INVALID_NUMBER)
+            if spec is None:
+                # ✅ Fallback for unknown commands
+                send_message(from_number, UNKNOWN_COMMAND)
                 return {"status": "ok"}
 
-            if not is_admin(phone):
-                send_message(from_number, NOT_ADMIN)
+            if spec.gated and _gate_if_needed(spec.name, phone):
                 return {"status": "ok"}
-
-            success, status = add_user_to_list(phone, target_phone, name=name)
-            if success:
-                # Confirma ao dono
-                send_message(from_number, guest_added(name, target_phone))
-
-                # Dá boas-vindas ao convidado com o nome do dono (se existir)
-                admin_data = firestore.client().collection("users").document(phone).get().to_dict()
-                admin_name = (admin_data or {}).get("name", "").strip()
-                admin_display_name = f"*{admin_name}*" if admin_name else phone
-
-                send_message(f"whatsapp:{target_phone}", WELCOME_MESSAGE(name, admin_display_name))
-
-                # (3) Show updated people list
-                _send_people_list(from_number, phone)
-
-            elif status == "already_in_list":
-                send_message(from_number, guest_already_in_other_list(target_phone))
-
-            return {"status": "ok"}
-
-        # Remove user (admin): e <phone>
-        if cmd == "/e" and arg:
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            target_phone = normalize_phone(arg, phone)
-            if not target_phone:
-                send_message(from_number, INVALID_NUMBER)
-                return {"status": "ok"}
-
-            if not is_admin(phone):
-                send_message(from_number, NOT_OWNER_CANNOT_REMOVE)
-                return {"status": "ok"}
-
-            # Fetch name BEFORE removal to display later
-            tdoc = firestore.client().collection("users").document(target_phone).get()
-            tname = ""
-            if tdoc.exists:
-                tname = (tdoc.to_dict() or {}).get("name", "").strip()
-
-            if remove_user_from_list(phone, target_phone):
-                # (6) confirm to admin with number and name
-                send_message(from_number, guest_removed(tname, target_phone))
-
-                # notify removed user with admin display name
-                admin_data = firestore.client().collection("users").document(phone).get().to_dict()
-                admin_name = (admin_data or {}).get("name", "").strip()
-                admin_display_name = f"*{admin_name}*" if admin_name else phone
-
-                send_message(f"whatsapp:{target_phone}", REMOVED_FROM_LIST(admin_display_name))
-
-                # (3) Show updated people list
-                _send_people_list(from_number, phone)
-            else:
-                send_message(from_number, not_a_member(target_phone))
-            return {"status": "ok"}
-
-        # Self-remove: s <your phone>
-        if cmd == "/s":
-            if not arg:
-                send_message(from_number, SELF_EXIT_INSTRUCTION)
-                return {"status": "ok"}
-
-            target_phone = normalize_phone(arg, phone)
-            if not target_phone:
-                send_message(from_number, INVALID_NUMBER)
-                return {"status": "ok"}
-
-            if target_phone != phone:
-                send_message(from_number, INVALID_SELF_EXIT)
+            if spec.admin_only and not is_admin(phone):
+                send_message(from_number, spec.admin_only)
                 return {"status": "ok"}
 
-            # Get group BEFORE removal so we know the owner to notify
-            group = get_user_group(phone) or {}
-            owner_phone = group.get("owner")
+            spec.handler(from_number, phone, arg, instance_id)
+        return {"status": "ok"}
 
-            if remove_self_from_list(phone):
-                # tell the leaver
-                send_message(from_number, LEFT_LIST)
+    except Exception as e:
+        print("❌ Erro processando webhook da Meta:", str(e))
+        return {"status": "error"}  # Meta still gets 200; this releases the dedupe claim
 
-                # politely notify the owner (if exists and not the same as the leaver)
-                if owner_phone and owner_phone != phone:
-                    # Try to show the leaver's saved name; fallback to phone
-                    user_doc = firestore.client().collection("users").document(phone).get()
-                    user_data = (user_doc.to_dict() or {}) if user_doc.exists else {}
-                    leaver_name = (user_data.get("name") or "").strip()
-                    leaver_display = f"*{leaver_name}*" if leaver_name else phone
+# ---------- WhatsApp commands ----------
 
-                    send_message(f"whatsapp:{owner_phone}", MEMBER_LEFT_NOTIFICATION(leaver_display))
-            else:
-                send_message(from_number, CANNOT_EXIT_AS_ADMIN)
+# LISTINHA commands
+@command("/listinha", needs_list=False)
+def _cmd_listinha(from_number, phone, arg, instance_id):
+    raw = (arg or "").strip()
+    # Keep quotes, but normalize capitalization of first letter as a courtesy
+    name = raw.strip('"').strip()[:20]
+    if name:
+        name = name.capitalize()
 
-            return {"status": "ok"}
+    if not name:
+        send_message(from_number, NAMELESS_OPENING)
+        return
 
-        # Transfer admin role: t <phone>
-        if cmd == "/t" and arg:
+    if user_in_list(phone):
+        send_message(from_number, ALREADY_IN_LIST)
+    else:
+        # --- Internal free trial (no Stripe) ---
+        now = int(time.time())
+        # allow fractional days for testing, e.g., 0.0035 ≈ 5 minutes
+        try:
+            trial_days = float(os.getenv("TRIAL_DAYS_DEFAULT", "30"))
+        except Exception:
+            trial_days = 30.0
+        trial_end = now + int(trial_days * 24 * 3600)
 
-            target_phone = normalize_phone(arg, phone)
-            if not target_phone:
-                send_message(from_number, INVALID_NUMBER)
-                return {"status": "ok"}
-            if not is_admin(phone):
-                send_message(from_number, NOT_OWNER_CANNOT_TRANSFER)
-                return {"status": "ok"}
-            if propose_admin_transfer(phone, target_phone):
-                send_message(from_number, transfer_proposed(target_phone))
-                send_message(f"whatsapp:{target_phone}", TRANSFER_RECEIVED)
-            else:
-                send_message(from_number, not_a_guest(target_phone))
-            return {"status": "ok"}
+        trial = {
+            "trial_end": trial_end,
+            "stripe_status": "TRIALING",  # informational only for admin
+            "last_updated": now
+        }
 
-        # Accept admin role: o
-        if cmd == "/o":
-            result = accept_admin_transfer(phone)
-            if result:
-                from_phone = result["from"]  # now returns a dict instead of just True
-                send_message(from_number, TRANSFER_ACCEPTED)
-                send_message(from_phone, TRANSFER_PREVIOUS_OWNER)
-            else:
-                send_message(from_number, NO_PENDING_TRANSFER)
-            return {"status": "ok"}
+        # Create the list and set the user as Dono (first time, not transfer),
+        # with the trial billing in the same batch
+        # NOTE: uses the existing `instance_id` from the webhook context
+        create_new_list(phone, instance_id, name, billing=trial)
 
-        # Admin can define custom list title: r <title>
-        if cmd == "/r" and arg:
-            if not is_admin(phone):
-                send_message(from_number, NOT_OWNER_CANNOT_RENAME)
-                return {"status": "ok"}
+        # Welcome message (first-time owner)
+        send_message(
+            from_number,
+            f"Bem-vindo à Listinha, {name}. 🎁 Sua assinatura de teste de *30 dias* foi ativada! "
+            "Aproveite a Listinha à vontade nesse período."
+        )
 
-            group = get_user_group(phone)
-            doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-            ref = firestore.client().collection("listas").document(doc_id)
-            new_title = arg.strip().capitalize()
-            ref.update({"title": new_title})
-            send_message(from_number, list_title_updated(new_title))
-            # (2) Show list with new title
+        # Optional: immediately show the (current) list
+        _send_current_list(from_number, phone)
+
+# Add item to list (i <text>); several at once: "i arroz, feijão, leite" or one per line
+@command("/i", requires_arg=True, gated=True, locks_list=True)
+def _cmd_add_item(from_number, phone, arg, instance_id):
+    names = _split_items(arg)
+    if len(names) > 1:
+        added, existing = add_items(phone, names)
+        send_message(from_number, items_added(added, existing))
+        print(f"✅ {len(added)} itens adicionados ({len(existing)} já existiam)")
+        if added:
             _send_current_list(from_number, phone)
-            return {"status": "ok"}
-
-        # Menu
-        MENU_ALIASES = {"/m", "/menu", "/instruções", "/opções", "/?"}  # removed ajuda/help
-        if cmd in MENU_ALIASES:
-            send_message(from_number, MENU_TEXT)
-            return {"status": "ok"}
-
-        # Help text
-        HELP_ALIASES = {"/h", "/ajuda", "/help"}
-        if cmd in HELP_ALIASES:
-            send_message(from_number, HELP_TEXT)
-            return {"status": "ok"}
-
-        # Consultar pessoas na lista: p (all) — numbered, no +55
-        if cmd == "/p":
-            _send_people_list(from_number, phone)
-            return {"status": "ok"}
-
-        # View list
-        if cmd == "/v":
-            raw_items = get_items(phone)  # already A→Z
-            items = [entry["item"] if isinstance(entry, dict) and "item" in entry else str(entry) for entry in
-                     raw_items]
-
-            # Save the snapshot the user will see now
-            save_view_snapshot(phone, items)
-
-            # Build doc id for links and fetch title (same as you already do)
-            group = get_user_group(phone)
-            raw_doc_id = current_doc_id(phone)
-            doc_id = quote(raw_doc_id, safe="")
-
-            # Title fallback
-            title = "Sua Listinha"
-            try:
-                ref = firestore.client().collection("listas").document(raw_doc_id)
-                doc = ref.get()
-                if doc.exists:
-                    data = doc.to_dict() or {}
-                    title = data.get("title") or title
-            except Exception:
-                pass
-
-            # Short vs PDF (unchanged)
-            if len(items) > 20:
-                timestamp = int(time.time())
-                pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&footer=true&&t={timestamp}"
-                send_message(from_number, list_download_url(pdf_url))
-            else:
-                send_message(from_number, list_shown(title, items))
-            return {"status": "ok"}
+        return
+
+    name = names[0] if names else arg  # "i arroz," → "arroz"
+    added = add_item(phone, name)
+    if added:
+        send_message(from_number, item_added_log(name))
+        print(f"✅ Item adicionado: {name}")
+        # (1) Show updated list right after action
+        _send_current_list(from_number, phone)
+    else:
+        send_message(from_number, item_already_exists(name))
+
+# Delete item: a <número | texto>; several at once: "a 1,3,5-9" or "a leite, pão"
+@command("/a", requires_arg=True, gated=True, locks_list=True)
+def _cmd_delete_item(from_number, phone, arg, instance_id):
+    wanted = arg.strip()
+
+    # Numbers/ranges: resolve via last snapshot (no race with live reordering)
+    ranges = _parse_positions(wanted)
+    if ranges is not None:
+        snap = load_view_snapshot(phone) or {}
+        snap_items = snap.get("items")
+        snap_doc_id = snap.get("doc_id")
+        snap_ts = snap.get("ts_epoch")
+        snap_count = snap.get("count") if snap.get("paged") else len(snap_items or [])
+
+        if not (snap_count and snapshot_is_fresh(snap_ts) and snap_doc_id == current_doc_id(phone)):
+            send_message(from_number, NEED_REFRESH_VIEW)
+            return
+
+        for lo, hi in ranges:
+            if lo < 1 or hi > snap_count:
+                send_message(from_number, item_index_invalid(lo if lo < 1 else hi, snap_count))
+                return
+        positions = list(dict.fromkeys(i for lo, hi in ranges for i in range(lo, hi + 1)))
+
+        # Large subcollection lists: numbers refer to the A→Z positions shown in the PDF
+        if snap.get("paged"):
+            names = get_items_at(snap_doc_id, positions)
+        else:
+            names = [snap_items[i - 1] for i in positions]
+        if not all(names):
+            send_message(from_number, NEED_REFRESH_VIEW)
+            return
+        if len(names) == 1:
+            delete_item(phone, names[0])
+            send_message(from_number, item_removed(names[0]))
+        else:
+            removed = delete_items(phone, names)
+            send_message(from_number, items_removed(removed, [n for n in names if n not in removed]))
+        # (1) Show updated list right after action
+        _send_current_list(from_number, phone)
+        return
+
+    # Several names: matched together and removed in one write
+    names = _split_items(wanted)
+    if len(names) > 1:
+        matches = find_items(phone, names)
+        removed = delete_items(phone, [m for m in matches if m])
+        send_message(from_number, items_removed(removed, [w for w, m in zip(names, matches) if not m]))
+        if removed:
+            _send_current_list(from_number, phone)
+        return
+
+    # Otherwise fall back to text delete (accent-insensitive)
+    wanted = names[0] if names else wanted  # "a arroz," → "arroz"
+    match_text = find_item(phone, wanted)
+
+    if not match_text:
+        send_message(from_number, item_not_found(wanted))
+        return
+
+    delete_item(phone, match_text)
+    send_message(from_number, item_removed(match_text))
+    # (1) Show updated list right after action
+    _send_current_list(from_number, phone)
+
+# Add new user (u <phone> [name])
+@command("/u", gated=True, admin_only=NOT_ADMIN)
+def _cmd_add_user(from_number, phone, arg, instance_id):
+    # Requer telefone + nome
+    if not arg:
+        send_message(from_number, ADD_USER_USAGE)
+        return
+
+    parts = arg.strip().split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        send_message(from_number, ADD_USER_USAGE)
+        return
+
+    phone_part, name_raw = parts[0], parts[1].strip()
+    # (5) Capitalize first letter of user's name
+    name = name_raw[:20].capitalize()
+
+    target_phone = normalize_phone(phone_part, phone)
+    if not target_phone:
+        send_message(from_number, INVALID_NUMBER)
+        return
+
+    success, status = add_user_to_list(phone, target_phone, name=name)
+    if success:
+        # Confirma ao dono
+        send_message(from_number, guest_added(name, target_phone))
+
+        # Dá boas-vindas ao convidado com o nome do dono (se existir)
+        admin_data = get_user_doc(phone)
+        admin_name = (admin_data or {}).get("name", "").strip()
+        admin_display_name = f"*{admin_name}*" if admin_name else phone
+
+        send_message(f"whatsapp:{target_phone}", WELCOME_MESSAGE(name, admin_display_name))
+
+        # (3) Show updated people list
+        _send_people_list(from_number, phone)
+
+    elif status == "already_in_list":
+        send_message(from_number, guest_already_in_other_list(target_phone))
+
+# Remove user (admin): e <phone>
+@command("/e", requires_arg=True, gated=True, admin_only=NOT_OWNER_CANNOT_REMOVE)
+def _cmd_remove_user(from_number, phone, arg, instance_id):
+    target_phone = normalize_phone(arg, phone)
+    if not target_phone:
+        send_message(from_number, INVALID_NUMBER)
+        return
+
+    # Fetch name BEFORE removal to display later
+    tdata = get_user_doc(target_phone)
+    tname = ""
+    if tdata is not None:
+        tname = (tdata.get("name") or "").strip()
+
+    if remove_user_from_list(phone, target_phone):
+        # (6) confirm to admin with number and name
+        send_message(from_number, guest_removed(tname, target_phone))
+
+        # notify removed user with admin display name
+        admin_data = get_user_doc(phone)
+        admin_name = (admin_data or {}).get("name", "").strip()
+        admin_display_name = f"*{admin_name}*" if admin_name else phone
+
+        send_message(f"whatsapp:{target_phone}", REMOVED_FROM_LIST(admin_display_name))
+
+        # (3) Show updated people list
+        _send_people_list(from_number, phone)
+    else:
+        send_message(from_number, not_a_member(target_phone))
 
-        # Download PDF: d
-        if cmd == "/d":
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            group = get_user_group(phone)
-            raw_doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-            doc_id = quote(raw_doc_id, safe="")
+# Self-remove: s <your phone>
+@command("/s")
+def _cmd_self_exit(from_number, phone, arg, instance_id):
+    if not arg:
+        send_message(from_number, SELF_EXIT_INSTRUCTION)
+        return
 
-            # Optional: check if list has items
-            ref = firestore.client().collection("listas").document(raw_doc_id)
-            doc = ref.get()
-            count = len(doc.to_dict().get("itens", [])) if doc.exists else 0
+    target_phone = normalize_phone(arg, phone)
+    if not target_phone:
+        send_message(from_number, INVALID_NUMBER)
+        return
 
-            if count == 0:
-                send_message(from_number, LIST_EMPTY_PDF)
-            else:
-                timestamp = int(time.time())
-                pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&footer=true&&t={timestamp}"
-                send_message(from_number, list_download_url(pdf_url))
+    if target_phone != phone:
+        send_message(from_number, INVALID_SELF_EXIT)
+        return
 
-            return {"status": "ok"}
-
-        # Comando /x – PDF com colunas (produto, usuário, hora)
-        if cmd == "/x":
-            group = get_user_group(phone)
-            raw_doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
-            doc_id = quote(raw_doc_id, safe="")
-            timestamp = int(time.time())
+    # Get group BEFORE removal so we know the owner to notify
+    group = get_user_group(phone) or {}
+    owner_phone = group.get("owner")
 
-            pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&mode=vc&footer=true&t={timestamp}"
-            send_message(from_number, list_detailed_url(pdf_url))
-            return {"status": "ok"}
+    if remove_self_from_list(phone):
+        # tell the leaver
+        send_message(from_number, LEFT_LIST)
 
-        # Clear all items: l (admin only)
-        if cmd == "/l":
-            if _gate_if_needed(cmd, phone):
-                return {"status": "ok"}
-            if not is_admin(phone):
-                send_message(from_number, NOT_OWNER_CANNOT_CLEAR)
-                return {"status": "ok"}
+        # politely notify the owner (if exists and not the same as the leaver)
+        if owner_phone and owner_phone != phone:
+            # Try to show the leaver's saved name; fallback to phone
+            user_data = get_user_doc(phone) or {}
+            leaver_name = (user_data.get("name") or "").strip()
+            leaver_display = f"*{leaver_name}*" if leaver_name else phone
 
-            clear_items(phone)
-            send_message(from_number, LIST_CLEARED)
-            # (1) Show updated list right after action
-            _send_current_list(from_number, phone)
-            return {"status": "ok"}
-
-        if cmd == "/z":
-            # --- 0) Status & eligibility check ---
-            now = int(time.time())
-            b = get_user_billing(phone) or {}
-            state, _ = compute_status(b)  # uses trial_end/grace_until/stripe info
-
-            # A. If already paying or still within a free window, do NOT grant
-            #    Paying: ACTIVE
-            #    Free window: TRIAL or GRACE
-            if state in {"ACTIVE", "TRIAL", "GRACE"}:
-                send_message(from_number, "ℹ️ O bônus de 60 dias pode ser ativado após o fim do seu período de teste.")
-            else:
-                # B. Only after trial/without sub: EXPIRED / NONE / CANCELED can get the 60-day bonus
-                if b.get("z_bonus_used"):
-                    send_message(from_number, "⚠️ O bônus de 60 dias já foi utilizado nesta conta.")
-                else:
-                    # Allow fractional days for testing (e.g., Z_BONUS_DAYS_DEFAULT=0.0069 ≈ 10min)
-                    try:
-                        z_days = float(os.getenv("Z_BONUS_DAYS_DEFAULT", "60"))
-                    except Exception:
-                        z_days = 60.0
-                    grace_until = now + int(z_days * 24 * 3600)
-                    update_user_billing(phone, {
-                        "grace_until": grace_until,
-                        "z_bonus_used": True,
-                        "last_updated": now,
-                    })
-                    send_message(from_number, "🎁 Bônus aplicado: +60 dias liberados a partir de agora.")
-
-            # --- 1) Instruction message (keep your viral flow) ---
-            send_message(from_number, z_step1_instructions())
-
-            # --- 2) Ready-to-copy message + 3) Short demo video ---
-            full_text = indication_text(PUBLIC_DISPLAY_NUMBER)
-            demo_url = "https://listinha-t5ga.onrender.com/static/listinha-demo.mp4"
-            send_video(from_number, demo_url, caption=full_text)
+            send_message(f"whatsapp:{owner_phone}", MEMBER_LEFT_NOTIFICATION(leaver_display))
+    else:
+        send_message(from_number, CANNOT_EXIT_AS_ADMIN)
+
+# Transfer admin role: t <phone>
+@command("/t", requires_arg=True, admin_only=NOT_OWNER_CANNOT_TRANSFER)
+def _cmd_transfer_admin(from_number, phone, arg, instance_id):
+    target_phone = normalize_phone(arg, phone)
+    if not target_phone:
+        send_message(from_number, INVALID_NUMBER)
+        return
+    if propose_admin_transfer(phone, target_phone):
+        send_message(from_number, transfer_proposed(target_phone))
+        send_message(f"whatsapp:{target_phone}", TRANSFER_RECEIVED)
+    else:
+        send_message(from_number, not_a_guest(target_phone))
+
+# Accept admin role: o
+@command("/o")
+def _cmd_accept_admin(from_number, phone, arg, instance_id):
+    result = accept_admin_transfer(phone)
+    if result:
+        from_phone = result["from"]  # now returns a dict instead of just True
+        send_message(from_number, TRANSFER_ACCEPTED)
+        send_message(from_phone, TRANSFER_PREVIOUS_OWNER)
+    else:
+        send_message(from_number, NO_PENDING_TRANSFER)
+
+# Admin can define custom list title: r <title>
+@command("/r", requires_arg=True, admin_only=NOT_OWNER_CANNOT_RENAME)
+def _cmd_rename_list(from_number, phone, arg, instance_id):
+    new_title = arg.strip().capitalize()
+    set_list_title(phone, new_title)
+    send_message(from_number, list_title_updated(new_title))
+    # (2) Show list with new title
+    _send_current_list(from_number, phone)
+
+# Menu
+@command("/m", "/menu", "/instruções", "/opções", "/?")  # removed ajuda/help
+def _cmd_menu(from_number, phone, arg, instance_id):
+    send_message(from_number, MENU_TEXT)
+
+# Help text
+@command("/h", "/ajuda", "/help")
+def _cmd_help(from_number, phone, arg, instance_id):
+    send_message(from_number, HELP_TEXT)
+
+# Consultar pessoas na lista: p (all) — numbered, no +55
+@command("/p")
+def _cmd_people(from_number, phone, arg, instance_id):
+    _send_people_list(from_number, phone)
+
+# View list
+@command("/v")
+def _cmd_view(from_number, phone, arg, instance_id):
+    _send_current_list(from_number, phone)
+
+# Download PDF: d
+@command("/d", gated=True)
+def _cmd_download_pdf(from_number, phone, arg, instance_id):
+    group = get_user_group(phone)
+    raw_doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
+    doc_id = quote(raw_doc_id, safe="")
 
-            return {"status": "ok"}
+    # Optional: check if list has items
+    count = list_item_count(get_list_doc(raw_doc_id))
 
-        # Payment link (/c)
-        if cmd in ("/c", "c"):
-            # Read current billing state
-            b = get_user_billing(phone) or {}
-            state, _ = compute_status(b)
+    if count == 0:
+        send_message(from_number, LIST_EMPTY_PDF)
+    else:
+        timestamp = int(time.time())
+        pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&footer=true&&t={timestamp}"
+        send_message(from_number, list_download_url(pdf_url))
 
-            # If already active/trial/grace, don't sell again
-            if state in {"ACTIVE", "TRIAL", "GRACE"}:
-                try:
-                    # Send Billing Portal so the user can manage the existing sub
-                    portal_url = create_billing_portal_session(
-                        phone,
-                        return_url=f"{load_config().domain_url}/billing/return?phone={phone}",
-                    )
-                    send_message(from_number,
-                                 "✅ Sua assinatura já está ativa.\n"
-                                 "Use o portal abaixo para alterar forma de pagamento, trocar plano ou cancelar:\n"
-                                 f"{portal_url}"
-                                 )
-                except Exception as e:
-                    print("Portal error on /pagar:", str(e))
-                    send_message(from_number,
-                                 "✅ Sua assinatura já está ativa.\n"
-                                 "Se precisar alterar o pagamento, responda aqui que te ajudamos."
-                                 )
-                return {"status": "ok"}
+# Comando /x – PDF com colunas (produto, usuário, hora)
+@command("/x")
+def _cmd_detailed_pdf(from_number, phone, arg, instance_id):
+    group = get_user_group(phone)
+    raw_doc_id = f"{group.get('instance', 'default')}__{group['owner']}__{group['list']}"
+    doc_id = quote(raw_doc_id, safe="")
+    timestamp = int(time.time())
+
+    pdf_url = f"https://listinha-t5ga.onrender.com/view?g={doc_id}&format=pdf&mode=vc&footer=true&t={timestamp}"
+    send_message(from_number, list_detailed_url(pdf_url))
+
+# Clear all items: l (admin only)
+@command("/l", gated=True, admin_only=NOT_OWNER_CANNOT_CLEAR, locks_list=True)
+def _cmd_clear(from_number, phone, arg, instance_id):
+    clear_items(phone)
+    send_message(from_number, LIST_CLEARED)
+    # (1) Show updated list right after action
+    _send_current_list(from_number, phone)
+
+@command("/z")
+def _cmd_bonus(from_number, phone, arg, instance_id):
+    # --- 0) Status & eligibility check ---
+    now = int(time.time())
+    b = get_user_billing(phone) or {}
+    state, _ = compute_status(b)  # uses trial_end/grace_until/stripe info
 
-            # Otherwise, proceed to create a new Checkout
+    # A. If already paying or still within a free window, do NOT grant
+    #    Paying: ACTIVE
+    #    Free window: TRIAL or GRACE
+    if state in {"ACTIVE", "TRIAL", "GRACE"}:
+        send_message(from_number, "ℹ️ O bônus de 60 dias pode ser ativado após o fim do seu período de teste.")
+    else:
+        # B. Only after trial/without sub: EXPIRED / NONE / CANCELED can get the 60-day bonus
+        if b.get("z_bonus_used"):
+            send_message(from_number, "⚠️ O bônus de 60 dias já foi utilizado nesta conta.")
+        else:
+            # Allow fractional days for testing (e.g., Z_BONUS_DAYS_DEFAULT=0.0069 ≈ 10min)
             try:
-                group = get_user_group(phone) or {}
-                instance_id = group.get("instance", "default")
-                sess = create_checkout_session(phone, instance_id)
-                url = sess.get("url")
-                cust_id = sess.get("customer_id")
-                sub_id = sess.get("subscription_id")
-
-                patch = {
-                    "last_checkout_url": url,
-                    "last_updated": int(time.time()),
-                }
-                if cust_id:
-                    patch["stripe_customer_id"] = cust_id
-                if sub_id:
-                    patch["subscription_id"] = sub_id
-                update_user_billing(phone, patch)
-
-                from messages import CHECKOUT_LINK
-                send_message(from_number, CHECKOUT_LINK(url))
-            except Exception as e:
-                print("Stripe error on /pagar:", str(e))
-                send_message(from_number, "⚠️ Não foi possível gerar o link agora. Tente novamente em instantes.")
-            return {"status": "ok"}
+                z_days = float(os.getenv("Z_BONUS_DAYS_DEFAULT", "60"))
+            except Exception:
+                z_days = 60.0
+            grace_until = now + int(z_days * 24 * 3600)
+            update_user_billing(phone, {
+                "grace_until": grace_until,
+                "z_bonus_used": True,
+                "last_updated": now,
+            })
+            send_message(from_number, "🎁 Bônus aplicado: +60 dias liberados a partir de agora.")
+
+    # --- 1) Instruction message (keep your viral flow) ---
+    send_message(from_number, z_step1_instructions())
+
+    # --- 2) Ready-to-copy message + 3) Short demo video ---
+    full_text = indication_text(PUBLIC_DISPLAY_NUMBER)
+    demo_url = "https://listinha-t5ga.onrender.com/static/listinha-demo.mp4"
+    send_video(from_number, demo_url, caption=full_text, file=DEMO_VIDEO_FILE)
+
+# Payment link (/c)
+@command("/c")
+def _cmd_checkout(from_number, phone, arg, instance_id):
+    # Read current billing state
+    b = get_user_billing(phone) or {}
+    state, _ = compute_status(b)
 
-        # Status summary
-        if cmd in ("/w", "w"):
-            b = get_user_billing(phone) or {}
-            state, until_ts = compute_status(b)
-            send_message(from_number, STATUS_SUMMARY(state, until_ts))
-            print("DEBUG billing doc:", b)
-            return {"status": "ok"}
+    # If already active/trial/grace, don't sell again
+    if state in {"ACTIVE", "TRIAL", "GRACE"}:
+        try:
+            # Send Billing Portal so the user can manage the existing sub
+            portal_url = create_billing_portal_session(
+                phone,
+                return_url=f"{load_config().domain_url}/billing/return?phone={phone}",
+            )
+            send_message(from_number,
+                         "✅ Sua assinatura já está ativa.\n"
+                         "Use o portal abaixo para alterar forma de pagamento, trocar plano ou cancelar:\n"
+                         f"{portal_url}"
+                         )
+        except Exception as e:
+            print("Portal error on /pagar:", str(e))
+            send_message(from_number,
+                         "✅ Sua assinatura já está ativa.\n"
+                         "Se precisar alterar o pagamento, responda aqui que te ajudamos."
+                         )
+        return
+
+    # Otherwise, proceed to create a new Checkout
+    try:
+        group = get_user_group(phone) or {}
+        instance_id = group.get("instance", "default")
+        sess = create_checkout_session(phone, instance_id)
+        url = sess.get("url")
+        cust_id = sess.get("customer_id")
+        sub_id = sess.get("subscription_id")
+
+        patch = {
+            "last_checkout_url": url,
+            "last_updated": int(time.time()),
+        }
+        if cust_id:
+            patch["stripe_customer_id"] = cust_id
+        if sub_id:
+            patch["subscription_id"] = sub_id
+        update_user_billing(phone, patch)
 
-        # /g (gerenciar assinatura) — always allowed, never gated
-        if cmd in ("/g", "g"):
-            cfg = load_config()
+        from messages import CHECKOUT_LINK
+        send_message(from_number, CHECKOUT_LINK(url))
+    except Exception as e:
+        print("Stripe error on /pagar:", str(e))
+        send_message(from_number, "⚠️ Não foi possível gerar o link agora. Tente novamente em instantes.")
 
-            # Read current status to decide portal vs checkout
-            b = get_user_billing(phone) or {}
-            state, _until_ts = compute_status(b)
+# Status summary
+@command("/w")
+def _cmd_status(from_number, phone, arg, instance_id):
+    b = get_user_billing(phone) or {}
+    state, until_ts = compute_status(b)
+    send_message(from_number, STATUS_SUMMARY(state, until_ts))
+    print("DEBUG billing doc:", b)
 
-            try:
-                if state in {"ACTIVE", "TRIAL", "GRACE"}:
-                    # ✅ create_billing_portal_session expects PHONE and returns a URL string
-                    return_url = f"{cfg.domain_url}/billing/return?phone={phone}"
-                    portal_url = create_billing_portal_session(phone, return_url)
-                    send_message(from_number, PORTAL_LINK(portal_url))
-                else:
-                    # Not active → send Checkout so the user can start a subscription
-                    group = get_user_group(phone) or {}
-                    instance_id = group.get("instance", "default")
-                    checkout = create_checkout_session(phone=phone, instance_id=instance_id)
-                    send_message(from_number, PORTAL_INACTIVE_CHECKOUT(checkout["url"]))
-            except Exception as e:
-                print("Portal command error:", str(e))
-                # Fallback: be helpful but minimal
-                send_message(from_number, "⚠️ Não consegui abrir o portal agora. Tente novamente em alguns instantes.")
-            return {"status": "ok"}
+# /g (gerenciar assinatura) — always allowed, never gated
+@command("/g")
+def _cmd_portal(from_number, phone, arg, instance_id):
+    cfg = load_config()
 
-        # ✅ Fallback for unknown commands
-        send_message(from_number, UNKNOWN_COMMAND)
-        return {"status": "ok"}
+    # Read current status to decide portal vs checkout
+    b = get_user_billing(phone) or {}
+    state, _until_ts = compute_status(b)
 
+    try:
+        if state in {"ACTIVE", "TRIAL", "GRACE"}:
+            # ✅ create_billing_portal_session expects PHONE and returns a URL string
+            return_url = f"{cfg.domain_url}/billing/return?phone={phone}"
+            portal_url = create_billing_portal_session(phone, return_url)
+            send_message(from_number, PORTAL_LINK(portal_url))
+        else:
+            # Not active → send Checkout so the user can start a subscription
+            group = get_user_group(phone) or {}
+            instance_id = group.get("instance", "default")
+            checkout = create_checkout_session(phone=phone, instance_id=instance_id)
+            send_message(from_number, PORTAL_INACTIVE_CHECKOUT(checkout["url"]))
     except Exception as e:
-        print("❌ Erro processando webhook da Meta:", str(e))
-        return {"status": "ok"}
+        print("Portal command error:", str(e))
+        # Fallback: be helpful but minimal
+        send_message(from_number, "⚠️ Não consegui abrir o portal agora. Tente novamente em alguns instantes.")
 
 @app.post("/stripe/webhook")
 async def stripe_webhook(request: Request):
@@ -1127,13 +1423,13 @@ async def stripe_webhook(request: Request):
     if not phone:
         # Try to map by customer_id or subscription_id
         try:
-            phone = find_phone_by_customer_or_subscription(customer_id, subscription_id)
+            phone = await firebase_async.find_phone_by_customer_or_subscription(customer_id, subscription_id)
             print("🔁 Resolved phone by lookup:", phone)
         except Exception as e:
             print("⚠️ Lookup error (customer/sub -> phone):", str(e))
         # If we found the user by customer id but it wasn't stored yet, persist it eagerly
         if phone and customer_id:
-            update_user_billing(phone, {"stripe_customer_id": customer_id})
+            await firebase_async.update_user_billing(phone, {"stripe_customer_id": customer_id})
 
     # 4) Enrich missing subscription fields by fetching from Stripe
     # Some events (e.g., invoice.paid / invoice.payment_succeeded, checkout.session.completed)
@@ -1142,7 +1438,7 @@ async def stripe_webhook(request: Request):
         try:
             import stripe
             stripe.api_key = cfg.secret_key
-            sub = stripe.Subscription.retrieve(subscription_id)
+            sub = await run_in_threadpool(stripe.Subscription.retrieve, subscription_id)
             sub_status = (sub.get("status") if hasattr(sub, "get") else getattr(sub, "status", None))
             cpe = (sub.get("current_period_end") if hasattr(sub, "get") else getattr(sub, "current_period_end", None))
             te = (sub.get("trial_end") if hasattr(sub, "get") else getattr(sub, "trial_end", None))
@@ -1179,7 +1475,7 @@ async def stripe_webhook(request: Request):
     # 5) Idempotency guard (by event id per-user) and load previous billing for change detection
     prev_billing = None
     if phone:
-        prev_billing = get_user_billing(phone) or {}
+        prev_billing = await firebase_async.get_user_billing(phone) or {}
         if cfg.webhook_idempotency:
             last = (prev_billing or {}).get("last_event_id")
             current_id = ev.get("id")
@@ -1241,13 +1537,16 @@ async def stripe_webhook(request: Request):
             patch["subscription_id"] = subscription_id
 
         print("💾 Writing billing patch for", phone, "→", patch)
-        update_user_billing(phone, patch)
+        await firebase_async.update_user_billing(phone, patch)
 
         # 7) Send WhatsApp notification (if any)
         if notify_text:
             try:
                 print("📣 Sending billing notification to", phone)
-                send_message(f"whatsapp:{phone}", notify_text)  #
+                # Keyed by event id: Stripe retries of this event don't notify twice
+                event_id = ev.get("id")
+                key = f"stripe:{event_id}:{phone}" if event_id else None
+                await send_message_async(f"whatsapp:{phone}", notify_text, key=key)
             except Exception as e:
                 print("Notify send error:", str(e))
     else:
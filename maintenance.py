@@ -0,0 +1,110 @@
+# maintenance.py
+"""
+One-off data jobs. Run from the project root with the same env as the app:
+
+    python maintenance.py migrate-items --all
+    python maintenance.py migrate-items default__+5511999999999__default
+    python maintenance.py rebuild-members --all
+    python maintenance.py backfill-stripe-index
+    python maintenance.py slim-users
+"""
+import argparse
+import sys
+
+from firebase import (
+    iter_lists, is_paged_list, migrate_list_to_subcollection, rebuild_member_index,
+    backfill_stripe_index, iter_users, slim_user_doc,
+)
+
+
+def cmd_migrate_items(args) -> int:
+    if args.all:
+        doc_ids = [doc_id for doc_id, data in iter_lists() if not is_paged_list(data)]
+    else:
+        doc_ids = args.doc_ids
+    if not doc_ids:
+        print("Nothing to migrate.")
+        return 0
+
+    print(f"Migrating {len(doc_ids)} list(s) to the itens subcollection...")
+    failed = 0
+    for doc_id in doc_ids:
+        if args.dry_run:
+            print(f"  would migrate {doc_id}")
+            continue
+        try:
+            migrate_list_to_subcollection(doc_id, batch_size=args.batch_size)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {doc_id}: {e}")
+    return 1 if failed else 0
+
+
+def cmd_rebuild_members(args) -> int:
+    doc_ids = [doc_id for doc_id, _ in iter_lists()] if args.all else args.doc_ids
+    failed = 0
+    for doc_id in doc_ids:
+        try:
+            members = rebuild_member_index(doc_id)
+            print(f"✅ {doc_id}: {len(members)} member(s)")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {doc_id}: {e}")
+    return 1 if failed else 0
+
+
+def cmd_backfill_stripe_index(args) -> int:
+    total = backfill_stripe_index(batch_size=args.batch_size, dry_run=args.dry_run)
+    print(f"{'Would index' if args.dry_run else '✅ Indexed'} {total} Stripe id(s)")
+    return 0
+
+
+def cmd_slim_users(args) -> int:
+    moved = failed = 0
+    for phone, data in iter_users():
+        if "admin_audit" not in data and "last_view_snapshot" not in data:
+            continue
+        if args.dry_run:
+            print(f"  would slim {phone} ({len(data.get('admin_audit') or [])} audit entries)")
+            moved += 1
+            continue
+        try:
+            moved += slim_user_doc(phone, data)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {phone}: {e}")
+    print(f"{'Would slim' if args.dry_run else '✅ Slimmed'} {moved} user doc(s)")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Listinha maintenance jobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-items", help="move list items from the itens array to a subcollection")
+    p.add_argument("doc_ids", nargs="*", help="listas document ids")
+    p.add_argument("--all", action="store_true", help="every list still using the array layout")
+    p.add_argument("--batch-size", type=int, default=400)
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=cmd_migrate_items)
+
+    p = sub.add_parser("rebuild-members", help="recompute member_index on list docs from users")
+    p.add_argument("doc_ids", nargs="*", help="listas document ids")
+    p.add_argument("--all", action="store_true", help="every list")
+    p.set_defaults(func=cmd_rebuild_members)
+
+    p = sub.add_parser("backfill-stripe-index", help="write stripe_index entries for existing users")
+    p.add_argument("--batch-size", type=int, default=400)
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=cmd_backfill_stripe_index)
+
+    p = sub.add_parser("slim-users", help="move admin_audit / last_view_snapshot off users docs")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=cmd_slim_users)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
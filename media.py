@@ -0,0 +1,151 @@
+# media.py
+"""
+Uploaded-media cache for WhatsApp sends.
+
+Static files (the /z demo video) are uploaded to the Graph media endpoint
+once; the returned media id is kept in memory and in Firestore
+(media_cache/{phone_number_id}__{file}) with its expiry, so every worker
+and restart reuses it and messages go out by id instead of Meta fetching
+the file from our origin each time. The id is re-uploaded when it expires
+or the file changes. Lookups on the send path never block on an upload:
+until an id is ready, sends fall back to the public link.
+"""
+import hashlib
+import os
+import threading
+import time
+
+import graph_client
+from firebase import load_media_entry, save_media_entry
+
+MEDIA_UPLOAD = os.getenv("MEDIA_UPLOAD", "true").lower() == "true"
+# Meta keeps uploaded media for 30 days; renew a day early
+MEDIA_TTL_SECONDS = float(os.getenv("MEDIA_TTL_SECONDS", str(29 * 24 * 3600)))
+
+_entries: dict[str, dict] = {}        # key -> {"media_id", "sha1", "expires_at"}
+_sha1: dict[str, tuple[float, str]] = {}  # file -> (mtime, sha1)
+_uploading: set[str] = set()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "uploads": 0, "upload_errors": 0, "forgotten": 0}
+
+
+def _key(phone_number_id: str, file_path: str) -> str:
+    return f"{phone_number_id or 'default'}__{os.path.basename(file_path)}"
+
+
+def _file_sha1(file_path: str) -> str:
+    mtime = os.path.getmtime(file_path)
+    known = _sha1.get(file_path)
+    if known and known[0] == mtime:
+        return known[1]
+    h = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    _sha1[file_path] = (mtime, h.hexdigest())
+    return _sha1[file_path][1]
+
+
+def _valid(entry: dict | None, sha1: str) -> bool:
+    return bool(entry and entry.get("media_id") and entry.get("sha1") == sha1
+                and entry.get("expires_at", 0) > time.time())
+
+
+def cached_id(file_path: str, phone_number_id: str) -> str | None:
+    """Media id from memory if it is still valid (no I/O beyond a file stat)."""
+    if not MEDIA_UPLOAD:
+        return None
+    entry = _entries.get(_key(phone_number_id, file_path))
+    try:
+        ok = _valid(entry, _file_sha1(file_path))
+    except OSError:
+        ok = False
+    with _lock:
+        _stats["hits" if ok else "misses"] += 1
+    return entry["media_id"] if ok else None
+
+
+def ensure(file_path: str, mime_type: str, phone_number_id: str, token: str, api_version: str) -> str | None:
+    """Valid media id for file_path: memory → Firestore → upload. None on failure."""
+    if not MEDIA_UPLOAD:
+        return None
+    key = _key(phone_number_id, file_path)
+    sha1 = _file_sha1(file_path)
+    if _valid(_entries.get(key), sha1):
+        return _entries[key]["media_id"]
+    try:
+        stored = load_media_entry(key)
+    except Exception as e:
+        print(f"⚠️ Media cache read failed for {key}:", str(e))
+        stored = None
+    if _valid(stored, sha1):
+        _entries[key] = stored
+        return stored["media_id"]
+
+    r = graph_client.upload_media(f"{api_version}/{phone_number_id}/media", file_path, mime_type, token,
+                                  pool=phone_number_id)
+    media_id = None
+    if r.status_code < 400:
+        try:
+            media_id = (r.json() or {}).get("id")
+        except ValueError:
+            pass
+    if not media_id:
+        with _lock:
+            _stats["upload_errors"] += 1
+        print(f"❌ Media upload failed for {key}: {r.status_code} {r.text[:300]}")
+        return None
+    entry = {"media_id": media_id, "sha1": sha1, "expires_at": time.time() + MEDIA_TTL_SECONDS,
+             "file": os.path.basename(file_path), "uploaded_at": int(time.time())}
+    _entries[key] = entry
+    with _lock:
+        _stats["uploads"] += 1
+    try:
+        save_media_entry(key, entry)
+    except Exception as e:
+        print(f"⚠️ Media cache write failed for {key}:", str(e))
+    print(f"🎞️ Uploaded {entry['file']} to Meta: media_id={media_id}")
+    return media_id
+
+
+def ensure_in_background(file_path: str, mime_type: str, phone_number_id: str, token: str, api_version: str) -> None:
+    """Start one upload thread per file (no-op if one is already running)."""
+    key = _key(phone_number_id, file_path)
+    with _lock:
+        if not MEDIA_UPLOAD or key in _uploading:
+            return
+        _uploading.add(key)
+
+    def _run():
+        try:
+            ensure(file_path, mime_type, phone_number_id, token, api_version)
+        except Exception as e:
+            with _lock:
+                _stats["upload_errors"] += 1
+            print(f"❌ Media upload failed for {key}:", str(e))
+        finally:
+            with _lock:
+                _uploading.discard(key)
+
+    threading.Thread(target=_run, name="media-upload", daemon=True).start()
+
+
+def forget(file_path: str, phone_number_id: str) -> None:
+    """Meta rejected the cached id (deleted/expired early): drop it everywhere."""
+    key = _key(phone_number_id, file_path)
+    _entries.pop(key, None)
+    with _lock:
+        _stats["forgotten"] += 1
+    try:
+        save_media_entry(key, None)
+    except Exception as e:
+        print(f"⚠️ Media cache delete failed for {key}:", str(e))
+
+
+def stats() -> dict:
+    now = time.time()
+    with _lock:
+        out = dict(_stats)
+    out["entries"] = {key: {"media_id": e["media_id"], "expires_in_h": round((e["expires_at"] - now) / 3600, 1)}
+                      for key, e in list(_entries.items())}
+    return out
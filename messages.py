@@ -171,6 +171,18 @@ def item_already_exists(item):
     return f"⚠️ O item *{item}* já está na sua Listinha 😉"
 
 
+def items_added(added, existing):
+    """Confirmation for `i a, b, c` (several items in one message)."""
+    lines = []
+    if len(added) == 1:
+        lines.append(item_added_log(added[0]))
+    elif added:
+        lines.append(f"✅ {len(added)} itens incluídos na sua Listinha: " + ", ".join(f"*{i}*" for i in added) + ".")
+    if existing:
+        lines.append("⚠️ Já estavam na sua Listinha: " + ", ".join(f"*{i}*" for i in existing) + " 😉")
+    return "\n".join(lines)
+
+
 def item_removed(item):
     return f"🗑️ Item *{item}* removido da sua Listinha."
 
@@ -179,6 +191,18 @@ def item_not_found(item):
     return f"🔎 Não encontrei o item *{item}* na sua Listinha."
 
 
+def items_removed(removed, not_found):
+    """Confirmation for `a 1,3,5-9` / `a leite, pão` (several items in one message)."""
+    lines = []
+    if len(removed) == 1:
+        lines.append(item_removed(removed[0]))
+    elif removed:
+        lines.append(f"🗑️ {len(removed)} itens removidos da sua Listinha: " + ", ".join(f"*{i}*" for i in removed) + ".")
+    if not_found:
+        lines.append("🔎 Não encontrei na sua Listinha: " + ", ".join(f"*{i}*" for i in not_found) + ".")
+    return "\n".join(lines)
+
+
 def br_local_number(num: str) -> str:
     """Return the Brazilian local form without country code.
     Ex.: '+55 11 91270-5543' -> '11912705543'"""
@@ -288,10 +312,12 @@ MENU_TEXT = (
     "• i — Incluir um item na lista\n"
     "   Formato: `i <item>`\n"
     "   📌 ex.: `i água`\n"
-    "   📌 ex.: `i arroz - 5 kg`\n\n"
+    "   📌 ex.: `i arroz - 5 kg`\n"
+    "   📌 vários: `i arroz, feijão, leite 1,5 l` (vírgula colada entre números, como `1,5`, não separa itens)\n\n"
     "• a — Apagar um item da lista\n"
     "   Formato: `a <item>`\n"
-    "   📌 ex.: `a laranja`\n\n"
+    "   📌 ex.: `a laranja`\n"
+    "   📌 vários: `a 1,3,5-9` ou `a leite, pão`\n\n"
     "• v — Ver todos os itens da lista\n\n"
     "• u — Incluir um convidado\n"
     "   Formato: `u <telefone> <nome>`\n"
@@ -0,0 +1,176 @@
+# mirror.py
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ("watch", "data", "ready", "last_used", "snapshots")
+
+    def __init__(self):
+        self.watch = None
+        self.data = None
+        self.ready = False       # True once a snapshot arrived and no local write is pending
+        # snapshots counts deliveries: it is the sequence mark()/written() compare
+        self.last_used = time.monotonic()
+        self.snapshots = 0
+
+
+class DocMirror:
+    """
+    Always-fresh local copies of hot documents, kept by snapshot listeners.
+
+    watch(doc_id) subscribes (the first access to a doc does it); get()
+    serves the latest snapshot once the listener delivered one. At most
+    `maxsize` docs are watched (least recently used is dropped) and docs not
+    read for `idle_ttl` seconds are unsubscribed by a background sweeper.
+    Because every process listens to the same documents, a write made by
+    another uvicorn worker reaches this copy too.
+    """
+
+    def __init__(self, name: str, doc_ref, maxsize: int = 200, idle_ttl: float = 600.0):
+        self.name = name
+        self._doc_ref = doc_ref  # doc_id -> document reference with on_snapshot()
+        self.maxsize = max(1, int(maxsize))
+        self.idle_ttl = float(idle_ttl)
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.subscribes = 0
+        self.unsubscribes = 0
+        self.snapshots = 0
+
+    def get(self, doc_id: str) -> tuple[bool, dict | None]:
+        """(found, data) from the mirror; found is False until a snapshot arrived."""
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is not None and entry.watch is not None and not getattr(entry.watch, "is_active", True):
+                # Listener died (network, permissions...): stop trusting it
+                self._drop(doc_id)
+                entry = None
+            if entry is None or not entry.ready:
+                self.misses += 1
+                if entry is not None:
+                    entry.last_used = time.monotonic()
+                return False, None
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(doc_id)
+            self.hits += 1
+            return True, copy.deepcopy(entry.data)
+
+    def watch(self, doc_id: str) -> None:
+        """Start mirroring doc_id (no-op if already watched)."""
+        with self._lock:
+            if doc_id in self._entries:
+                self._entries[doc_id].last_used = time.monotonic()
+                self._entries.move_to_end(doc_id)
+                return
+            entry = self._entries[doc_id] = _Entry()
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+            self._start_sweeper()
+        # Subscribe outside the lock: the first snapshot may be delivered right away
+        try:
+            watch = self._doc_ref(doc_id).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(doc_id, entry, docs)
+            )
+        except Exception as e:
+            print(f"⚠️ {self.name} mirror: could not watch {doc_id}: {e}")
+            with self._lock:
+                if self._entries.get(doc_id) is entry:
+                    del self._entries[doc_id]
+            return
+        with self._lock:
+            self.subscribes += 1
+            if self._entries.get(doc_id) is entry:
+                entry.watch = watch
+                return
+        watch.unsubscribe()  # evicted while subscribing
+
+    def mark(self, doc_id: str) -> int | None:
+        """Call right before writing doc_id; hand the result to written(since=...)."""
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            return entry.snapshots if entry is not None else None
+
+    def written(self, doc_id: str, since: int | None = None) -> None:
+        """
+        We just wrote doc_id: don't serve the mirror until the listener catches
+        up. If a snapshot was already delivered after mark() (the listener can
+        beat the write call's return), the copy is kept; otherwise it waits
+        for the next one.
+        """
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is not None and (since is None or entry.snapshots <= since):
+                entry.ready = False
+
+    def _on_snapshot(self, doc_id: str, entry: _Entry, docs) -> None:
+        snap = docs[0] if docs else None
+        data = (snap.to_dict() or {}) if snap is not None and snap.exists else None
+        with self._lock:
+            if self._entries.get(doc_id) is not entry:
+                return
+            entry.data = data
+            entry.ready = True
+            entry.snapshots += 1
+            self.snapshots += 1
+
+    def _drop(self, doc_id: str) -> None:
+        entry = self._entries.pop(doc_id, None)
+        if entry is None or entry.watch is None:
+            return
+        self.unsubscribes += 1
+        try:
+            entry.watch.unsubscribe()
+        except Exception as e:
+            print(f"⚠️ {self.name} mirror: unsubscribe {doc_id} failed: {e}")
+
+    def sweep(self) -> int:
+        """Unsubscribe docs idle for longer than idle_ttl; returns how many."""
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = [doc_id for doc_id, entry in self._entries.items() if entry.last_used < cutoff]
+            for doc_id in idle:
+                self._drop(doc_id)
+        return len(idle)
+
+    def _start_sweeper(self) -> None:
+        if self._sweeper is not None:
+            return
+
+        def _loop():
+            interval = max(1.0, min(60.0, self.idle_ttl / 2))
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"⚠️ {self.name} mirror sweep failed: {e}")
+
+        self._sweeper = threading.Thread(target=_loop, name=f"{self.name}-mirror-sweep", daemon=True)
+        self._sweeper.start()
+
+    def clear(self) -> None:
+        with self._lock:
+            for doc_id in list(self._entries):
+                self._drop(doc_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "watched": len(self._entries),
+                "ready": sum(1 for e in self._entries.values() if e.ready),
+                "maxsize": self.maxsize,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "subscribes": self.subscribes,
+                "unsubscribes": self.unsubscribes,
+                "snapshots": self.snapshots,
+            }
@@ -0,0 +1,168 @@
+# outbound.py
+"""
+In-process outbound message queue.
+
+Handlers submit() messages and return; worker tasks on the event loop
+deliver them after the webhook has answered. Recipients are sharded over
+the workers by a hash of the phone, so one person's messages go out
+strictly in submit order ("item added" before the refreshed list) while
+different people are served in parallel.
+"""
+import asyncio
+import collections
+import os
+import threading
+import time
+import zlib
+
+OUTBOUND_QUEUE = os.getenv("OUTBOUND_QUEUE", "true").lower() == "true"
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+OUTBOUND_DRAIN_SECONDS = float(os.getenv("OUTBOUND_DRAIN_SECONDS", "10"))
+
+
+def recipient_key(to: str) -> str:
+    return (to or "").replace("whatsapp:", "").strip().lstrip("+")
+
+
+class OutboundQueue:
+    def __init__(self, workers: int = 4, latency_window: int = 500, name: str = ""):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._loop = None
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._deliver = None
+        self._closing = False
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=latency_window)  # submit → delivered, ms
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and not self._closing
+
+    def start(self, deliver) -> None:
+        """Start the workers on the running loop; deliver(to, msg) is a coroutine."""
+        self._loop = asyncio.get_running_loop()
+        self._deliver = deliver
+        self._closing = False
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [self._loop.create_task(self._worker(q)) for q in self._queues]
+        print(f"📮 Outbound queue {self.name or '-'} started with {self.workers} worker(s)")
+
+    def submit(self, to: str, msg: dict) -> bool:
+        """
+        Queue msg for `to` (thread-safe). Returns False when the queue isn't
+        running, so the caller can send inline instead.
+        """
+        if not self.running:
+            return False
+        shard = self._queues[zlib.crc32(recipient_key(to).encode()) % len(self._queues)]
+        item = (to, msg, time.monotonic())
+        try:
+            # FIFO per calling thread, so per-recipient order is kept
+            self._loop.call_soon_threadsafe(self._put, shard, item)
+        except RuntimeError:  # loop already closed
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _put(self, shard: asyncio.Queue, item) -> None:
+        shard.put_nowait(item)
+        depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    async def _worker(self, shard: asyncio.Queue) -> None:
+        while True:
+            to, msg, submitted = await shard.get()
+            try:
+                await self._deliver(to, msg)
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"❌ Outbound delivery to {to} failed:", str(e))
+            finally:
+                shard.task_done()
+            with self._lock:
+                if ok:
+                    self.delivered += 1
+                    self._latencies.append((time.monotonic() - submitted) * 1000)
+                else:
+                    self.failed += 1
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Stop accepting messages, give the backlog `timeout` seconds, then cancel."""
+        if self._loop is None:
+            return
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Outbound queue stopped with {self.depth()} undelivered message(s)")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._loop = None
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+            enqueued, delivered, failed = self.enqueued, self.delivered, self.failed
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(p * len(lat)))], 1) if lat else 0.0
+
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "depth": self.depth(),
+            "depth_by_worker": [q.qsize() for q in self._queues],
+            "max_depth": self.max_depth,
+            "enqueued": enqueued,
+            "delivered": delivered,
+            "failed": failed,
+            "latency_ms": {"p50": pct(0.50), "p95": pct(0.95), "max": round(lat[-1], 1) if lat else 0.0},
+        }
+
+
+# One queue (and OUTBOUND_WORKERS workers) per WhatsApp number, so outbound
+# capacity grows with the numbers we register; main.py starts them in the lifespan
+_queues: dict[str, OutboundQueue] = {}
+_default = None
+
+
+def start(numbers, deliver) -> None:
+    """Start a queue for each phone_number_id; the first one also takes unknown numbers."""
+    global _default
+    for number in dict.fromkeys(n or "default" for n in numbers):
+        queue = _queues.get(number)
+        if queue is None:
+            queue = _queues[number] = OutboundQueue(workers=OUTBOUND_WORKERS, name=number)
+        queue.start(deliver)
+        if _default is None:
+            _default = queue
+
+
+def submit(number: str, to: str, msg: dict) -> bool:
+    """Queue msg on the queue of the number it is sent from; False if none is running."""
+    queue = _queues.get(number or "default") or _default
+    return queue is not None and queue.submit(to, msg)
+
+
+async def stop(timeout: float = 10.0) -> None:
+    global _default
+    await asyncio.gather(*(q.stop(timeout) for q in _queues.values()))
+    _default = None
+
+
+def stats() -> dict:
+    return {number: q.stats() for number, q in list(_queues.items())}
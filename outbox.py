@@ -0,0 +1,226 @@
+# outbox.py
+"""
+Durable outbox for outbound WhatsApp messages.
+
+Every message is written to a local SQLite file before it is handed to the
+outbound queue and marked delivered once the Graph API accepted it. A send
+that fails is retried with exponential backoff; whatever was pending when
+the process stopped is replayed on the next start. Callers may pass an
+idempotency key (e.g. the Stripe event id): a key that was already recorded
+is not sent again, so webhook retries don't duplicate notifications.
+
+Each pending entry is owned by the process that recorded or claimed it
+(pid plus a boot nonce) until delivered()/failed() settles it, however long
+it waits in the outbound queue. Owners heartbeat in outbox_owners; only
+entries whose owner stopped heartbeating for OUTBOX_LEASE_SECONDS (or shut
+down via release()) are replayed, so workers sharing outbox.db never
+re-send each other's in-flight messages.
+
+Delivery is at-least-once: a crash between Graph accepting a message and
+delivered() being recorded sends that message again after restart.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+OUTBOX = os.getenv("OUTBOX", "true").lower() == "true"
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))       # seconds, doubled per attempt
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "120"))  # owner silent this long = dead
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "72"))  # idempotency window
+
+PENDING = "pending"
+DELIVERED = "delivered"
+DEAD = "dead"
+
+
+def backoff_seconds(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+
+
+class Outbox:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._heartbeat_at = 0.0
+        self.recorded = 0
+        self.duplicates = 0
+        self.replayed = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use so importing main doesn't touch the disk
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " key TEXT NOT NULL UNIQUE,"
+                " recipient TEXT NOT NULL,"
+                " msg TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " owner TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " last_error TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if "owner" not in columns:  # files created before owners were tracked
+                conn.execute("ALTER TABLE outbox ADD COLUMN owner TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS outbox_owners (owner TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    def _beat(self, db: sqlite3.Connection, now: float) -> None:
+        db.execute(
+            "INSERT INTO outbox_owners (owner, heartbeat_at) VALUES (?, ?)"
+            " ON CONFLICT(owner) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (self.owner, now),
+        )
+        self._heartbeat_at = now
+
+    def heartbeat(self) -> None:
+        """Tell other workers this process is alive (its entries are not to be replayed)."""
+        with self._lock:
+            self._beat(self._db(), time.time())
+
+    def release(self) -> None:
+        """At shutdown: drop our heartbeat so entries still pending here are replayed right away."""
+        with self._lock:
+            self._db().execute("DELETE FROM outbox_owners WHERE owner = ?", (self.owner,))
+
+    def record(self, to: str, msg: dict, key: str | None = None) -> int | None:
+        """
+        Persist msg before sending and lease it to the caller. Returns the
+        entry id, or None when `key` was already recorded (don't send again).
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            if now - self._heartbeat_at > OUTBOX_POLL_SECONDS:
+                self._beat(db, now)  # also covers processes without the replayer (scripts)
+            cur = db.execute(
+                "INSERT OR IGNORE INTO outbox (key, recipient, msg, status, next_attempt_at, owner,"
+                " created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key or uuid.uuid4().hex, to, json.dumps(msg, ensure_ascii=False), PENDING,
+                 now, self.owner, now, now),
+            )
+            if cur.rowcount == 0:
+                self.duplicates += 1
+                return None
+            self.recorded += 1
+            return cur.lastrowid
+
+    def delivered(self, entry_id: int) -> None:
+        with self._lock:
+            self._db().execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, owner = NULL,"
+                " updated_at = ?, last_error = NULL WHERE id = ?",
+                (DELIVERED, time.time(), entry_id),
+            )
+
+    def failed(self, entry_id: int, error: str, retry: bool = True) -> None:
+        """Schedule the next attempt with backoff, or give up (status dead)."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            dead = not retry or attempts >= OUTBOX_MAX_ATTEMPTS
+            db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, owner = NULL,"
+                " updated_at = ?, last_error = ? WHERE id = ?",
+                (DEAD if dead else PENDING, attempts, now + backoff_seconds(attempts), now,
+                 (error or "")[:500], entry_id),
+            )
+        if dead:
+            print(f"☠️ Outbox entry {entry_id} gave up after {attempts} attempt(s): {error}")
+
+    # Owners that heartbeat within the lease window; everyone else's entries are up for grabs
+    _LIVE = "SELECT owner FROM outbox_owners WHERE heartbeat_at > ?"
+
+    def recover(self) -> int:
+        """At startup: register this process and make entries of dead owners due now."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            self._beat(db, now)
+            db.execute("DELETE FROM outbox_owners WHERE heartbeat_at <= ?", (now - OUTBOX_LEASE_SECONDS,))
+            cur = db.execute(
+                "UPDATE outbox SET owner = NULL, next_attempt_at = MIN(next_attempt_at, ?)"
+                f" WHERE status = ? AND owner IS NOT NULL AND owner NOT IN ({self._LIVE})",
+                (now, PENDING, now - OUTBOX_LEASE_SECONDS),
+            )
+        return cur.rowcount
+
+    def claim_due(self, limit: int = 500) -> list[tuple[int, str, dict]]:
+        """
+        Take ownership of up to `limit` pending entries whose retry time has
+        come and that nobody alive owns, oldest first. Also heartbeats.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._beat(db, now)
+                rows = db.execute(
+                    "SELECT id, recipient, msg FROM outbox WHERE status = ? AND next_attempt_at <= ?"
+                    f" AND (owner IS NULL OR owner NOT IN ({self._LIVE})) ORDER BY id LIMIT ?",
+                    (PENDING, now, now - OUTBOX_LEASE_SECONDS, limit),
+                ).fetchall()
+                db.executemany(
+                    "UPDATE outbox SET owner = ? WHERE id = ?",
+                    [(self.owner, row[0]) for row in rows],
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            self.replayed += len(rows)
+        return [(entry_id, to, json.loads(msg)) for entry_id, to, msg in rows]
+
+    def purge(self) -> int:
+        """Drop delivered/dead entries older than the retention window."""
+        cutoff = time.time() - OUTBOX_RETENTION_HOURS * 3600
+        with self._lock:
+            cur = self._db().execute(
+                "DELETE FROM outbox WHERE status != ? AND updated_at < ?", (PENDING, cutoff)
+            )
+        return cur.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            db = self._db()
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = db.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+        return {
+            "pending": counts.get(PENDING, 0),
+            "delivered": counts.get(DELIVERED, 0),
+            "dead": counts.get(DEAD, 0),
+            "oldest_pending_s": round(time.time() - oldest, 1) if oldest else 0.0,
+            "recorded": self.recorded,
+            "duplicates_skipped": self.duplicates,
+            "replayed": self.replayed,
+            "owner": self.owner,
+        }
+
+
+# Process-wide outbox; main.py records, marks and replays through it
+outbox = Outbox(OUTBOX_PATH)
@@ -0,0 +1,125 @@
+# ratelimit.py
+"""
+Token-bucket limiter for Graph API sends, one bucket per phone_number_id.
+
+Each send reserves a token; when the bucket is empty the caller waits just
+long enough for its token to be refilled, so a burst is paced out at the
+configured rate instead of being fired at Meta and bounced with 429s. A
+throttling response pauses the whole bucket for the Retry-After period, so
+every worker sending from that number backs off together.
+
+    GRAPH_RATE_PER_SECOND=80          default rate per number
+    GRAPH_RATE_BURST=80               tokens available at once
+    GRAPH_RATE_LIMITS=123=20,456=50:100   per phone_number_id rate[:burst]
+"""
+import asyncio
+import os
+import threading
+import time
+
+GRAPH_RATE_PER_SECOND = float(os.getenv("GRAPH_RATE_PER_SECOND", "80"))
+GRAPH_RATE_BURST = float(os.getenv("GRAPH_RATE_BURST", str(GRAPH_RATE_PER_SECOND)))
+
+
+def _parse_limits(raw: str) -> dict[str, tuple[float, float]]:
+    limits = {}
+    for part in (raw or "").split(","):
+        key, _, spec = part.strip().partition("=")
+        if not key or not spec:
+            continue
+        try:
+            rate, _, burst = spec.partition(":")
+            limits[key.strip()] = (float(rate), float(burst or rate))
+        except ValueError:
+            print(f"⚠️ Ignoring invalid GRAPH_RATE_LIMITS entry: {part!r}")
+    return limits
+
+
+GRAPH_RATE_LIMITS = _parse_limits(os.getenv("GRAPH_RATE_LIMITS", ""))
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = max(0.001, float(rate))
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_ms = 0.0
+        self.throttled = 0
+
+    def _reserve(self) -> float:
+        """Take one token (possibly ahead of time); returns how long to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            # _updated is in the future while the bucket is paused: nothing refills until then
+            self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+            self._updated = max(now, self._updated)
+            self._tokens -= 1
+            wait = (self._updated - now) + max(0.0, -self._tokens / self.rate)
+            self.acquired += 1
+            if wait > 0:
+                self.waited += 1
+                self.wait_ms += wait * 1000
+            return wait
+
+    def acquire(self) -> float:
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        """Meta throttled us: hold every send from this number for `seconds`."""
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = max(self._updated, now + seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+            return {
+                "rate_per_s": self.rate,
+                "burst": self.burst,
+                "tokens": round(tokens, 2),
+                "paused_s": round(max(0.0, self._updated - now), 2),
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "avg_wait_ms": round(self.wait_ms / self.waited, 1) if self.waited else 0.0,
+                "throttled": self.throttled,
+            }
+
+
+_buckets: dict[str, TokenBucket] = {}
+_lock = threading.Lock()
+
+
+def bucket(phone_number_id: str) -> TokenBucket:
+    key = phone_number_id or "default"
+    found = _buckets.get(key)
+    if found is None:
+        with _lock:
+            found = _buckets.get(key)
+            if found is None:
+                rate, burst = GRAPH_RATE_LIMITS.get(key, (GRAPH_RATE_PER_SECOND, GRAPH_RATE_BURST))
+                found = _buckets[key] = TokenBucket(key, rate, burst)
+    return found
+
+
+def stats() -> dict:
+    with _lock:
+        buckets = dict(_buckets)
+    return {key: b.stats() for key, b in buckets.items()}
@@ -0,0 +1,107 @@
+# replies.py
+"""
+Coalesced replies: while one inbound WhatsApp message is handled, the text
+replies it produces are collected per recipient and sent as a single
+message ("item added" + the refreshed list = one Graph call instead of
+two). Text is split only when it would go over WhatsApp's 4096-character
+limit, preferring the boundary between replies, then a line break.
+"""
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+
+REPLY_COALESCE = os.getenv("REPLY_COALESCE", "true").lower() == "true"
+WHATSAPP_TEXT_LIMIT = 4096
+REPLY_SEPARATOR = "\n\n"
+
+_batch: contextvars.ContextVar = contextvars.ContextVar("listinha_reply_batch", default=None)
+_lock = threading.Lock()
+_stats = {"batches": 0, "replies": 0, "messages": 0}
+
+
+def _cut(text: str, limit: int) -> list[str]:
+    """Split one oversized reply at line breaks (hard cut for a single huge line)."""
+    chunks = []
+    while len(text) > limit:
+        at = text.rfind("\n", 0, limit + 1)
+        if at <= 0:
+            at = limit
+        chunks.append(text[:at].rstrip("\n"))
+        text = text[at:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def split_text(bodies: list[str], limit: int = WHATSAPP_TEXT_LIMIT) -> list[str]:
+    """Pack replies, in order, into as few messages of at most `limit` characters as possible."""
+    out = []
+    current = ""
+    for body in bodies:
+        for piece in _cut(body, limit):
+            joined = f"{current}{REPLY_SEPARATOR}{piece}" if current else piece
+            if len(joined) <= limit:
+                current = joined
+            else:
+                out.append(current)
+                current = piece
+    if current:
+        out.append(current)
+    return out
+
+
+class ReplyBatch:
+    def __init__(self, send):
+        self._send = send  # send(to, body): the real (non-coalesced) text send
+        self._pending: dict[str, list[str]] = {}  # recipient -> bodies, in send order
+
+    def add(self, to: str, body: str) -> None:
+        self._pending.setdefault(to, []).append(body)
+
+    def flush(self, to: str | None = None) -> None:
+        """Send what was collected (for one recipient, or everyone)."""
+        recipients = [to] if to is not None else list(self._pending)
+        for recipient in recipients:
+            bodies = self._pending.pop(recipient, None)
+            if not bodies:
+                continue
+            messages = split_text(bodies)
+            with _lock:
+                _stats["replies"] += len(bodies)
+                _stats["messages"] += len(messages)
+            for text in messages:
+                self._send(recipient, text)
+
+
+@contextmanager
+def collect(send):
+    """Coalesce the text replies sent inside this block; they go out when it exits."""
+    if not REPLY_COALESCE:
+        yield None
+        return
+    batch = ReplyBatch(send)
+    token = _batch.set(batch)
+    try:
+        yield batch
+    finally:
+        _batch.reset(token)
+        with _lock:
+            _stats["batches"] += 1
+        batch.flush()
+
+
+def current() -> ReplyBatch | None:
+    return _batch.get()
+
+
+def stats() -> dict:
+    with _lock:
+        replies, messages = _stats["replies"], _stats["messages"]
+        return {
+            "enabled": REPLY_COALESCE,
+            "batches": _stats["batches"],
+            "replies": replies,
+            "messages_sent": messages,
+            "calls_saved": replies - messages,
+        }
@@ -0,0 +1,620 @@
+# storage.py
+"""
+Document storage behind the data layer.
+
+firebase.py talks to a Firestore-shaped client (collection / document /
+where / batch / transaction ...). STORAGE_BACKEND picks what sits behind it:
+
+  firestore (default)  Google Cloud Firestore via firebase_admin
+  memory               process-local dicts: no credentials, no network
+  sqlite               one JSON row per document in STORAGE_SQLITE_PATH
+
+The local engines implement the subset of the client API the app uses with
+the same write semantics (set/merge/update, dotted update paths, ArrayUnion,
+ArrayRemove, Increment, DELETE_FIELD, SERVER_TIMESTAMP), so the whole
+webhook path can run and be profiled on a laptop.
+"""
+import base64
+import copy
+import json
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timezone
+
+import lazy
+from lazy import LazyModule
+
+# google-cloud-firestore is only imported when a sentinel or client is used
+firestore = LazyModule("firebase_admin.firestore")
+
+STORAGE_BACKEND = (os.getenv("STORAGE_BACKEND") or "firestore").strip().lower()
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", "listinha.db")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class LazyClient:
+    """Module-level handle on client(); the real client is built on first use."""
+
+    def __getattr__(self, attr: str):
+        return getattr(client(), attr)
+
+
+def client():
+    """The process-wide document client for STORAGE_BACKEND."""
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        if STORAGE_BACKEND == "firestore":
+            _client = _firestore_client()
+        elif STORAGE_BACKEND == "memory":
+            _client = LocalClient(MemoryStore())
+        elif STORAGE_BACKEND == "sqlite":
+            _client = LocalClient(SQLiteStore(STORAGE_SQLITE_PATH))
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND!r}")
+        print(f"🗄️ Storage backend: {STORAGE_BACKEND}")
+    return _client
+
+
+def async_client():
+    """Async counterpart of client() (firestore_async for Firestore)."""
+    if STORAGE_BACKEND == "firestore":
+        client()  # makes sure the Firebase app is initialized
+        return lazy.load("firebase_admin.firestore_async").client()
+    return AsyncLocalClient(client())
+
+
+def _firestore_client():
+    firebase_admin = lazy.load("firebase_admin")
+    credentials = lazy.load("firebase_admin.credentials")
+
+    # Parse JSON string from env
+    firebase_creds = json.loads(os.getenv("FIREBASE_CREDENTIALS"))
+    cred = credentials.Certificate(firebase_creds)
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+def transactional(fn):
+    """Drop-in for @firestore.transactional that also runs local transactions."""
+    remote = firestore.transactional(fn)
+
+    def run(transaction, *args, **kwargs):
+        if isinstance(transaction, LocalTransaction):
+            return transaction.run(fn, *args, **kwargs)
+        return remote(transaction, *args, **kwargs)
+    return run
+
+
+# --- Write semantics ---
+
+def _split(path: str) -> tuple[str, str]:
+    parent, _, doc_id = path.rpartition("/")
+    return parent, doc_id
+
+
+def _transformed(current, value):
+    """Resolve a write value (possibly a Firestore sentinel) against the current one."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, firestore.ArrayUnion):
+        out = list(current) if isinstance(current, list) else []
+        out += [v for v in value.values if v not in out]
+        return out
+    if isinstance(value, firestore.ArrayRemove):
+        return [v for v in (current if isinstance(current, list) else []) if v not in value.values]
+    if isinstance(value, firestore.Increment):
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        return base + value.value
+    if isinstance(value, dict):
+        return _merge_into({}, value, merge=False)
+    return copy.deepcopy(value)
+
+
+def _merge_into(target: dict, data: dict, merge: bool) -> dict:
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        elif merge and isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_into(target[key], value, merge=True)
+        elif merge and isinstance(value, dict):
+            target[key] = _merge_into({}, value, merge=True)
+        else:
+            target[key] = _transformed(target.get(key), value)
+    return target
+
+
+def _apply_set(current: dict | None, data: dict, merge: bool) -> dict:
+    base = copy.deepcopy(current) if (merge and current) else {}
+    return _merge_into(base, data, merge=merge)
+
+
+def _apply_update(current: dict, data: dict) -> dict:
+    out = copy.deepcopy(current)
+    for path, value in data.items():
+        *parents, leaf = path.split(".")
+        target = out
+        for part in parents:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        if value is firestore.DELETE_FIELD:
+            target.pop(leaf, None)
+        else:
+            target[leaf] = _transformed(target.get(leaf), value)
+    return out
+
+
+def _field(data: dict | None, path: str):
+    """(found, value) for a dotted field path."""
+    cur = data
+    for part in path.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return False, None
+        cur = cur[part]
+    return True, cur
+
+
+# --- Local engines ---
+
+class MemoryStore:
+    """Documents in a dict: {collection_path: {doc_id: data}}."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._docs: dict[str, dict[str, dict]] = {}
+
+    def read(self, path: str) -> dict | None:
+        parent, doc_id = _split(path)
+        with self.lock:
+            return copy.deepcopy(self._docs.get(parent, {}).get(doc_id))
+
+    def scan(self, parent: str) -> list[tuple[str, dict]]:
+        with self.lock:
+            return [(doc_id, copy.deepcopy(data)) for doc_id, data in self._docs.get(parent, {}).items()]
+
+    def write_many(self, changes: dict[str, dict | None]) -> None:
+        with self.lock:
+            for path, data in changes.items():
+                parent, doc_id = _split(path)
+                if data is None:
+                    self._docs.get(parent, {}).pop(doc_id, None)
+                else:
+                    self._docs.setdefault(parent, {})[doc_id] = copy.deepcopy(data)
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if "__bytes__" in obj and len(obj) == 1:
+        return base64.b64decode(obj["__bytes__"])
+    if "__datetime__" in obj and len(obj) == 1:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class SQLiteStore:
+    """Documents as JSON rows in a single SQLite table."""
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                " parent TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL,"
+                " PRIMARY KEY (parent, id))"
+            )
+
+    def read(self, path: str) -> dict | None:
+        parent, doc_id = _split(path)
+        with self.lock:
+            row = self._conn.execute(
+                "SELECT data FROM docs WHERE parent = ? AND id = ?", (parent, doc_id)
+            ).fetchone()
+        return json.loads(row[0], object_hook=_decode) if row else None
+
+    def scan(self, parent: str) -> list[tuple[str, dict]]:
+        with self.lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM docs WHERE parent = ?", (parent,)
+            ).fetchall()
+        return [(doc_id, json.loads(data, object_hook=_decode)) for doc_id, data in rows]
+
+    def write_many(self, changes: dict[str, dict | None]) -> None:
+        with self.lock, self._conn:
+            for path, data in changes.items():
+                parent, doc_id = _split(path)
+                if data is None:
+                    self._conn.execute("DELETE FROM docs WHERE parent = ? AND id = ?", (parent, doc_id))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO docs (parent, id, data) VALUES (?, ?, ?)",
+                        (parent, doc_id, json.dumps(data, default=_encode)),
+                    )
+
+
+class LocalSnapshot:
+    def __init__(self, reference: "LocalDocument", data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str):
+        return copy.deepcopy(_field(self._data, field_path)[1])
+
+
+class LocalDocument:
+    def __init__(self, client: "LocalClient", path: str):
+        self._client = client
+        self.path = path
+        self.id = _split(path)[1]
+
+    @property
+    def parent(self) -> "LocalCollection":
+        return LocalCollection(self._client, _split(self.path)[0])
+
+    def collection(self, name: str) -> "LocalCollection":
+        return LocalCollection(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction=None) -> LocalSnapshot:
+        return LocalSnapshot(self, self._client.store.read(self.path))
+
+    def on_snapshot(self, callback) -> "LocalWatch":
+        """Call callback(docs, changes, read_time) now and after each write to this doc."""
+        return self._client._watch(self, callback)
+
+    def _commit(self, op: str, *args, **kwargs):
+        batch = self._client.batch()
+        getattr(batch, op)(self, *args, **kwargs)
+        batch.commit()
+
+    def set(self, document_data: dict, merge: bool = False):
+        self._commit("set", document_data, merge=merge)
+
+    def create(self, document_data: dict):
+        self._commit("create", document_data)
+
+    def update(self, field_updates: dict):
+        self._commit("update", field_updates)
+
+    def delete(self):
+        self._commit("delete")
+
+
+class LocalQuery:
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+        "not-in": lambda a, b: a not in b,
+        "array_contains": lambda a, b: isinstance(a, list) and b in a,
+        "array_contains_any": lambda a, b: isinstance(a, list) and any(v in a for v in b),
+    }
+
+    def __init__(self, client: "LocalClient", path: str, filters=(), orders=(),
+                 limit_to=None, offset_by=0, cursor=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_to
+        self._offset = offset_by
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> "LocalQuery":
+        state = {
+            "filters": self._filters, "orders": self._orders, "limit_to": self._limit,
+            "offset_by": self._offset, "cursor": self._cursor,
+        }
+        state.update(changes)
+        return LocalQuery(self._client, self._path, **state)
+
+    def where(self, field_path: str, op_string: str, value):
+        if op_string not in self._OPS:
+            raise ValueError(f"Unsupported operator: {op_string}")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit_to=count)
+
+    def offset(self, num_to_skip: int):
+        return self._copy(offset_by=num_to_skip)
+
+    def start_after(self, document_fields_or_snapshot):
+        cursor = document_fields_or_snapshot
+        if isinstance(cursor, LocalSnapshot):
+            cursor = cursor.to_dict()
+        return self._copy(cursor=cursor)
+
+    def _matches(self, data: dict) -> bool:
+        for field_path, op_string, value in self._filters:
+            found, current = _field(data, field_path)
+            if not found or not self._OPS[op_string](current, value):
+                return False
+        # Firestore leaves out documents missing an order_by field
+        return all(_field(data, f)[0] for f, _ in self._orders)
+
+    def stream(self, transaction=None):
+        rows = [(doc_id, data) for doc_id, data in self._client.store.scan(self._path) if self._matches(data)]
+        rows.sort(key=lambda row: row[0])
+        for field_path, direction in reversed(self._orders):
+            rows.sort(key=lambda row: _field(row[1], field_path)[1],
+                      reverse=(direction == "DESCENDING"))
+        if self._cursor is not None and self._orders:
+            rows = [row for row in rows if self._after_cursor(row[1])]
+        rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            yield LocalSnapshot(LocalDocument(self._client, f"{self._path}/{doc_id}"), data)
+
+    def _after_cursor(self, data: dict) -> bool:
+        for field_path, direction in self._orders:
+            found, bound = _field(self._cursor, field_path)
+            if not found:
+                return True
+            value = _field(data, field_path)[1]
+            if value == bound:
+                continue
+            return (value < bound) if direction == "DESCENDING" else (value > bound)
+        return False
+
+    def get(self, transaction=None) -> list[LocalSnapshot]:
+        return list(self.stream())
+
+
+class LocalCollection(LocalQuery):
+    def __init__(self, client: "LocalClient", path: str):
+        super().__init__(client, path)
+        self.id = _split(path)[1]
+
+    def document(self, document_id: str | None = None) -> LocalDocument:
+        return LocalDocument(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data: dict, document_id: str | None = None):
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return datetime.now(timezone.utc), ref
+
+
+class LocalWriteBatch:
+    def __init__(self, client: "LocalClient"):
+        self._client = client
+        self._ops: list[tuple] = []
+
+    def set(self, reference: LocalDocument, document_data: dict, merge: bool = False):
+        self._ops.append(("set", reference.path, document_data, merge))
+
+    def create(self, reference: LocalDocument, document_data: dict):
+        self._ops.append(("create", reference.path, document_data, False))
+
+    def update(self, reference: LocalDocument, field_updates: dict):
+        self._ops.append(("update", reference.path, field_updates, False))
+
+    def delete(self, reference: LocalDocument):
+        self._ops.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        from google.api_core.exceptions import AlreadyExists, NotFound
+
+        store = self._client.store
+        with store.lock:
+            changes: dict[str, dict | None] = {}
+            for op, path, data, merge in self._ops:
+                current = changes[path] if path in changes else store.read(path)
+                if op == "delete":
+                    changes[path] = None
+                elif op == "create":
+                    if current is not None:
+                        raise AlreadyExists(f"Document already exists: {path}")
+                    changes[path] = _apply_set(None, data, merge=False)
+                elif op == "update":
+                    if current is None:
+                        raise NotFound(f"No document to update: {path}")
+                    changes[path] = _apply_update(current, data)
+                else:
+                    changes[path] = _apply_set(current, data, merge=merge)
+            store.write_many(changes)
+        self._ops = []
+        self._client._notify(changes)
+        return []
+
+
+class LocalTransaction(LocalWriteBatch):
+    """Runs the whole function under the store lock, so it never conflicts."""
+
+    def __init__(self, client: "LocalClient", max_attempts: int = 5, read_only: bool = False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+
+    def get_all(self, references):
+        return self._client.get_all(references)
+
+    def run(self, fn, *args, **kwargs):
+        with self._client.store.lock:
+            self._ops = []
+            result = fn(self, *args, **kwargs)
+            self.commit()
+        return result
+
+
+class LocalWatch:
+    def __init__(self, client: "LocalClient", path: str, callback):
+        self._client = client
+        self._path = path
+        self._callback = callback
+        self.is_active = True
+
+    def _push(self, data: dict | None):
+        if not self.is_active:
+            return
+        ref = LocalDocument(self._client, self._path)
+        docs = [LocalSnapshot(ref, data)] if data is not None else []
+        self._callback(docs, [], datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        self.is_active = False
+        with self._client._watch_lock:
+            watchers = self._client._watchers.get(self._path, [])
+            if self in watchers:
+                watchers.remove(self)
+
+
+class LocalClient:
+    def __init__(self, store):
+        self.store = store
+        self._watchers: dict[str, list[LocalWatch]] = {}
+        self._watch_lock = threading.Lock()
+        self._events = None
+
+    def _watch(self, ref: LocalDocument, callback) -> LocalWatch:
+        watch = LocalWatch(self, ref.path, callback)
+        with self._watch_lock:
+            self._watchers.setdefault(ref.path, []).append(watch)
+            if self._events is None:
+                self._events = queue.Queue()
+                threading.Thread(target=self._deliver, name="local-watch", daemon=True).start()
+        self._events.put((watch, self.store.read(ref.path)))
+        return watch
+
+    def _notify(self, changes: dict[str, dict | None]) -> None:
+        # Only writes made through this process are seen. Snapshots are
+        # delivered on a background thread, in order, as Firestore does.
+        with self._watch_lock:
+            for path, data in changes.items():
+                for watch in self._watchers.get(path, []):
+                    self._events.put((watch, copy.deepcopy(data)))
+
+    def _deliver(self) -> None:
+        while True:
+            watch, data = self._events.get()
+            try:
+                watch._push(data)
+            except Exception as e:
+                print(f"⚠️ Snapshot listener failed: {e}")
+
+    def collection(self, collection_path: str) -> LocalCollection:
+        return LocalCollection(self, collection_path)
+
+    def document(self, document_path: str) -> LocalDocument:
+        return LocalDocument(self, document_path)
+
+    def batch(self) -> LocalWriteBatch:
+        return LocalWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> LocalTransaction:
+        return LocalTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for ref in references:
+            yield ref.get()
+
+
+# --- Async wrappers for the local engines (used by firebase_async) ---
+
+class AsyncLocalDocument:
+    def __init__(self, ref: LocalDocument):
+        self._ref = ref
+        self.id = ref.id
+        self.path = ref.path
+
+    async def get(self, transaction=None):
+        return self._ref.get()
+
+    async def set(self, document_data: dict, merge: bool = False):
+        self._ref.set(document_data, merge=merge)
+
+    async def update(self, field_updates: dict):
+        self._ref.update(field_updates)
+
+    async def delete(self):
+        self._ref.delete()
+
+
+class AsyncLocalQuery:
+    def __init__(self, query: LocalQuery):
+        self._query = query
+
+    def where(self, *args, **kwargs):
+        return AsyncLocalQuery(self._query.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return AsyncLocalQuery(self._query.order_by(*args, **kwargs))
+
+    def limit(self, count: int):
+        return AsyncLocalQuery(self._query.limit(count))
+
+    def offset(self, num_to_skip: int):
+        return AsyncLocalQuery(self._query.offset(num_to_skip))
+
+    def start_after(self, cursor):
+        return AsyncLocalQuery(self._query.start_after(cursor))
+
+    def document(self, document_id: str | None = None) -> AsyncLocalDocument:
+        return AsyncLocalDocument(self._query.document(document_id))
+
+    async def stream(self, transaction=None):
+        for snap in self._query.stream():
+            yield snap
+
+
+class AsyncLocalWriteBatch:
+    def __init__(self, batch: LocalWriteBatch):
+        self._batch = batch
+
+    def set(self, reference: AsyncLocalDocument, document_data: dict, merge: bool = False):
+        self._batch.set(reference._ref, document_data, merge=merge)
+
+    def create(self, reference: AsyncLocalDocument, document_data: dict):
+        self._batch.create(reference._ref, document_data)
+
+    def update(self, reference: AsyncLocalDocument, field_updates: dict):
+        self._batch.update(reference._ref, field_updates)
+
+    def delete(self, reference: AsyncLocalDocument):
+        self._batch.delete(reference._ref)
+
+    async def commit(self):
+        return self._batch.commit()
+
+
+class AsyncLocalClient:
+    def __init__(self, sync_client: LocalClient):
+        self._client = sync_client
+
+    def batch(self) -> AsyncLocalWriteBatch:
+        return AsyncLocalWriteBatch(self._client.batch())
+
+    def collection(self, collection_path: str) -> AsyncLocalQuery:
+        return AsyncLocalQuery(self._client.collection(collection_path))
+
+    def document(self, document_path: str) -> AsyncLocalDocument:
+        return AsyncLocalDocument(self._client.document(document_path))